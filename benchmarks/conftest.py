@@ -0,0 +1,69 @@
+# !usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Licensed under a 3-clause BSD license.
+#
+
+''' Benchmarks of the service client hot paths, against the local mock server
+
+Requires pytest-benchmark (pip install pytest-benchmark).  Runs against a MockServer in
+the test process, or against a mock server in its own process, so its threads do not
+compete with the client, if SCISERVER_MOCK_URL is set::
+
+    python -m sciserver.mockserver --port 8000 &
+    SCISERVER_MOCK_URL=http://127.0.0.1:8000 pytest benchmarks
+
+Results are compared against a baseline of the same host, kept in benchmarks/baselines, with::
+
+    invoke benchmark            # compare with the latest baseline, or save one on the first run
+    invoke benchmark --save     # save a new baseline
+
+'''
+
+from __future__ import print_function, division, absolute_import
+import os
+import sys
+import pytest
+
+# benchmark the checkout, installed or not
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'python'))
+
+from sciserver import config  # noqa: E402
+from sciserver.mockserver import MockServer, SERVICE_PATHS  # noqa: E402
+from sciserver.transport import Transport, set_transport  # noqa: E402
+
+# the result sizes, in rows, of the parsing benchmarks
+ROWS = [1000, 100000]
+
+
+@pytest.fixture(scope='session')
+def server():
+    ''' Points sciserver at the mock services for the whole run '''
+    url = os.environ.get('SCISERVER_MOCK_URL')
+    if url:
+        previous = {name: getattr(config, name) for name in list(SERVICE_PATHS) + ['token']}
+        for name, path in SERVICE_PATHS.items():
+            setattr(config, name, url.rstrip('/') + path)
+        config.token = 'mocktoken'
+        yield None
+        for name, val in previous.items():
+            setattr(config, name, val)
+    else:
+        with MockServer(job_duration=0.1) as server:
+            yield server
+
+
+@pytest.fixture(autouse=True)
+def transport(server):
+    ''' A fresh transport for each benchmark, so statistics and breakers do not carry over '''
+    previous = set_transport(Transport())
+    yield
+    set_transport(previous)
+
+
+def throughput(benchmark, nbytes):
+    ''' Records the throughput of a benchmark of a transfer of nbytes, in MB/s '''
+    benchmark.extra_info['MB'] = nbytes / 2**20
+    if benchmark.disabled or benchmark.stats is None:
+        return
+    benchmark.extra_info['MB/s'] = nbytes / 2**20 / benchmark.stats.stats.mean
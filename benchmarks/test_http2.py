@@ -0,0 +1,186 @@
+# !usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Licensed under a 3-clause BSD license.
+#
+
+''' Compares HTTP/1.1 connection pooling with the HTTP/2 backend
+
+Sends many small concurrent GET requests, like SkyServer.objectSearch or job status
+checks, through the sciserver transport with each backend, against a local HTTPS
+test server that answers every request after a fixed latency.
+
+Requires httpx[http2], hypercorn and trustme, and is skipped by pytest without them::
+
+    pip install "httpx[http2]" hypercorn trustme
+    pytest benchmarks/test_http2.py
+    python benchmarks/test_http2.py --requests 2000 --concurrency 64 --latency 0.02
+
+'''
+
+from __future__ import print_function, division, absolute_import
+import argparse
+import asyncio
+import os
+import socket
+import ssl
+import tempfile
+import threading
+import time
+from collections import deque
+import pytest
+import requests
+from sciserver import config
+from sciserver.transport import Transport, HTTP2Session, set_transport
+from sciserver.utils import send_request
+
+
+def make_app(latency):
+    ''' Returns an ASGI app answering every request with a small JSON body after latency seconds '''
+
+    async def app(scope, receive, send):
+        if scope['type'] != 'http':
+            return
+        await asyncio.sleep(latency)
+        body = '{{"objId": "{0}", "http_version": "{1}"}}'.format(
+            scope['query_string'].decode(), scope['http_version']).encode()
+        await send({'type': 'http.response.start', 'status': 200,
+                    'headers': [(b'content-type', b'application/json')]})
+        await send({'type': 'http.response.body', 'body': body})
+
+    return app
+
+
+def start_server(latency, workdir):
+    ''' Starts a local HTTPS server offering HTTP/2 and HTTP/1.1; returns its url and CA file '''
+    import trustme
+    from hypercorn.asyncio import serve
+    from hypercorn.config import Config
+
+    ca = trustme.CA()
+    cert = ca.issue_cert(u'127.0.0.1', u'localhost')
+    cafile = os.path.join(workdir, 'ca.pem')
+    certfile = os.path.join(workdir, 'cert.pem')
+    keyfile = os.path.join(workdir, 'key.pem')
+    ca.cert_pem.write_to_path(cafile)
+    cert.cert_chain_pems[0].write_to_path(certfile)
+    cert.private_key_pem.write_to_path(keyfile)
+
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+
+    hyper = Config()
+    hyper.bind = ['127.0.0.1:{0}'.format(port)]
+    hyper.certfile = certfile
+    hyper.keyfile = keyfile
+    hyper.loglevel = 'ERROR'
+    hyper.errorlog = None
+    hyper.keep_alive_max_requests = 10 ** 9
+    hyper.h2_max_concurrent_streams = 1000
+
+    async def forever():
+        await asyncio.Event().wait()
+
+    # a shutdown trigger keeps hypercorn from installing signal handlers outside the main thread
+    thread = threading.Thread(target=lambda: asyncio.run(serve(make_app(latency), hyper, shutdown_trigger=forever)))
+    thread.daemon = True
+    thread.start()
+
+    url = 'https://127.0.0.1:{0}'.format(port)
+    for i in range(100):
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            break
+        except socket.error:
+            time.sleep(0.05)
+    return url, cafile
+
+
+def run(transport, url, nrequests, concurrency):
+    ''' Sends nrequests distinct GETs from concurrency threads; returns the elapsed seconds '''
+    set_transport(transport)
+    pending = deque(range(nrequests))
+
+    def worker():
+        while True:
+            try:
+                i = pending.popleft()
+            except IndexError:
+                return
+            send_request('{0}/objectSearch?objId={1}'.format(url, i), acceptHeader='application/json')
+
+    threads = [threading.Thread(target=worker) for i in range(concurrency)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.time() - start
+
+
+def make_sessions(cafile, concurrency):
+    ''' Returns the (name, session) of the HTTP/1.1 pooled and HTTP/2 backends, trusting cafile '''
+    # CA bundles from the environment would override the test CA
+    pooled = requests.Session()
+    pooled.trust_env = False
+    pooled.verify = cafile
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+    pooled.mount('https://', adapter)
+    return [('HTTP/1.1 pool', pooled), ('HTTP/2', HTTP2Session(verify=ssl.create_default_context(cafile=cafile)))]
+
+
+# the requests, threads and server latency of the pytest benchmarks
+REQUESTS = 200
+CONCURRENCY = 32
+LATENCY = 0.005
+
+
+@pytest.fixture(scope='module')
+def http2_server(tmp_path_factory):
+    ''' A local HTTPS server offering HTTP/2, shared by the benchmarks of this module '''
+    for name in ['httpx', 'h2', 'hypercorn', 'trustme']:
+        pytest.importorskip(name)
+    return start_server(LATENCY, str(tmp_path_factory.mktemp('http2')))
+
+
+@pytest.mark.parametrize('backend', [0, 1], ids=['http1', 'http2'])
+def test_concurrent_requests(benchmark, http2_server, backend):
+    ''' REQUESTS small GETs from CONCURRENCY threads, through each backend '''
+    url, cafile = http2_server
+    name, session = make_sessions(cafile, CONCURRENCY)[backend]
+    transport = Transport(session=session, coalesce=False)
+    try:
+        run(transport, url, CONCURRENCY, CONCURRENCY)
+        benchmark(run, transport, url, REQUESTS, CONCURRENCY)
+    finally:
+        session.close()
+    assert transport.stats()['sent'] >= REQUESTS
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--requests', type=int, default=2000, help='the number of requests per backend')
+    parser.add_argument('--concurrency', type=int, default=64, help='the number of threads sending requests')
+    parser.add_argument('--latency', type=float, default=0.02, help='the server latency per request, in seconds')
+    args = parser.parse_args()
+
+    config.token = 'benchmark'
+    workdir = tempfile.mkdtemp()
+    url, cafile = start_server(args.latency, workdir)
+
+    backends = make_sessions(cafile, args.concurrency)
+    print('{0} requests, {1} threads, {2:.0f} ms server latency'.format(
+        args.requests, args.concurrency, args.latency * 1000))
+    print('{0:<16}{1:>10}{2:>12}'.format('backend', 'seconds', 'requests/s'))
+    for name, session in backends:
+        transport = Transport(session=session, coalesce=False)
+        run(transport, url, min(args.requests, args.concurrency), args.concurrency)
+        elapsed = run(transport, url, args.requests, args.concurrency)
+        print('{0:<16}{1:>10.2f}{2:>12.0f}'.format(name, elapsed, args.requests / elapsed))
+        session.close()
+
+
+if __name__ == '__main__':
+    main()
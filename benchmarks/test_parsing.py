@@ -0,0 +1,74 @@
+# !usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Licensed under a 3-clause BSD license.
+#
+
+''' Query result download and parsing, across result sizes and output formats '''
+
+from __future__ import print_function, division, absolute_import
+from io import StringIO
+import pandas
+import pytest
+from sciserver.casjobs import CasJobs
+from sciserver.mockserver import photo_rows, PHOTO_COLUMNS
+from sciserver.skyquery import SkyQuery
+from sciserver.skyserver import SkyServer, read_csv, PHOTO_DTYPES
+from conftest import ROWS, throughput
+
+# the result sizes, in rows, of the SkyServer search benchmarks
+SEARCH_ROWS = [10000, 100000, 500000]
+
+
+def skyserver_csv(rows):
+    ''' A SkyServer csv result of rows photometric rows '''
+    lines = ['#Table1', ','.join(name for name, sqltype in PHOTO_COLUMNS)]
+    lines.extend(','.join(str(val) for val in row) for row in photo_rows(0, rows))
+    return ('\n'.join(lines) + '\n').encode()
+
+
+@pytest.mark.parametrize('rows', ROWS)
+@pytest.mark.parametrize('outformat', ['pandas', 'dict', 'csv', 'StringIO'])
+def test_execute_query(benchmark, rows, outformat):
+    benchmark.group = 'CasJobs.executeQuery {0} rows'.format(rows)
+    sql = 'select top {0} * from PhotoObj'.format(rows)
+    benchmark(CasJobs().executeQuery, sql, outformat=outformat, cache=False)
+
+
+@pytest.mark.parametrize('rows', SEARCH_ROWS)
+def test_sql_search(benchmark, rows):
+    benchmark.group = 'SkyServer searches'
+    sql = 'select top {0} * from PhotoObj'.format(rows)
+    df = benchmark(SkyServer().sqlSearch, sql, cache=False)
+    assert len(df) == rows
+
+
+@pytest.mark.parametrize('rows', SEARCH_ROWS)
+def test_radial_search(benchmark, rows):
+    benchmark.group = 'SkyServer searches'
+    df = benchmark(SkyServer().radialSearch, ra=258.25, dec=64.05, radius=10, limit=str(rows))
+    assert len(df) == rows
+
+
+@pytest.mark.parametrize('rows', SEARCH_ROWS)
+@pytest.mark.parametrize('parser', ['pyarrow', 'c', 'decoded'])
+def test_read_csv(benchmark, rows, parser):
+    ''' Parsing a SkyServer csv result alone.  decoded is the former decode, StringIO and read_csv with comment='#' '''
+    benchmark.group = 'SkyServer csv parsing {0} rows'.format(rows)
+    if parser == 'pyarrow':
+        pytest.importorskip('pyarrow')
+    content = skyserver_csv(rows)
+    if parser == 'decoded':
+        df = benchmark(lambda: pandas.read_csv(StringIO(content.decode()), comment='#', index_col=None))
+    else:
+        df = benchmark(read_csv, content, dtype=PHOTO_DTYPES, engine=parser)
+    assert len(df) == rows
+    throughput(benchmark, len(content))
+
+
+@pytest.mark.parametrize('rows', ROWS)
+@pytest.mark.parametrize('dtype', [None, True])
+def test_get_table(benchmark, rows, dtype):
+    benchmark.group = 'SkyQuery.getTable'
+    df = benchmark(SkyQuery().getTable, 'PhotoObj', top=rows, dtype=dtype)
+    assert len(df) == rows
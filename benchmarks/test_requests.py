@@ -0,0 +1,35 @@
+# !usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Licensed under a 3-clause BSD license.
+#
+
+''' Per-request overhead of send_request and the transport '''
+
+from __future__ import print_function, division, absolute_import
+from sciserver import config
+from sciserver.transport import Transport, MemorySession, set_transport
+from sciserver.utils import send_request
+
+
+def test_send_request(benchmark):
+    ''' A small GET to the mock server: HTTP round trip plus client overhead '''
+    url = '{0}/Jobs.svc/queues'.format(config.SkyQueryUrl)
+    response = benchmark(send_request, url, acceptHeader='application/json')
+    assert response.json()['queues']
+
+
+def test_send_request_put(benchmark):
+    ''' A small PUT, which is never coalesced or retried '''
+    url = '{0}/contexts/MyDB/jobs'.format(config.CasJobsRESTUri)
+    data = b'{"Query": "select 1", "TaskName": "benchmark"}'
+    benchmark(send_request, url, reqtype='put', data=data)
+
+
+def test_client_overhead(benchmark):
+    ''' A small GET answered in memory: the client overhead alone, without network '''
+    session = MemorySession()
+    session.add('get', r'/queues$', {'queues': [{'name': 'quick'}]})
+    set_transport(Transport(session=session))
+    response = benchmark(send_request, 'http://memory/queues', acceptHeader='application/json')
+    assert response.ok
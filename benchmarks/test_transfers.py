@@ -0,0 +1,68 @@
+# !usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Licensed under a 3-clause BSD license.
+#
+
+''' Upload and download throughput, upload serialization and job waiting latency '''
+
+from __future__ import print_function, division, absolute_import
+import pandas
+import pytest
+from sciserver.casjobs import CasJobs
+from sciserver.mockserver import photo_rows, PHOTO_COLUMNS
+from sciserver.scidrive import SciDrive
+from sciserver.skyquery import SkyQuery
+from conftest import ROWS, throughput
+
+SIZES = [2**20, 2**24]
+
+
+def photo_frame(rows):
+    return pandas.DataFrame(photo_rows(0, rows), columns=[name for name, sqltype in PHOTO_COLUMNS])
+
+
+@pytest.mark.parametrize('size', SIZES)
+def test_scidrive_upload(benchmark, size):
+    benchmark.group = 'SciDrive upload'
+    data = b'x' * size
+    benchmark(SciDrive().upload, 'bench/upload.bin', data=data)
+    throughput(benchmark, size)
+
+
+@pytest.mark.parametrize('size', SIZES)
+def test_scidrive_download(benchmark, size):
+    benchmark.group = 'SciDrive download'
+    drive = SciDrive()
+    drive.upload('bench/download.bin', data=b'x' * size)
+    data = benchmark(drive.download, 'bench/download.bin', outformat='BytesIO')
+    assert len(data.getvalue()) == size
+    throughput(benchmark, size)
+
+
+@pytest.mark.parametrize('rows', ROWS)
+def test_upload_dataframe(benchmark, rows):
+    benchmark.group = 'CasJobs.uploadPandasDataFrameToTable'
+    df = photo_frame(rows)
+    benchmark(CasJobs().uploadPandasDataFrameToTable, df, 'bench_upload')
+
+
+@pytest.mark.parametrize('rows', ROWS)
+def test_skyquery_upload(benchmark, rows):
+    benchmark.group = 'SkyQuery.uploadTable'
+    df = photo_frame(rows)
+    benchmark(SkyQuery().uploadTable, df, 'bench_upload', batch_rows=rows)
+
+
+def test_wait_for_job(benchmark, server):
+    ''' The time from submitting a job to seeing it finished, beyond the job duration '''
+    skyquery = SkyQuery()
+
+    def submit():
+        return (skyquery.submitJob('select top 10 * from PhotoObj', cache=False),), {'verbose': False}
+
+    job = benchmark.pedantic(skyquery.waitForJob, setup=submit, rounds=10)
+    assert job['status'] == 'completed'
+    if server and not benchmark.disabled and benchmark.stats is not None:
+        benchmark.extra_info['job_duration'] = server.job_duration
+        benchmark.extra_info['overshoot'] = benchmark.stats.stats.mean - server.job_duration
@@ -13,6 +13,8 @@ import os
 
 __version__ = "1.11.0dev"  # sciserver release version
 
+__all__ = ['SciServerConfig', 'config', 'deadline']
+
 
 class SciServerConfig(object):
     ''' Global configuration for SciServer
@@ -50,6 +52,68 @@ class SciServerConfig(object):
           package belongs.
           E.g., "1.11.0"
 
+        - **config.queryCache**: a sciserver.sqlcache.QueryCache holding query results keyed by
+          their normalized SQL and the user's token, or None to disable caching (default).  Results
+          expire after an hour by default, and queries of MyDB are never cached.
+          Set with sciserver.sqlcache.enable_cache().
+
+        - **config.metrics**: a sciserver.metrics.MetricsRegistry recording the time, size and status of
+          requests and the time spent parsing results, or None to not record them (default).
+          Set with sciserver.metrics.enable_metrics().
+
+        - **config.streamThreshold**: the decoded size in bytes (int) above which query results, e.g. from
+          SkyServer.sqlSearch, are parsed as they are streamed, instead of being read into memory and decoded
+          first.  None always reads them whole.  E.g., 67108864
+
+        - **config.memoryBudget**: the decoded size in bytes (int) above which the DataFrame results of
+          CasJobs.executeQuery, the SkyServer searches and SkyQuery.getTable are spilled to a local Arrow file
+          as they are streamed, and returned as a memory-mapped sciserver.spill.SpilledTable (needs pyarrow).
+          None keeps every result in memory (default).  E.g., 1073741824
+
+        - **config.spillDir**: the directory (string) of the files of spilled results, or None for the
+          system temporary directory (default).  E.g., "/home/idies/workspace/Temporary/spill"
+
+        - **config.connectTimeout**: the number of seconds to wait for a connection to a service (float),
+          or None to wait forever.  E.g., 15
+
+        - **config.readTimeout**: the number of seconds to wait for data from a service (float), between
+          received bytes rather than for the whole response, or None to wait forever.  E.g., 600
+
+        - **config.httpBackend**: the HTTP client used to send requests (string).  'requests' uses HTTP/1.1
+          with connection pooling.  'http2' uses HTTP/2 with httpx (pip install "httpx[http2]"), which
+          multiplexes concurrent requests to a host over one connection.  'memory' answers requests from
+          the routes added to an in-memory fake.  'record' sends requests with requests and records them to
+          config.transportRecording, and 'replay' answers requests from that recording.  E.g., "requests"
+
+        - **config.transportRecording**: the path of the recording (string) of the 'record' and 'replay'
+          backends.  It is read when the backend is chosen, so set it first.  E.g., "casjobs-session.jsonl"
+
+        - **config.replayLatency**: if set, the 'replay' backend delays each response by its recorded time
+          multiplied by this factor (float).  By default responses are replayed at once.  E.g., 1.0
+
+        - **config.asyncWorkers**: the number of threads running calls made through sciserver.aio (int).
+          E.g., 32
+
+        - **config.acceptEncoding**: the content codings accepted for responses (string).  'auto' accepts every
+          coding the installed urllib3 can decode (gzip, deflate, and zstd or br when zstandard or brotli are
+          installed), decoded incrementally as responses are read.  None asks for uncompressed responses.
+          E.g., "auto"
+
+        - **config.compressUploads**: the base URLs of services accepting gzip-compressed uploads (list).  Upload
+          bodies to them, from e.g. CasJobs.uploadCSVDataToTable, SkyQuery.uploadTable and SciDrive.upload,
+          are compressed as they are sent.  E.g., [config.SkyQueryUrl]
+
+        - **config.compressMinSize**: the minimum size in bytes of an upload body to compress (int).  Bodies
+          streamed from files or iterators are always compressed.  E.g., 65536
+
+        - **config.rateLimits**: client-side limits on the requests sent to each service (dict), keyed by
+          base URL, with values of the form {'rate': requests per second, 'burst': int, 'concurrency': int}.
+          Any of the keys can be left out.  Requests go by the longest matching base URL.
+          E.g., {config.CasJobsRESTUri: {'rate': 5, 'burst': 10, 'concurrency': 4}}
+
+        - **config.rateLimitLockDir**: if set, a directory (string) for the lock files sharing config.rateLimits
+          between all processes on the machine (POSIX only).  By default limits are shared between threads only.
+
     '''
 
     def __init__(self):
@@ -57,6 +121,22 @@ class SciServerConfig(object):
         self.set_paths()
         self.version = __version__
         self.token = None
+        self.queryCache = None
+        self.metrics = None
+        self.streamThreshold = 2**26
+        self.memoryBudget = None
+        self.spillDir = None
+        self.rateLimits = {}
+        self.rateLimitLockDir = None
+        self.connectTimeout = 15.
+        self.readTimeout = 600.
+        self.httpBackend = 'requests'
+        self.transportRecording = None
+        self.replayLatency = None
+        self.asyncWorkers = 32
+        self.acceptEncoding = 'auto'
+        self.compressUploads = []
+        self.compressMinSize = 2**16
 
     def set_paths(self):
         ''' Sets the initial paths for SciServer routes '''
@@ -107,3 +187,6 @@ class SciServerConfig(object):
 # create the config object
 config = SciServerConfig()
 
+# after the config object, which sciserver.transport imports
+from sciserver.transport import deadline  # noqa: E402
+
@@ -0,0 +1,68 @@
+# !usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Licensed under a 3-clause BSD license.
+#
+
+''' Awaitable SciServer calls for asyncio code (Python 3 only)
+
+Any blocking SciServer call can be awaited with :func:`run`, which runs it in a pool
+of config.asyncWorkers threads sharing the transport of the blocking API, with its
+retries, limits and coalescing.  With config.httpBackend set to 'http2', the
+concurrent calls are multiplexed over one HTTP/2 connection per host.
+
+Example:
+    >>> from sciserver import aio
+    >>> from sciserver.skyserver import SkyServer
+    >>> sky = SkyServer()
+    >>> async def fetch(objIds):
+    >>>     return await asyncio.gather(*[aio.run(sky.objectSearch, objId=objId) for objId in objIds])
+
+'''
+
+from __future__ import print_function, division, absolute_import
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from sciserver import config
+from sciserver import utils
+from sciserver.transport import bind_deadline
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    ''' Returns the thread pool running the awaited calls, creating it on first use '''
+    global _executor
+    with _executor_lock:
+        if _executor is None or _executor._max_workers != config.asyncWorkers:
+            _executor = ThreadPoolExecutor(max_workers=config.asyncWorkers)
+        return _executor
+
+
+def run(func, *args, **kwargs):
+    ''' Runs a blocking SciServer call in the worker pool
+
+    The call runs under the sciserver.deadline of the caller, if any.
+
+    Parameters:
+        func (callable):
+            the blocking call, e.g. SkyServer().objectSearch
+        args, kwargs:
+            the arguments of the call
+
+    Returns:
+        an awaitable resolving to the result of the call
+
+    Must be called from a coroutine or callback of a running event loop.
+
+    '''
+    loop = asyncio.get_running_loop()
+    return loop.run_in_executor(get_executor(), bind_deadline(functools.partial(func, *args, **kwargs)))
+
+
+def send_request(url, **kwargs):
+    ''' Awaitable version of sciserver.utils.send_request '''
+    return run(utils.send_request, url, **kwargs)
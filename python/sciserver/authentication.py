@@ -12,11 +12,10 @@ from __future__ import print_function, division, absolute_import
 import json
 import os.path
 import warnings
-import requests
 import netrc
 from sciserver import config
 from sciserver.exceptions import SciServerError
-from sciserver.utils import send_request
+from sciserver.utils import send_request, get_transport
 
 __author__ = 'gerard,mtaghiza'
 
@@ -136,7 +135,7 @@ class Authentication(object):
         data = json.dumps(auth).encode()
         headers = {'Content-Type': "application/json"}
 
-        response = requests.post(self.loginURL, data=data, headers=headers)
+        response = get_transport().request('post', self.loginURL, data=data, headers=headers)
         if response.ok:
             _token = response.headers['X-Subject-Token']
             self.setToken(_token)
@@ -10,14 +10,64 @@
 
 from __future__ import print_function, division, absolute_import
 from io import StringIO, BytesIO
+import codecs
 import json
+import re
 import time
 import requests as requests
 import pandas
 import os
-from sciserver import config
+from sciserver import config, metrics
 from sciserver.authentication import Authentication
-from sciserver.utils import checkAuth, send_request, Task
+from sciserver.exceptions import SciServerError
+from sciserver.spill import over_budget, spill_rows
+from sciserver.sqlcache import cached_query, invalidate, is_readonly
+from sciserver.utils import checkAuth, send_request, should_stream, ResponseStream, Task
+
+# separators between the rows of a json array
+_ROW_SEPARATOR = re.compile(r'[\s,]*')
+
+
+def _iter_json_rows(stream, chunk_size=2**20):
+    ''' Decodes the columns, then the rows, of the first table of a CasJobs json result as it is read
+
+    Only the current chunk of the response and the row being decoded are held in memory.
+    '''
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder('utf-8')()
+    text, pos, state = '', 0, 'columns'
+    while True:
+        chunk = stream.read(chunk_size)
+        text = text[pos:] + utf8.decode(chunk, final=not chunk)
+        pos = 0
+        while True:
+            if state in ('columns', 'data'):
+                key = text.find('"Columns"' if state == 'columns' else '"Data"', pos)
+                start = text.find('[', key) if key >= 0 else -1
+                if start < 0:
+                    break
+                if state == 'data':
+                    pos, state = start + 1, 'rows'
+                    continue
+                try:
+                    columns, pos = decoder.raw_decode(text, start)
+                except ValueError:
+                    break
+                state = 'data'
+                yield columns
+            else:
+                pos = _ROW_SEPARATOR.match(text, pos).end()
+                if pos == len(text):
+                    break
+                if text[pos] == ']':
+                    return
+                try:
+                    row, pos = decoder.raw_decode(text, pos)
+                except ValueError:
+                    break
+                yield row
+        if not chunk:
+            raise SciServerError('The json result ended before its table did')
 
 
 class CasJobs(object):
@@ -103,7 +153,7 @@ class CasJobs(object):
             jsonResponse = json.loads(response.content.decode())
             return jsonResponse
 
-    def executeQuery(self, sql, context="MyDB", outformat="pandas"):
+    def executeQuery(self, sql, context="MyDB", outformat="pandas", cache=True):
         """
         Executes a synchronous SQL query in a CasJobs database context.
 
@@ -123,9 +173,14 @@ class CasJobs(object):
                 \t\t'StringIO': an object of type io.StringIO, which has the .read() method and wraps a csv string that can be passed into pandas.read_csv for example.\n
                 \t\t'fits': an object of type io.BytesIO, which has the .read() method and wraps the result in fits format.\n
                 \t\t'BytesIO': an object of type io.BytesIO, which has the .read() method and wraps the result in fits format.\n
+            cache (bool):
+                if True, and config.queryCache is enabled, returns a copy of the cached result of an identical
+                query (after normalization) by the same user in the same context and format.  Statements that
+                modify data, and queries of MyDB, are never cached.  Set to False to always query the server.
 
         Returns:
-            The query result table, in the format specified
+            The query result table, in the format specified.  Pandas results larger than config.memoryBudget
+            are returned as a sciserver.spill.SpilledTable.
 
         Raises:
             Throws an exception if the HTTP request to the CasJobs API returns an error.
@@ -149,6 +204,13 @@ class CasJobs(object):
         else:
             raise Exception("Error when executing query. Illegal format parameter specification: {0}".format(outformat))
 
+        return cached_query(sql, ('casjobs', self.baseURI, context, outformat),
+                            lambda: self._execute_query(sql, context, outformat, acceptHeader), cache=cache,
+                            database=context)
+
+    def _execute_query(self, sql, context, outformat, acceptHeader):
+        ''' Sends a synchronous query to CasJobs and converts the result to outformat '''
+
         QueryUrl = self.make_uri(os.path.join(context, 'query'), base=self.contextURI)
 
         TaskName = self.get_taskname('executeQuery')
@@ -157,28 +219,41 @@ class CasJobs(object):
 
         data = json.dumps(query).encode()
 
-        postResponse = send_request(QueryUrl, reqtype='post', data=data, stream=True,
-                                    content_type='application/json', acceptHeader=acceptHeader,
-                                    errmsg='Error when getting schema name')
-
-        if postResponse.ok:
-            if (outformat == "readable") or (outformat == "StringIO"):
-                return StringIO(postResponse.content.decode())
-            elif outformat == "pandas":
-                r = json.loads(postResponse.content.decode())
-                return pandas.DataFrame(r['Result'][0]['Data'], columns=r['Result'][0]['Columns'])
-            elif outformat == "csv":
-                return postResponse.content.decode()
-            elif outformat == "dict":
-                return json.loads(postResponse.content.decode())
-            elif outformat == "json":
-                return postResponse.content.decode()
-            elif outformat == "fits":
-                return BytesIO(postResponse.content)
-            elif outformat == "BytesIO":
-                return BytesIO(postResponse.content)
-            else:  # should not occur
-                raise Exception("Error when executing query. Illegal format parameter specification: {0}".format(outformat))
+        # read-only queries are safe to retry
+        with metrics.task(TaskName):
+            postResponse = send_request(QueryUrl, reqtype='post', data=data, stream=True,
+                                        content_type='application/json', acceptHeader=acceptHeader,
+                                        errmsg='Error when getting schema name', idempotent=is_readonly(sql))
+            stream = ResponseStream(postResponse)
+            if outformat == 'pandas' and over_budget(stream):
+                with metrics.parsing('spill_rows'), metrics.stage('spill_rows'):
+                    rows = _iter_json_rows(stream)
+                    return spill_rows(next(rows), rows)
+
+            # results are read off the stream, so the bytes are freed once decoded
+            # rather than kept on the response until the DataFrame is built
+            streamed = outformat in ('pandas', 'dict') and should_stream(stream)
+            with metrics.stage('download (streamed)' if streamed else 'download'):
+                content = stream.read()
+
+            with metrics.parsing('executeQuery.{0}'.format(outformat)):
+                if (outformat == "fits") or (outformat == "BytesIO"):
+                    return BytesIO(content)
+                with metrics.stage('decode'):
+                    text = content.decode()
+                del content
+                if (outformat == "readable") or (outformat == "StringIO"):
+                    return StringIO(text)
+                elif (outformat == "csv") or (outformat == "json"):
+                    return text
+
+                with metrics.stage('json.loads'):
+                    r = json.loads(text)
+                del text
+                if outformat == "dict":
+                    return r
+                with metrics.stage('DataFrame'):
+                    return pandas.DataFrame(r['Result'][0]['Data'], columns=r['Result'][0]['Columns'])
 
     @checkAuth
     def submitJob(self, sql, context="MyDB"):
@@ -497,7 +572,8 @@ class CasJobs(object):
 
         Parameters:
             csvData:
-                a CSV table in string format.
+                a CSV table in string format, or a file-like object or iterator of bytes
+                that is streamed to the server.
             tableName (str):
                 the name of the CasJobs table to be created
             context (str):
@@ -519,9 +595,10 @@ class CasJobs(object):
 
         tablesUrl = self.make_uri(os.path.join(context, 'Tables', tableName), base=self.contextURI)
 
-        postResponse = send_request(tablesUrl, reqtype='post', data=csvData, stream=True,
+        postResponse = send_request(tablesUrl, reqtype='post', data=csvData, stream=True, compress=True,
                                     content_type='application/json',
                                     errmsg='Error when uploading CSV data into CasJobs table {0}'.format(tableName))
         if postResponse.ok:
+            invalidate(tableName)
             return True
 
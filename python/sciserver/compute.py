@@ -9,17 +9,23 @@
 # @Last Modified time: 2017-10-16 15:45:23
 
 from __future__ import print_function, division, absolute_import
-from sciserver import config
-from sciserver.utils import checkAuth, send_request, Task
+from sciserver import config, metrics
+from sciserver.utils import checkAuth, send_request, Task, RateLimiter, ResponseStream
 from sciserver.casjobs import CasJobs
 from sciserver.exceptions import SciServerError
-from io import StringIO
+from sciserver.transport import bind_deadline, effective_timeout
+from io import BytesIO
+from collections import deque
 import os
 import json
 import time
 import pandas
+import array
 import datetime
+import itertools
+import numpy
 import re
+import threading
 
 # Questions
 # add a runTime or endTime
@@ -43,8 +49,34 @@ STATUS_INFO = {1: "PENDING", 2: "QUEUED", 4: "ACCEPTED", 8: "STARTED",
 STATUS_CODES = {v: k for k, v in STATUS_INFO.items()}
 
 
+def _quote_braces(chunk):
+    ''' Quotes brace-enclosed values in a chunk of CSV bytes '''
+    return chunk.replace(b'{', b'"{').replace(b'}', b'}"')
+
+
+def _read_fits(source, memmap=False):
+    ''' Reads the first table of a FITS file into a Pandas Dataframe '''
+    try:
+        from astropy.table import Table
+    except ImportError:
+        raise SciServerError('astropy is required to load FITS job results.')
+    return Table.read(source, format='fits', memmap=memmap).to_pandas()
+
+
+# job time fields that are converted to datetimes once a job is done
+DATETIME_FIELDS = ('startTime', 'submissionTime')
+
+
 class Job(object):
-    ''' This class represents a Compute Job '''
+    ''' This class represents a Compute Job
+
+    The job information returned by the Compute System is kept as-is, and its keys
+    are accessible as attributes of the Job.  Job time fields are only converted into
+    Python datetimes when first accessed.
+
+    '''
+
+    __slots__ = ('_info', '_datetimes', 'code', 'status', 'error_message', 'verbose', 'upload_stats')
 
     def __init__(self, jobinfo, verbose=None):
         ''' A SciServer Compute Job
@@ -57,25 +89,50 @@ class Job(object):
 
         '''
         assert isinstance(jobinfo, dict), 'Job Info must be a dictionary object'
-        self._orig = jobinfo
-        # set class attributes
-        for key, val in jobinfo.items():
-            self.__setattr__(key, val)
+        self._info = jobinfo
+        self._datetimes = None
         self.code = jobinfo.get('status', None)
         self.status = STATUS_INFO[self.code]
         self.error_message = None
         self.verbose = verbose
-        if self.code > STATUS_CODES['FINISHED']:
-            self.set_datetimes()
+        self.upload_stats = None
 
     def __repr__(self):
         return '<Job(jobid={0.id}, status={0.status}, code={0.code})>'.format(self)
 
+    def __getattr__(self, name):
+        # only called for names that are not slots, i.e. the job information keys
+        if name.startswith('__') or name in Job.__slots__:
+            raise AttributeError(name)
+        if name in DATETIME_FIELDS and self.code > STATUS_CODES['FINISHED']:
+            self.set_datetimes()
+            return self._datetimes[name]
+        try:
+            return self._info[name]
+        except KeyError:
+            raise AttributeError("'Job' object has no attribute '{0}'".format(name))
+
+    def __dir__(self):
+        return sorted(set(dir(type(self)) + list(self.__slots__) + list(self._info.keys())))
+
+    @property
+    def result_target(self):
+        ''' The target holding the results file, i.e. the first FILE target '''
+        for target in self.targets:
+            if target['type'].startswith('FILE'):
+                return target
+        return self.targets[0]
+
+    @property
+    def result_format(self):
+        ''' The format of the results file, e.g. CSV, FITS or PARQUET '''
+        return self.result_target['type'].partition('_')[2] or 'CSV'
+
     @property
     def result_path(self):
         ''' Build the sub-path to the results file '''
         resultsFolder = self.resultsFolderURI.lstrip(os.path.sep)
-        targetLoc = self.targets[0]['location'].lstrip(os.path.sep)
+        targetLoc = self.result_target['location'].lstrip(os.path.sep)
         resultlink = os.path.join(resultsFolder, targetLoc)
         return resultlink
 
@@ -84,8 +141,13 @@ class Job(object):
         return self.code >= STATUS_CODES['FINISHED']
 
     def to_dict(self):
-        ''' Converts the Job to a dictionary '''
-        return self.__dict__
+        ''' Converts the Job to a new dictionary '''
+        jobdict = dict(self._info)
+        if self.code > STATUS_CODES['FINISHED']:
+            self.set_datetimes()
+            jobdict.update(self._datetimes)
+        jobdict.update({'code': self.code, 'status': self.status, 'error_message': self.error_message})
+        return jobdict
 
     def check_error(self):
         ''' Checks the job for an error message '''
@@ -98,29 +160,67 @@ class Job(object):
     def set_datetimes(self):
         ''' Converts job times into Python datetime objects '''
 
-        # multiply by 1e-3 to convert times from milliseconds to seconds
-        self.startTime = datetime.datetime.fromtimestamp(self.startTime * 1e-3)
-        self.submissionTime = datetime.datetime.fromtimestamp(self.submissionTime * 1e-3)
+        if self._datetimes is None:
+            # multiply by 1e-3 to convert times from milliseconds to seconds
+            self._datetimes = {name: datetime.datetime.fromtimestamp(self._info[name] * 1e-3)
+                               for name in DATETIME_FIELDS}
 
-    def loadDataFrame(self):
+    def loadDataFrame(self, chunksize=None, **kwargs):
         ''' Load the data into a Pandas Dataframe
 
+        Inside the Compute environment, the results file is read directly from the
+        workspace, memory-mapped.  Otherwise the results are streamed from the file
+        service and parsed as they arrive.  CSV, FITS and PARQUET result files are supported.
+
+        Parameters:
+            chunksize (int):
+                If set, returns an iterator of Dataframes of chunksize rows each, instead
+                of a single Dataframe.  Only used for CSV results.
+            kwargs:
+                Any additional keyword arguments passed to the Pandas reader
+
         Returns:
             A Pandas Dataframe of the results
 
         '''
-        if config.isSciServerComputeEnvironment():
-            location = '{0}{1}'.format(self.workspacePath, self.result_path)
-            df = pandas.read_csv(location)
-        else:
-            csv = self.retrieveData()
-            csv = csv.replace('{', '"{').replace('}', '}"')  # is this temporary?
-            df = pandas.read_csv(StringIO(csv), index_col=None)
-        return df
+        fileformat = self.result_format
+        assert fileformat in ('CSV', 'FITS', 'PARQUET'), 'Cannot load results of file type {0}'.format(fileformat)
 
-    def retrieveData(self):
+        if config.isSciServerComputeEnvironment():
+            location = os.path.join(config.computeWorkspace, self.result_path)
+            if fileformat == 'CSV':
+                return pandas.read_csv(location, memory_map=True, chunksize=chunksize, **kwargs)
+            elif fileformat == 'PARQUET':
+                return pandas.read_parquet(location, memory_map=True, **kwargs)
+            else:
+                return _read_fits(location, memmap=True)
+
+        with metrics.task(Task('loadDataFrame', use_base=True, component='Compute').name):
+            response = self.retrieveData(stream=True)
+            if fileformat == 'CSV':
+                # quote the brace-enclosed array columns as they stream in.  is this temporary?
+                stream = ResponseStream(response, transform=_quote_braces)
+                with metrics.parsing('pandas.read_csv (streamed)'), metrics.stage('read_csv (streamed)'):
+                    return pandas.read_csv(stream, index_col=None, chunksize=chunksize, **kwargs)
+
+            # binary formats need a seekable file
+            with metrics.stage('download'):
+                data = BytesIO(response.content)
+            response.close()
+            parser = 'pandas.read_parquet' if fileformat == 'PARQUET' else 'astropy.table'
+            with metrics.parsing(parser), metrics.stage(parser):
+                if fileformat == 'PARQUET':
+                    return pandas.read_parquet(data, **kwargs)
+                else:
+                    return _read_fits(data)
+
+    def retrieveData(self, stream=False):
         ''' Retrieve data from the server
 
+        Parameters:
+            stream (bool):
+                If True, returns the streamed HTTP response, without downloading its content
+
         Returns:
             A string representation of the CSV results data file
 
@@ -133,26 +233,285 @@ class Job(object):
         fileURL = os.path.join(alpha01URL, datalink)
 
         response = send_request(fileURL, content_type='application/json', acceptHeader='application/json',
-                                errmsg='Error when retrieving Job Results')
+                                errmsg='Error when retrieving Job Results', stream=stream)
         if response.ok:
-            return response.content.decode()
+            return response if stream else response.content.decode()
 
-    def upload(self, tableName, context='MyDB'):
+    def upload(self, tableName, context='MyDB', chunk_size=2**20):
         ''' Upload the job csv data into user mydb
 
         Uploads the Job results into MyDB using the SciServer
-        CasJobs class.
+        CasJobs class.  If the job already wrote its results to the requested
+        table via a TABLE target, nothing is transferred.  Otherwise the results
+        file is streamed from the file service straight into the CasJobs upload,
+        without loading it into memory.
+
+        Throughput statistics of the transfer are stored in Job.upload_stats.
 
         Parameters:
             tableName (str):
                 The name of the table of create in MyDB
             context (str):
                 The database name.  Default is MyDB
+            chunk_size (int):
+                The number of bytes to transfer at a time.  Default is 1 MB.
+
+        Returns:
+            True if the results were uploaded successfully
+
+        See Also:
+            Compute.submitQuery
+
+        '''
+        assert self.status == 'SUCCESS', 'Job must be successful to upload its results'
+
+        start = time.time()
+        stats = {'mode': 'server', 'bytes': 0, 'seconds': 0.0, 'rate': 0.0}
+
+        tables = [t['location'] for t in self.targets if t['type'] == 'TABLE']
+        if tableName in tables and context == 'MyDB':
+            self.upload_stats = stats
+            return True
+
+        response = self.retrieveData(stream=True)
+
+        def body():
+            for chunk in response.iter_content(chunk_size=chunk_size):
+                stats['bytes'] += len(chunk)
+                yield chunk
+
+        try:
+            cas = CasJobs()
+            result = cas.uploadCSVDataToTable(body(), tableName, context=context)
+        finally:
+            response.close()
+
+        stats['mode'] = 'stream'
+        stats['seconds'] = time.time() - start
+        stats['rate'] = stats['bytes'] / stats['seconds'] if stats['seconds'] else 0.0
+        self.upload_stats = stats
+        return result
+
+
+class JobTable(object):
+    ''' A compact columnar table of Compute Jobs
+
+    Holds many jobs at once, e.g. for monitoring.  The most used job fields are stored
+    in typed arrays, and all remaining fields of each job are kept as a compact JSON
+    string that is only parsed when a full Job or a rarely used column is requested.
+
+    Parameters:
+        jobinfos (list):
+            A list of job information dictionaries, as returned by the Compute System
+
+    Example:
+        >>> table = compute.getJobs(astable=True)
+        >>> df = table.to_dataframe()
+
+    '''
+
+    # (name, array typecode) of the columns stored as arrays; NaN marks missing times
+    numeric_columns = (('id', 'l'), ('status', 'H'), ('submissionTime', 'd'), ('startTime', 'd'),
+                       ('endTime', 'd'), ('rdbDomainId', 'l'))
+    string_columns = ('username', 'submitterDID', 'databaseContextName', 'type')
+
+    def __init__(self, jobinfos=None):
+        self._numeric = {name: array.array(code) for name, code in self.numeric_columns}
+        self._strings = {name: [] for name in self.string_columns}
+        self._rest = []
+        self._present = []
+        if jobinfos:
+            self.extend(jobinfos)
+
+    def __repr__(self):
+        return '<JobTable(njobs={0})>'.format(len(self))
+
+    def __len__(self):
+        return len(self._rest)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        return Job(self._jobinfo(index))
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    @property
+    def columns(self):
+        ''' The names of the columns stored directly in the table '''
+        return [name for name, code in self.numeric_columns] + list(self.string_columns)
+
+    def append(self, jobinfo):
+        ''' Appends a job information dictionary to the table '''
+        rest = dict(jobinfo)
+        for name, code in self.numeric_columns:
+            value = rest.pop(name, None)
+            if value is None:
+                value = float('nan') if code == 'd' else 0
+            self._numeric[name].append(value)
+        for name in self.string_columns:
+            self._strings[name].append(rest.pop(name, None))
+        self._present.append(tuple(name for name in self.columns if jobinfo.get(name) is not None))
+        self._rest.append(json.dumps(rest, separators=(',', ':')))
+
+    def extend(self, jobinfos):
+        ''' Appends a list of job information dictionaries to the table '''
+        for jobinfo in jobinfos:
+            if isinstance(jobinfo, Job):
+                jobinfo = jobinfo._info
+            self.append(jobinfo)
+
+    def _jobinfo(self, index):
+        ''' Rebuilds the full job information dictionary of a single job '''
+        jobinfo = json.loads(self._rest[index])
+        for name in self._present[index]:
+            jobinfo[name] = self.column(name)[index]
+        return jobinfo
+
+    def column(self, name):
+        ''' Returns a single column of the table
+
+        Parameters:
+            name (str):
+                The name of the job field
+
+        Returns:
+            An array or list of values, one per job
 
         '''
-        csvdata = self.retrieveData()
-        cas = CasJobs()
-        cas.uploadCSVDataToTable(csvdata, tableName, context="MyDB")
+        if name in self._numeric:
+            return self._numeric[name]
+        elif name in self._strings:
+            return self._strings[name]
+        else:
+            return [json.loads(rest).get(name) for rest in self._rest]
+
+    def to_dataframe(self, columns=None):
+        ''' Converts the table into a Pandas DataFrame
+
+        Job times are converted to (UTC) datetimes and status codes to status
+        names for the whole table at once.
+
+        Parameters:
+            columns (list):
+                The job fields to include.  Default is all stored columns.
+
+        Returns:
+            A Pandas DataFrame with one row per job
+
+        '''
+        columns = columns or self.columns
+        data = {}
+        for name in columns:
+            values = self.column(name)
+            if name in self._numeric:
+                values = numpy.frombuffer(values, dtype=values.typecode) if len(values) else numpy.array([])
+            data[name] = values
+
+        df = pandas.DataFrame(data, columns=columns)
+        for name in columns:
+            if name.endswith('Time') and name in self._numeric:
+                df[name] = pandas.to_datetime(df[name], unit='ms')
+        if 'status' in df:
+            df['code'] = df['status']
+            df['status'] = df['code'].map(STATUS_INFO)
+        return df
+
+
+def _to_milliseconds(value):
+    ''' Converts a datetime or unix timestamp into a job timestamp in milliseconds '''
+    if value is None:
+        return None
+    if isinstance(value, datetime.datetime):
+        value = time.mktime(value.timetuple()) + value.microsecond * 1e-6
+    return value * 1e3
+
+
+class JobIndex(object):
+    ''' A local index of finished Compute jobs
+
+    Finished jobs never change, so once seen they are kept here and do not need to
+    be downloaded again.  The floor is the job id at or below which every job is
+    known to be finished and stored in the index.
+
+    Parameters:
+        path (str):
+            Optional path to a JSON file used to persist the index between sessions
+
+    '''
+
+    def __init__(self, path=None):
+        self.path = path
+        self.jobs = {}
+        self.floor = None
+        if self.path and os.path.isfile(self.path):
+            self.load()
+
+    def __repr__(self):
+        return '<JobIndex(njobs={0}, floor={1})>'.format(len(self.jobs), self.floor)
+
+    def __len__(self):
+        return len(self.jobs)
+
+    def __contains__(self, jobid):
+        return jobid in self.jobs
+
+    def update(self, jobinfos, complete=False):
+        ''' Update the index with freshly fetched raw job dictionaries
+
+        Parameters:
+            jobinfos (list):
+                Raw job dictionaries for all jobs newer than the current floor
+            complete (bool):
+                If True, jobinfos is the complete job history
+
+        '''
+        if self.floor is None and not complete:
+            return
+
+        openids = []
+        for jobinfo in jobinfos:
+            if jobinfo.get('status', 0) >= STATUS_CODES['FINISHED']:
+                self.jobs[jobinfo['id']] = jobinfo
+            else:
+                openids.append(jobinfo['id'])
+
+        ids = [jobinfo['id'] for jobinfo in jobinfos]
+        if openids:
+            self.floor = min(openids) - 1
+        elif ids:
+            self.floor = max(ids + [self.floor or 0])
+        elif self.floor is None:
+            self.floor = 0
+
+        if self.path:
+            self.save()
+
+    def finished_before(self, floor):
+        ''' Returns the indexed jobs with ids at or below floor, newest first '''
+        jobids = sorted((jobid for jobid in self.jobs if jobid <= floor), reverse=True)
+        return [self.jobs[jobid] for jobid in jobids]
+
+    def clear(self):
+        ''' Clears the index '''
+        self.jobs = {}
+        self.floor = None
+
+    def save(self, path=None):
+        ''' Saves the index to a JSON file '''
+        path = path or self.path
+        with open(path, 'w') as f:
+            json.dump({'floor': self.floor, 'jobs': list(self.jobs.values())}, f)
+
+    def load(self, path=None):
+        ''' Loads the index from a JSON file '''
+        path = path or self.path
+        with open(path, 'r') as f:
+            data = json.load(f)
+        self.floor = data['floor']
+        self.jobs = {jobinfo['id']: jobinfo for jobinfo in data['jobs']}
 
 
 class Compute(object):
@@ -164,6 +523,7 @@ class Compute(object):
         self.jobsURL = os.path.join(self.computeURL, 'jobm/rest')
         self.job = None
         self.targets = []
+        self.jobindex = JobIndex()
         self.set_domains()
 
     def set_domains(self):
@@ -197,27 +557,139 @@ class Compute(object):
             jsonres = json.loads(response.content.decode())
             return jsonres
 
-    def getJobs(self, status=None):
+    def _fetch_job_page(self, start=0, top=100, onlyopen=None):
+        ''' Fetch a single page of raw job dictionaries, newest first '''
+
+        params = 'top={0}&start={1}'.format(top, start)
+        if onlyopen is not None:
+            params = '{0}&open={1}'.format(params, str(onlyopen).lower())
+        url = '{0}?{1}'.format(os.path.join(self.jobsURL, 'jobs'), params)
+
+        response = send_request(url, content_type='application/json', acceptHeader='application/json',
+                                errmsg='Error when retrieving jobs')
+        if response.ok:
+            return json.loads(response.content.decode())
+
+    def _iter_raw_jobs(self, pagesize=100, onlyopen=None, use_index=True):
+        ''' Iterate over raw job dictionaries, newest first
+
+        Pages are fetched from the server until reaching jobs already recorded as
+        finished in the local job index; the remaining jobs are served from the index.
+
+        '''
+        floor = self.jobindex.floor if use_index and onlyopen is not True else None
+        seen = set()
+        fetched = []
+        start = 0
+        reached_floor = False
+        while True:
+            page = self._fetch_job_page(start=start, top=pagesize, onlyopen=onlyopen) or []
+            for jobinfo in page:
+                if floor is not None and jobinfo['id'] <= floor:
+                    reached_floor = True
+                    break
+                # new jobs shift the page offsets, so skip any duplicates
+                if jobinfo['id'] in seen:
+                    continue
+                seen.add(jobinfo['id'])
+                fetched.append(jobinfo)
+                yield jobinfo
+            if reached_floor or len(page) < pagesize:
+                break
+            start += pagesize
+
+        if floor is None:
+            if onlyopen is None:
+                self.jobindex.update(fetched, complete=True)
+            return
+
+        # a closed-only listing does not show which newer jobs are still open
+        if onlyopen is None:
+            self.jobindex.update(fetched)
+        for jobinfo in self.jobindex.finished_before(floor):
+            if jobinfo['id'] not in seen:
+                yield jobinfo
+
+    def iterJobs(self, status=None, since=None, until=None, pagesize=100, use_index=True, raw=False):
+        ''' Iterate over jobs, newest first
+
+        Jobs are fetched from the server one page at a time, so iteration can be stopped
+        early without downloading the full job history.  Finished jobs are recorded in a
+        local job index, so later calls only fetch jobs newer than the oldest unfinished job.
+
+        Parameters:
+            status (str|list):
+                A specific status, or list of statuses, of jobs to return
+            since (datetime|float):
+                Only return jobs submitted at or after this time (a datetime or a unix timestamp)
+            until (datetime|float):
+                Only return jobs submitted before this time (a datetime or a unix timestamp)
+            pagesize (int):
+                The number of jobs to request per page.  Default is 100.
+            use_index (bool):
+                If True, serves already finished jobs from the local job index.  Default is True.
+            raw (bool):
+                If True, yields the job information dictionaries instead of Jobs
+
+        Returns:
+            A generator of SciServer Jobs
+
+        Example:
+            >>> # the ten most recent failed jobs
+            >>> jobs = list(itertools.islice(compute.iterJobs(status='ERROR'), 10))
+
+        '''
+
+        statuses = [status] if isinstance(status, str) else status
+        codes = set(STATUS_CODES[s] for s in statuses) if statuses else None
+
+        # let the server filter on open/closed jobs when possible
+        onlyopen = None
+        if codes:
+            if all(c < STATUS_CODES['FINISHED'] for c in codes):
+                onlyopen = True
+            elif all(c >= STATUS_CODES['FINISHED'] for c in codes):
+                onlyopen = False
+
+        since = _to_milliseconds(since)
+        until = _to_milliseconds(until)
+
+        for jobinfo in self._iter_raw_jobs(pagesize=pagesize, onlyopen=onlyopen, use_index=use_index):
+            subtime = jobinfo.get('submissionTime')
+            if until is not None and subtime is not None and subtime >= until:
+                continue
+            if since is not None and subtime is not None and subtime < since:
+                break
+            if codes and jobinfo.get('status') not in codes:
+                continue
+            yield jobinfo if raw else Job(jobinfo)
+
+    def getJobs(self, status=None, since=None, until=None, limit=None, astable=False):
         ''' Get a list of all jobs
 
         Parameters:
-            status (str):
-                A specific status of jobs to return
+            status (str|list):
+                A specific status, or list of statuses, of jobs to return
+            since (datetime|float):
+                Only return jobs submitted at or after this time (a datetime or a unix timestamp)
+            until (datetime|float):
+                Only return jobs submitted before this time (a datetime or a unix timestamp)
+            limit (int):
+                The maximum number of jobs to return
+            astable (bool):
+                If True, returns the jobs as a compact JobTable
 
         Returns:
-            A list of SciServer Jobs with the given status
+            A list of SciServer Jobs with the given status, newest first
+
+        See Also:
+            Compute.iterJobs
 
         '''
-        joburl = 'jobs'
-        url = os.path.join(self.jobsURL, joburl)
-        response = send_request(url, content_type='application/json', acceptHeader='application/json',
-                                errmsg='Error when retrieving jobs')
-        if response.ok:
-            jobjson = json.loads(response.content.decode())
-            joblist = [Job(j) for j in jobjson]
-            if status:
-                joblist = [j for j in joblist if j.status == status]
-            return joblist
+        pagesize = min(limit, 100) if limit else 100
+        jobs = self.iterJobs(status=status, since=since, until=until, pagesize=pagesize, raw=astable)
+        jobs = itertools.islice(jobs, limit)
+        return JobTable(jobs) if astable else list(jobs)
 
     def getJob(self, jobid):
         ''' Get a job
@@ -288,33 +760,31 @@ class Compute(object):
             print('Job [{0}]'.format(self.job.status))
             return self.job
 
-    def add_target(self, target_type, tablename='mytable', filename='results.csv', file_type='CSV'):
-        ''' Add a target location for query results '''
+    @staticmethod
+    def _make_target(target_type, tablename='mytable', filename='results.csv', file_type='CSV'):
+        ''' Create a target location dictionary for query results '''
 
         tt = target_type.upper()
         assert tt in ['FILE', 'TABLE'], 'target_type can only be FILE or TABLE'
 
-        # existing types
-        types = [t['type'] for t in self.targets]
-
-        # add a table
         if tt == 'TABLE':
-            tab_targ = {'location': tablename, 'type': tt, 'resultNumber': 1}
-            if tt in types:
-                tindex = types.index(tt)
-                self.targets[tindex] = tab_targ
-            else:
-                self.targets.append(tab_targ)
-
-        # add a file
-        if tt == 'FILE':
+            return {'location': tablename, 'type': tt, 'resultNumber': 1}
+        else:
             filetype = '{0}_{1}'.format(tt, file_type.upper())
-            file_targ = {'location': filename, 'type': filetype, 'resultNumber': 1}
-            if filetype in types:
-                tindex = types.index(filetype)
-                self.targets[tindex] = file_targ
-            else:
-                self.targets.append(file_targ)
+            return {'location': filename, 'type': filetype, 'resultNumber': 1}
+
+    def add_target(self, target_type, tablename='mytable', filename='results.csv', file_type='CSV'):
+        ''' Add a target location for query results '''
+
+        target = self._make_target(target_type, tablename=tablename, filename=filename, file_type=file_type)
+
+        # replace an existing target of the same type or add a new one
+        types = [t['type'] for t in self.targets]
+        if target['type'] in types:
+            tindex = types.index(target['type'])
+            self.targets[tindex] = target
+        else:
+            self.targets.append(target)
 
     def _create_job_input(self, sql, context="manga", queue='quick', filename='results.csv',
                           file_type='CSV', target_type='FILE', tablename='mytable',
@@ -328,12 +798,16 @@ class Compute(object):
         else:
             raise SciServerError('No domainid lookup found.  Check retrieveDomains for domain names.')
 
-        # add the target for the results
-        if not self.targets:
-            self.add_target(target_type, tablename=tablename, filename=filename, file_type=file_type)
+        # use any explicitly added targets, otherwise build one for this job only
+        if self.targets:
+            targets = list(self.targets)
+        else:
+            target_types = [target_type] if isinstance(target_type, str) else target_type
+            targets = [self._make_target(tt, tablename=tablename, filename=filename, file_type=file_type)
+                       for tt in target_types]
 
         job = {"inputSql": sql,
-               "targets": self.targets,
+               "targets": targets,
                "databaseContextName": context,
                "rdbDomainId": domainid,
                "submitterDID": name
@@ -353,8 +827,9 @@ class Compute(object):
                 The database to connect to
             domainId (int):
                 The compute domain id to connect to
-            target_type (str):
-                Type of output results.  Either TABLE or FILE
+            target_type (str|list):
+                Type of output results.  Either TABLE or FILE, or a list of both to write
+                the results to a file and to a MyDB table at once
             tablename (str):
                 The MyDB tablename to save the results to
             filename (str):
@@ -369,11 +844,14 @@ class Compute(object):
                 The job id of the submitted query
 
         '''
-        url = os.path.join(self.jobsURL, 'jobs/rdb')
-
         job = self._create_job_input(sql, context=context, queue=queue, target_type=target_type,
                                      tablename=tablename, filename=filename, file_type=file_type, name=name)
+        return self._submit_job_input(job)
+
+    def _submit_job_input(self, job):
+        ''' Submits a job dictionary to the RDB job endpoint and returns the job id '''
 
+        url = os.path.join(self.jobsURL, 'jobs/rdb')
         data = json.dumps(job)
 
         response = send_request(url, reqtype='post', data=data, content_type='application/json',
@@ -383,3 +861,177 @@ class Compute(object):
             jobid = jdata['id']
             return jobid
 
+    @staticmethod
+    def _parse_spec(spec):
+        ''' Converts a batch query spec into keyword arguments for _create_job_input
+
+        A spec can either be a dictionary of submitQuery keyword arguments, or a tuple
+        of (sql, context, target), where target is either a target_type string or a
+        dictionary of target keyword arguments (target_type, tablename, filename, file_type).
+
+        '''
+        if isinstance(spec, dict):
+            kwargs = dict(spec)
+        else:
+            spec = tuple(spec)
+            assert 1 <= len(spec) <= 3, 'A query spec must be a tuple of (sql, context, target)'
+            kwargs = {'sql': spec[0]}
+            if len(spec) > 1 and spec[1] is not None:
+                kwargs['context'] = spec[1]
+            if len(spec) > 2 and spec[2] is not None:
+                target = spec[2]
+                if isinstance(target, dict):
+                    kwargs.update(target)
+                else:
+                    kwargs['target_type'] = target
+
+        assert 'sql' in kwargs, 'A query spec must contain a sql query'
+        queue = kwargs.get('queue', 'quick')
+        kwargs['queue'] = 'quick' if queue == 'short' else queue
+        return kwargs
+
+    @checkAuth
+    def submitQueries(self, specs, max_inflight=None, rate=5, burst=5):
+        ''' Submit a batch of SQL queries to compute
+
+        Submits many queries concurrently.  The number of submissions in flight at once
+        is limited per compute domain, and all submissions share a client-side rate limit,
+        so the job manager is not flooded with requests.
+
+        Parameters:
+            specs (list):
+                A list of query specs.  Each spec is either a tuple of (sql, context, target),
+                where target is a target_type string (FILE or TABLE) or a dictionary of target
+                keyword arguments (target_type, tablename, filename, file_type), or a dictionary
+                of submitQuery keyword arguments.
+            max_inflight (dict):
+                The maximum number of concurrent submissions per queue.
+                Default is {'quick': 4, 'long': 2}.
+            rate (float):
+                The maximum number of submissions per second.  Default is 5.
+            burst (int):
+                The maximum number of submissions allowed in a single burst.  Default is 5.
+
+        Returns:
+            A JobSet of the submitted jobs, in the same order as the specs
+
+        Example:
+            >>> specs = [('select top 10 * from nsa', 'manga', 'FILE'),
+            >>>          ('select top 10 * from drpall', 'manga', {'target_type': 'TABLE', 'tablename': 'drp'})]
+            >>> jobset = compute.submitQueries(specs, max_inflight={'quick': 2})
+            >>> jobs = jobset.wait()
+
+        '''
+
+        inflight = {'quick': 4, 'long': 2}
+        if max_inflight:
+            inflight.update({'quick' if k == 'short' else k: v for k, v in max_inflight.items()})
+
+        # build all job inputs up front so bad specs fail before anything is submitted
+        jobinputs = {}
+        for index, spec in enumerate(specs):
+            kwargs = self._parse_spec(spec)
+            jobinputs.setdefault(kwargs['queue'], deque()).append((index, self._create_job_input(**kwargs)))
+
+        limiter = RateLimiter(rate, burst=burst)
+        jobids = [None] * len(specs)
+        errors = {}
+
+        def worker(pending):
+            while True:
+                try:
+                    index, job = pending.popleft()
+                except IndexError:
+                    return
+                limiter.acquire()
+                try:
+                    jobids[index] = self._submit_job_input(job)
+                except Exception as e:
+                    errors[index] = e
+
+        threads = []
+        for queue, pending in jobinputs.items():
+            nthreads = max(1, min(inflight.get(queue, 1), len(pending)))
+            for i in range(nthreads):
+                thread = threading.Thread(target=bind_deadline(worker), args=(pending,))
+                thread.daemon = True
+                thread.start()
+                threads.append(thread)
+
+        for thread in threads:
+            thread.join()
+
+        return JobSet(self, jobids, errors=errors)
+
+
+class JobSet(object):
+    ''' This class represents a set of submitted Compute Jobs
+
+    Returned by Compute.submitQueries.  The job ids are kept in the order of the
+    submitted specs.  Specs that failed to submit have a job id of None and
+    their exception is stored in the errors dictionary, keyed by spec index.
+
+    '''
+
+    def __init__(self, compute, jobids, errors=None):
+        self.compute = compute
+        self.jobids = list(jobids)
+        self.errors = errors or {}
+
+    def __repr__(self):
+        return '<JobSet(njobs={0}, nerrors={1})>'.format(len(self.jobids), len(self.errors))
+
+    def __len__(self):
+        return len(self.jobids)
+
+    def __iter__(self):
+        return iter(self.jobids)
+
+    def __getitem__(self, index):
+        return self.jobids[index]
+
+    @property
+    def submitted(self):
+        ''' The ids of all successfully submitted jobs '''
+        return [jobid for jobid in self.jobids if jobid is not None]
+
+    def wait(self, poll=1, timeout=None, verbose=None):
+        ''' Wait for all jobs in the set to finish
+
+        Parameters:
+            poll (float):
+                The number of seconds between status checks.  Default is 1.
+            timeout (float):
+                The maximum number of seconds to wait.  Default is to wait forever, or until
+                the current sciserver.deadline.
+            verbose (bool):
+                If True, prints the number of jobs still pending
+
+        Returns:
+            A list of SciServer Jobs, in the order of the submitted specs.  Specs
+            that failed to submit are returned as None.
+
+        Raises:
+            SciServerError: if the jobs are not finished before the timeout
+
+        '''
+        timeout = effective_timeout(timeout)
+        start = time.time()
+        finished = {}
+        pending = self.submitted
+        while pending:
+            for jobid in pending:
+                job = self.compute.getJob(jobid)
+                if job.is_finished():
+                    finished[jobid] = job
+            pending = [jobid for jobid in pending if jobid not in finished]
+            if not pending:
+                break
+            elapsed = time.time() - start
+            if timeout is not None and elapsed > timeout:
+                raise SciServerError('Timed out waiting for {0} jobs to finish'.format(len(pending)))
+            if verbose:
+                print('Wait [{0} pending] ... '.format(len(pending)))
+            time.sleep(poll if timeout is None else min(poll, max(timeout - elapsed, 0)))
+
+        return [finished.get(jobid) for jobid in self.jobids]
@@ -27,6 +27,27 @@ class SciServerAPIError(SciServerError):
         super(SciServerAPIError, self).__init__(message)
 
 
+class SciServerUploadError(SciServerError):
+    def __init__(self, message=None, batch=None):
+        self.batch = batch
+        if batch is not None:
+            message = 'Upload failed at batch {0}. Resume with start_batch={0}. {1}'.format(batch, message)
+        super(SciServerUploadError, self).__init__(message)
+
+
+class SciServerCircuitOpenError(SciServerError):
+    def __init__(self, host=None, retry_in=None):
+        self.host = host
+        self.retry_in = retry_in
+        message = 'Too many consecutive failures from {0}; requests are suspended for {1:.1f} more seconds'.format(
+            host, retry_in or 0)
+        super(SciServerCircuitOpenError, self).__init__(message)
+
+
+class SciServerTimeoutError(SciServerError):
+    pass
+
+
 class SciServerWarning(Warning):
     pass
 
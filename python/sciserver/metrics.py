@@ -0,0 +1,550 @@
+# !usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Licensed under a 3-clause BSD license.
+#
+
+''' Instrumentation of service requests and result parsing
+
+Every request sent through the transport, and the parsing of query results by the
+services, emit events to the hooks added with :func:`add_hook`:
+
+- **request_start**: a request is about to be sent (method, url, endpoint, task, bytes_out)
+- **request_end**: the request is done, after any retries (adds status, elapsed, wait,
+  bytes_in and error).  wait is the time until the response headers arrived, i.e.
+  connecting and the server work, and elapsed - wait the time spent downloading a
+  non-streamed body.
+- **retry**: the request is retried (endpoint, attempt, reason, delay)
+- **response_read**: a streamed response body was read to the end (endpoint, bytes_in)
+- **parse**: a result was parsed (parser, task, elapsed)
+
+The start and end events of a request get the same info dictionary, so a hook can keep
+state in it.  Endpoints are request paths with ids and tokens replaced by {id}, and
+tasks are the names of the sciserver.utils.Task of the service call, if any.
+
+With a MetricsRegistry in config.metrics, set by :func:`enable_metrics`, the events are
+also recorded as histograms and counters, which can be exported in the Prometheus text
+format.  :func:`enable_opentelemetry` exports requests and parsing as OpenTelemetry spans.
+
+Inside :func:`profile_memory`, the memory allocated by each stage of the service calls
+(downloading, decoding, json.loads, DataFrame construction, ...) is measured with tracemalloc.
+
+Example:
+    >>> from sciserver import metrics
+    >>> registry = metrics.enable_metrics()
+    >>> df = SkyServer().sqlSearch('select top 10 objid from PhotoObj')
+    >>> registry.histogram('request_seconds', endpoint='/DR13/SkyServerWS/SearchTools/SqlSearch',
+    >>>                    method='get', task='SciScript-Python.SkyServer.sqlSearch')
+    >>> print(registry.to_prometheus())
+
+'''
+
+from __future__ import print_function, division, absolute_import
+from bisect import bisect_left
+from contextlib import contextmanager
+import re
+import threading
+import time
+import warnings
+from requests.compat import urlparse
+from sciserver import config
+from sciserver.exceptions import SciServerError, SciServerWarning
+
+EVENTS = ('request_start', 'request_end', 'retry', 'response_read', 'parse')
+
+_hooks = dict((event, []) for event in EVENTS)
+_local = threading.local()
+
+# path segments that are ids: numbers, guids and tokens
+_ID = re.compile(r'^(\d+|[0-9a-fA-F-]{16,}|[A-Za-z0-9_-]{32,})$')
+
+
+def add_hook(event, func):
+    ''' Adds a hook called with the event name and info dictionary of each event
+
+    Parameters:
+        event (str):
+            One of request_start, request_end, retry, response_read or parse
+        func (callable):
+            The hook, called as func(event, info).  Exceptions raised by hooks are turned into warnings.
+
+    '''
+    if event not in _hooks:
+        raise SciServerError('Unknown event {0}. Choose one of {1}'.format(event, ', '.join(EVENTS)))
+    _hooks[event].append(func)
+
+
+def remove_hook(event, func):
+    ''' Removes a hook added with add_hook '''
+    if func in _hooks.get(event, []):
+        _hooks[event].remove(func)
+
+
+def active():
+    ''' Whether any hook or registry receives events '''
+    return config.metrics is not None or any(_hooks.values())
+
+
+def emit(event, info):
+    ''' Sends an event to the metrics registry and the hooks '''
+    if config.metrics is not None:
+        config.metrics.record(event, info)
+    for func in list(_hooks[event]):
+        try:
+            func(event, info)
+        except Exception as e:
+            warnings.warn('Metrics hook {0} failed on {1}: {2}'.format(func, event, e), SciServerWarning)
+
+
+def endpoint(url):
+    ''' Returns the path of a url, with ids and tokens replaced by {id} '''
+    path = urlparse(url).path
+    return '/'.join('{id}' if _ID.match(part) else part for part in path.split('/'))
+
+
+@contextmanager
+def task(name):
+    ''' Labels the events inside the block with a task name
+
+    Parameters:
+        name (str):
+            The task name, e.g. Task('sqlSearch', use_base=True, component='SkyServer').name
+
+    '''
+    stack = _task_stack()
+    profile = _profile if not stack else None
+    if profile is not None:
+        _local.call = {'call': name, 'stages': []}
+    stack.append(name)
+    try:
+        yield
+    finally:
+        stack.pop()
+        if profile is not None:
+            profile.add(_local.call)
+            _local.call = None
+
+
+def _task_stack():
+    if not hasattr(_local, 'tasks'):
+        _local.tasks = []
+    return _local.tasks
+
+
+def current_task():
+    ''' Returns the name of the innermost task, or an empty string '''
+    stack = _task_stack()
+    return stack[-1] if stack else ''
+
+
+def _size(data):
+    if data is None:
+        return 0
+    return len(data) if isinstance(data, (bytes, type(u''))) else None
+
+
+def start_request(method, url, data=None):
+    ''' Emits request_start, and returns the info of the request, or None if nothing receives events '''
+    if not active():
+        return None
+    info = {'method': method, 'url': url, 'endpoint': endpoint(url), 'task': current_task(),
+            'bytes_out': _size(data), 'start': time.time()}
+    _local.request = info
+    emit('request_start', info)
+    return info
+
+
+def end_request(info, response=None, stream=False, error=None):
+    ''' Emits request_end for a request started with start_request '''
+    if info is None:
+        return
+    _local.request = None
+    info['elapsed'] = time.time() - info['start']
+    info['error'] = error
+    info['status'] = getattr(response, 'status_code', None)
+    elapsed = getattr(response, 'elapsed', None)
+    info['wait'] = elapsed.total_seconds() if hasattr(elapsed, 'total_seconds') else None
+    info['bytes_in'] = None if response is None or stream else len(response.content)
+    emit('request_end', info)
+
+
+def retry(url, attempt, reason, delay):
+    ''' Emits retry '''
+    if active():
+        emit('retry', {'url': url, 'endpoint': endpoint(url), 'attempt': attempt, 'reason': reason,
+                       'delay': delay, 'request': getattr(_local, 'request', None)})
+
+
+def response_read(response, nbytes):
+    ''' Emits response_read for a streamed response read to the end '''
+    if active():
+        url = getattr(response, 'url', None) or ''
+        emit('response_read', {'url': url, 'endpoint': endpoint(url), 'bytes_in': nbytes})
+
+
+@contextmanager
+def parsing(parser):
+    ''' Times the parsing of a result inside the block, and emits parse
+
+    Parameters:
+        parser (str):
+            The name of the parser, e.g. pandas.read_csv
+
+    '''
+    if not active():
+        yield
+        return
+    start = time.time()
+    yield
+    now = time.time()
+    emit('parse', {'parser': parser, 'task': current_task(), 'start': start, 'elapsed': now - start})
+
+
+_profile = None
+
+
+class MemoryProfile(object):
+    ''' The memory allocated by the stages of profiled service calls
+
+    Attributes:
+        calls (list):
+            The profiled calls, as dictionaries of the call (task) name and its stages.  Each stage
+            has its name, the peak and retained bytes allocated during the stage, its seconds, and
+            with snapshots, the top allocating source lines.
+
+    '''
+
+    def __init__(self, snapshots=False):
+        self.snapshots = snapshots
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return '<MemoryProfile(calls={0})>'.format(len(self.calls))
+
+    def add(self, call):
+        with self._lock:
+            self.calls.append(call)
+
+    def records(self):
+        ''' Returns a list of dictionaries of call, stage, peak, retained and seconds, one per stage '''
+        return [dict(stage, call=call['call']) for call in self.calls for stage in call['stages']]
+
+    def report(self):
+        ''' Returns the per-call memory breakdown as a table, in MB '''
+        lines = ['{0:<44}{1:<28}{2:>10}{3:>12}{4:>9}'.format('call', 'stage', 'peak MB', 'retained MB', 'seconds')]
+        for record in self.records():
+            peak = '{0:.1f}'.format(record['peak'] / 2**20) if record['peak'] is not None else '-'
+            lines.append('{0:<44}{1:<28}{2:>10}{3:>12.1f}{4:>9.3f}'.format(
+                record['call'], record['stage'], peak, record['retained'] / 2**20, record['seconds']))
+        return '\n'.join(lines)
+
+
+@contextmanager
+def profile_memory(snapshots=False):
+    ''' Profiles the memory allocated by the stages of the service calls inside the block
+
+    Uses tracemalloc, which slows allocations down while tracing.  Peaks are measured per
+    stage from Python 3.9; on older versions only the retained memory is.  Allocations by
+    other threads count towards the stages running at the time, so profile calls one at a time.
+
+    Parameters:
+        snapshots (bool):
+            If True, also records the source lines allocating the most memory in each stage
+
+    Returns:
+        the MemoryProfile of the block
+
+    Example:
+        >>> with metrics.profile_memory() as profile:
+        >>>     df = CasJobs().executeQuery('select top 100000 * from PhotoObj')
+        >>> print(profile.report())
+
+    '''
+    global _profile
+    try:
+        import tracemalloc
+    except ImportError:
+        raise SciServerError('Memory profiling needs tracemalloc, from Python 3.4')
+    started = not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start(5 if snapshots else 1)
+    previous, _profile = _profile, MemoryProfile(snapshots)
+    try:
+        yield _profile
+    finally:
+        _profile = previous
+        if started:
+            tracemalloc.stop()
+
+
+@contextmanager
+def stage(name):
+    ''' Measures the memory allocated inside the block, as a stage of the profiled call
+
+    Parameters:
+        name (str):
+            The name of the stage, e.g. json.loads
+
+    '''
+    call = getattr(_local, 'call', None)
+    if _profile is None or call is None:
+        yield
+        return
+    import tracemalloc
+    before = tracemalloc.take_snapshot() if _profile.snapshots else None
+    if hasattr(tracemalloc, 'reset_peak'):
+        tracemalloc.reset_peak()
+    baseline = tracemalloc.get_traced_memory()[0]
+    start = time.time()
+    yield
+    seconds = time.time() - start
+    current, peak = tracemalloc.get_traced_memory()
+    record = {'stage': name, 'peak': peak - baseline if hasattr(tracemalloc, 'reset_peak') else None,
+              'retained': current - baseline, 'seconds': seconds}
+    if before is not None:
+        stats = tracemalloc.take_snapshot().compare_to(before, 'lineno')
+        record['top'] = [str(stat) for stat in stats[:3]]
+    call['stages'].append(record)
+
+
+class MetricsRegistry(object):
+    ''' An in-process registry of request and parsing metrics
+
+    Records the events of the module as histograms of seconds and counters:
+
+    - request_seconds (endpoint, method, task): the time of requests, including retries
+    - response_wait_seconds (endpoint, method): the time until the response headers arrived
+    - parse_seconds (parser, task): the time parsing results
+    - requests_total (endpoint, method, status): the requests made
+    - retries_total (endpoint, reason): the retries
+    - sent_bytes_total, received_bytes_total (endpoint): the request and response body sizes
+
+    Parameters:
+        buckets (list):
+            The upper bounds in seconds of the histogram buckets.  Default is from 5 ms to 5 minutes.
+
+    Example:
+        >>> registry = MetricsRegistry()
+        >>> registry.observe('request_seconds', 0.2, endpoint='/x', method='get', task='')
+        >>> registry.quantile('request_seconds', 0.5, endpoint='/x', method='get', task='')
+
+    '''
+
+    BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1., 2.5, 5., 10., 30., 60., 300.)
+
+    def __init__(self, buckets=None):
+        self.buckets = tuple(sorted(buckets or self.BUCKETS))
+        self.histograms = {}
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return '<MetricsRegistry(histograms={0}, counters={1})>'.format(len(self.histograms), len(self.counters))
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def observe(self, name, value, **labels):
+        ''' Adds a value to a histogram '''
+        key = self._key(name, labels)
+        with self._lock:
+            hist = self.histograms.get(key)
+            if hist is None:
+                hist = self.histograms[key] = {'counts': [0] * (len(self.buckets) + 1), 'sum': 0., 'count': 0}
+            hist['counts'][bisect_left(self.buckets, value)] += 1
+            hist['sum'] += value
+            hist['count'] += 1
+
+    def inc(self, name, value=1, **labels):
+        ''' Adds a value to a counter '''
+        key = self._key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def histogram(self, name, **labels):
+        ''' Returns a histogram as a dictionary of count, sum and cumulative bucket counts, or None '''
+        with self._lock:
+            hist = self.histograms.get(self._key(name, labels))
+            if hist is None:
+                return None
+            cumulative, total = [], 0
+            for count in hist['counts']:
+                total += count
+                cumulative.append(total)
+            return {'count': hist['count'], 'sum': hist['sum'],
+                    'buckets': list(zip(self.buckets + (float('inf'),), cumulative))}
+
+    def quantile(self, name, q, **labels):
+        ''' Estimates a quantile of a histogram, as the upper bound of the bucket holding it '''
+        hist = self.histogram(name, **labels)
+        if not hist or not hist['count']:
+            return None
+        for bound, count in hist['buckets']:
+            if count >= q * hist['count']:
+                return bound
+
+    def counter(self, name, **labels):
+        ''' Returns the value of a counter '''
+        with self._lock:
+            return self.counters.get(self._key(name, labels), 0)
+
+    def clear(self):
+        ''' Removes all metrics '''
+        with self._lock:
+            self.histograms.clear()
+            self.counters.clear()
+
+    def record(self, event, info):
+        ''' Records an event of the module '''
+        if event == 'request_end':
+            labels = {'endpoint': info['endpoint'], 'method': info['method']}
+            self.observe('request_seconds', info['elapsed'], task=info['task'], **labels)
+            if info['wait'] is not None:
+                self.observe('response_wait_seconds', info['wait'], **labels)
+            status = info['status'] or type(info['error']).__name__
+            self.inc('requests_total', status=str(status), **labels)
+            if info['bytes_out']:
+                self.inc('sent_bytes_total', info['bytes_out'], endpoint=info['endpoint'])
+            if info['bytes_in']:
+                self.inc('received_bytes_total', info['bytes_in'], endpoint=info['endpoint'])
+        elif event == 'response_read':
+            self.inc('received_bytes_total', info['bytes_in'], endpoint=info['endpoint'])
+        elif event == 'retry':
+            self.inc('retries_total', endpoint=info['endpoint'], reason=str(info['reason']))
+        elif event == 'parse':
+            self.observe('parse_seconds', info['elapsed'], parser=info['parser'], task=info['task'])
+
+    def to_prometheus(self, prefix='sciserver_'):
+        ''' Returns the metrics in the Prometheus text exposition format '''
+
+        def labelstr(labels, extra=()):
+            items = list(labels) + list(extra)
+            if not items:
+                return ''
+            return '{' + ','.join('{0}="{1}"'.format(key, str(val).replace('\\', '\\\\').replace('"', '\\"'))
+                                  for key, val in items) + '}'
+
+        lines = []
+        with self._lock:
+            histograms = sorted(self.histograms.items())
+            counters = sorted(self.counters.items())
+        typed = set()
+        for (name, labels), hist in histograms:
+            name = prefix + name
+            if name not in typed:
+                typed.add(name)
+                lines.append('# TYPE {0} histogram'.format(name))
+            total = 0
+            for bound, count in zip(self.buckets + (float('inf'),), hist['counts']):
+                total += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append('{0}_bucket{1} {2}'.format(name, labelstr(labels, [('le', le)]), total))
+            lines.append('{0}_sum{1} {2!r}'.format(name, labelstr(labels), hist['sum']))
+            lines.append('{0}_count{1} {2}'.format(name, labelstr(labels), hist['count']))
+        for (name, labels), value in counters:
+            name = prefix + name
+            if name not in typed:
+                typed.add(name)
+                lines.append('# TYPE {0} counter'.format(name))
+            lines.append('{0}{1} {2}'.format(name, labelstr(labels), value))
+        return '\n'.join(lines) + '\n'
+
+
+def enable_metrics(registry=None):
+    ''' Records the events in a metrics registry, set as config.metrics
+
+    Parameters:
+        registry (MetricsRegistry):
+            The registry.  Default is a new MetricsRegistry.
+
+    Returns:
+        the registry
+
+    '''
+    config.metrics = registry or MetricsRegistry()
+    return config.metrics
+
+
+def disable_metrics():
+    ''' Stops recording the events in config.metrics '''
+    config.metrics = None
+
+
+class OpenTelemetryHook(object):
+    ''' A hook exporting requests and parsing as OpenTelemetry spans
+
+    Requests are spans named after their method and endpoint, with retries as span
+    events.  Parsing is a span of its own.  Requires opentelemetry-api.
+
+    Parameters:
+        tracer:
+            The OpenTelemetry tracer.  Default is the tracer named sciserver of the global tracer provider.
+
+    '''
+
+    def __init__(self, tracer=None):
+        try:
+            from opentelemetry import trace
+        except ImportError:
+            raise SciServerError('OpenTelemetry export needs opentelemetry-api. Install it with: '
+                                 'pip install opentelemetry-api opentelemetry-sdk')
+        self.trace = trace
+        self.tracer = tracer or trace.get_tracer('sciserver')
+
+    def __call__(self, event, info):
+        if event == 'request_start':
+            attributes = {'http.method': info['method'].upper(), 'sciserver.endpoint': info['endpoint'],
+                          'sciserver.task': info['task']}
+            if info['bytes_out'] is not None:
+                attributes['http.request_content_length'] = info['bytes_out']
+            info['span'] = self.tracer.start_span('{0} {1}'.format(info['method'].upper(), info['endpoint']),
+                                                  start_time=int(info['start'] * 1e9), attributes=attributes)
+        elif event == 'request_end':
+            span = info.pop('span', None)
+            if span is None:
+                return
+            if info['status'] is not None:
+                span.set_attribute('http.status_code', info['status'])
+            if info['bytes_in'] is not None:
+                span.set_attribute('http.response_content_length', info['bytes_in'])
+            if info['wait'] is not None:
+                span.set_attribute('sciserver.wait_seconds', info['wait'])
+            if info['error'] is not None or (info['status'] or 0) >= 400:
+                if info['error'] is not None:
+                    span.record_exception(info['error'])
+                span.set_status(self.trace.Status(self.trace.StatusCode.ERROR))
+            span.end(end_time=int((info['start'] + info['elapsed']) * 1e9))
+        elif event == 'retry':
+            span = (info['request'] or {}).get('span')
+            if span is not None:
+                span.add_event('retry', {'attempt': info['attempt'], 'reason': str(info['reason']),
+                                         'delay': info['delay']})
+        elif event == 'parse':
+            span = self.tracer.start_span('parse {0}'.format(info['parser']), start_time=int(info['start'] * 1e9),
+                                          attributes={'sciserver.task': info['task']})
+            span.end(end_time=int((info['start'] + info['elapsed']) * 1e9))
+
+
+def enable_opentelemetry(tracer=None):
+    ''' Exports requests and parsing as OpenTelemetry spans
+
+    Parameters:
+        tracer:
+            The OpenTelemetry tracer.  Default is the tracer named sciserver of the global tracer provider.
+
+    Returns:
+        the OpenTelemetryHook, to pass to disable_opentelemetry
+
+    '''
+    hook = OpenTelemetryHook(tracer)
+    for event in EVENTS:
+        add_hook(event, hook)
+    return hook
+
+
+def disable_opentelemetry(hook):
+    ''' Stops exporting spans with a hook returned by enable_opentelemetry '''
+    for event in EVENTS:
+        remove_hook(event, hook)
@@ -0,0 +1,799 @@
+# !usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Licensed under a 3-clause BSD license.
+#
+
+''' A local stand-in for the SciServer services, for offline load and performance testing
+
+The mock server is a threaded HTTP server implementing the endpoints used by the
+CasJobs, SkyServer, SkyQuery, SciDrive, Compute and Authentication clients.  Queries
+return a synthetic table of photometric objects (objid, ra, dec, u, g, r, i, z, type),
+of the server rows or as many as a "top N" in the query asks for.  Jobs go through
+their lifecycle in job_duration seconds, and uploads are kept in memory so they can
+be downloaded again.
+
+Latency, bandwidth and failures can be set for the whole server, and failures injected
+for matching requests with :meth:`MockServer.inject`.
+
+Example:
+    >>> from sciserver.mockserver import MockServer
+    >>> with MockServer(latency=0.02, rows=100000) as server:
+    >>>     df = SkyServer().sqlSearch('select top 10 objid, ra, dec from PhotoObj')
+    >>>     server.inject(r'/Jobs.svc/jobs/', status=503, count=2)
+
+    or from the command line, to run the server in its own process::
+
+    python -m sciserver.mockserver --port 8000 --latency 0.05 --rows 100000
+
+'''
+
+from __future__ import print_function, division, absolute_import
+from collections import Counter
+import argparse
+import csv
+import gzip
+import io
+import itertools
+import json
+import random
+import re
+import socket
+import threading
+import time
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlsplit, parse_qsl, unquote
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlsplit, parse_qsl
+    from urllib import unquote
+from sciserver import config
+
+# the synthetic table returned by queries, as (name, SQL type)
+PHOTO_COLUMNS = [('objid', 'bigint'), ('ra', 'float'), ('dec', 'float'), ('u', 'real'), ('g', 'real'),
+                 ('r', 'real'), ('i', 'real'), ('z', 'real'), ('type', 'smallint')]
+
+# the config attributes pointing at each service, relative to the server url
+SERVICE_PATHS = {'CasJobsRESTUri': '/CasJobs/RestApi',
+                 'AuthenticationURL': '/login-portal/keystone/v3/tokens',
+                 'SciDriveHost': '/scidrive',
+                 'SkyQueryUrl': '/skyquery/Api/V1',
+                 'SkyServerWSurl': '',
+                 'computeURL': '/racm',
+                 'sciserverURL': ''}
+
+# the objid of the first row of the synthetic photometric table
+FIRST_OBJID = 1237645876861272064
+
+_TOP = re.compile(r'\btop\s+(\d+)', re.IGNORECASE)
+# keyset predicates, e.g. q.[objid] > 1237645876861272163
+_AFTER = re.compile(r'\[?(\w+)\]?\s*>\s*(-?\d+)')
+_COUNT = re.compile(r'count_big\(\*\).*count_big\(distinct\s+(?:\w+\.)?\[?(\w+)\]?\)', re.IGNORECASE)
+_INTO = re.compile(r'\binto\s+(?:mydb\.)?\[?(\w+)\]?', re.IGNORECASE)
+_FROM = re.compile(r'\bfrom\s+(?:mydb\.)?\[?(\w+)\]?', re.IGNORECASE)
+_DROP = re.compile(r'^\s*drop\s+table\s+(?:mydb\.)?\[?(\w+)\]?', re.IGNORECASE)
+
+
+def photo_row(i):
+    ''' Returns the i-th row of the synthetic photometric table '''
+    mag = 14 + (i * 7919 % 1000) / 100.
+    return (FIRST_OBJID + i, round(i * 0.00036 % 360, 6), round(i * 0.00017 % 180 - 90, 6),
+            round(mag + 1.5, 3), round(mag + 0.4, 3), mag, round(mag - 0.2, 3), round(mag - 0.3, 3),
+            3 if i % 3 else 6)
+
+
+def photo_rows(start, stop):
+    ''' Returns the rows start to stop of the synthetic photometric table '''
+    return [photo_row(i) for i in range(start, stop)]
+
+
+def _delimited(header, rows, sep=','):
+    ''' Formats a header and rows as delimited text '''
+    lines = [sep.join(header)]
+    lines.extend(sep.join(str(val) for val in row) for row in rows)
+    return '\n'.join(lines) + '\n'
+
+
+def _format(header, rows, fmt='csv'):
+    ''' Formats a table as csv, tsv, json or SkyServer csv '''
+    if fmt == 'json':
+        body = json.dumps({'Result': [{'TableName': 'Table1', 'Columns': header, 'Data': rows}]})
+    else:
+        body = ('#Table1\n' if fmt == 'skyserver' else '') + _delimited(header, rows, '\t' if fmt == 'tsv' else ',')
+    return body.encode('utf8')
+
+
+def _ppm(width, height):
+    ''' Returns a plain gray image, in the binary PPM format '''
+    return 'P6\n{0} {1}\n255\n'.format(width, height).encode() + b'\x40\x40\x60' * (width * height)
+
+
+class MockRequest(object):
+    ''' A request received by the mock server '''
+
+    def __init__(self, method, path, query, headers, body):
+        self.method = method
+        self.path = path
+        self.query = query
+        self.headers = headers
+        self.body = body
+
+    def json(self):
+        return json.loads(self.body.decode('utf8'))
+
+    def table(self):
+        ''' Reads the CSV body into a header and rows '''
+        reader = csv.reader(io.StringIO(self.body.decode('utf8')))
+        header = next(reader, [])
+        return header, [row for row in reader if row]
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        # headers and body are written separately, which Nagle's algorithm would delay
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def _read_body(self):
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().split(b';')[0].strip() or b'0', 16)
+                if not size:
+                    self.rfile.readline()
+                    break
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+            body = b''.join(chunks)
+        else:
+            body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        if self.headers.get('Content-Encoding', '').lower() == 'gzip':
+            body = gzip.GzipFile(fileobj=io.BytesIO(body)).read()
+        return body
+
+    def _dispatch(self):
+        parts = urlsplit(self.path)
+        request = MockRequest(self.command.lower(), unquote(parts.path), dict(parse_qsl(parts.query, True)),
+                              self.headers, self._read_body())
+        response = self.server.mock.handle(request)
+        if response is None:
+            # drop the connection without answering
+            self.close_connection = True
+            return
+        status, body, headers = response
+        mock = self.server.mock
+        self.send_response(status)
+        for key, val in headers.items():
+            self.send_header(key, val)
+        if mock.compress and 'gzip' in self.headers.get('Accept-Encoding', ''):
+            buf = io.BytesIO()
+            with gzip.GzipFile(fileobj=buf, mode='wb') as f:
+                f.write(body)
+            body = buf.getvalue()
+            self.send_header('Content-Encoding', 'gzip')
+        if mock.chunked:
+            self.send_header('Transfer-Encoding', 'chunked')
+            body = b'%x\r\n%s\r\n0\r\n\r\n' % (len(body), body) if body else b'0\r\n\r\n'
+        else:
+            self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        mock.write(self.wfile, body)
+
+    do_GET = do_POST = do_PUT = do_DELETE = _dispatch
+
+    def log_message(self, *args):
+        pass
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
+
+
+class MockServer(object):
+    ''' A local stand-in for the SciServer services
+
+    Parameters:
+        host (str):
+            The host to listen on.  Default is 127.0.0.1.
+        port (int):
+            The port to listen on.  Default is any free port.
+        latency (float):
+            The number of seconds to wait before answering each request.  Default is 0.
+        bandwidth (float):
+            If set, the number of bytes per second responses are sent at.
+        rows (int):
+            The number of rows returned by queries and searches without a "top N".  Default is 1000.
+        max_rows (int):
+            The most rows returned by a SkyServer search, like the real service.  Default is 500000.
+        failure_rate (float):
+            The fraction of requests answered with failure_status.  Default is 0.
+        failure_status (int):
+            The status of failed requests.  Default is 503.
+        job_duration (float):
+            The number of seconds jobs take to finish.  Jobs are running for the second half.  Default is 1.
+        job_failure_rate (float):
+            The fraction of jobs that fail.  Default is 0.
+        token (str):
+            The token given out at login.  Default is "mocktoken".
+        seed (int):
+            The seed of the random failures
+        compress (bool):
+            If True, gzip-compresses the responses to requests accepting gzip.  Default is False.
+        chunked (bool):
+            If True, sends responses with chunked transfer encoding, without a Content-Length.
+            Default is False.
+
+    Attributes:
+        requests (Counter):
+            The number of requests answered, by route name
+        tables (dict):
+            The uploaded tables, and the CasJobs tables created by select ... into, as (header, rows),
+            by (service, dataset, table name)
+        files (dict):
+            The files uploaded to SciDrive, by path
+
+    '''
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0., bandwidth=None, rows=1000, max_rows=500000,
+                 failure_rate=0., failure_status=503, job_duration=1., job_failure_rate=0.,
+                 token='mocktoken', seed=None, compress=False, chunked=False):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.rows = rows
+        self.max_rows = max_rows
+        self.failure_rate = failure_rate
+        self.failure_status = failure_status
+        self.job_duration = job_duration
+        self.job_failure_rate = job_failure_rate
+        self.token = token
+        self.compress = compress
+        self.chunked = chunked
+        self.random = random.Random(seed)
+        self.requests = Counter()
+        self.tables = {}
+        self.files = {}
+        self.jobs = {}
+        self._injected = []
+        self._payloads = {}
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+        self._previous = None
+        self.routes = [(method, re.compile(pattern + '$'), handler) for method, pattern, handler in [
+            ('post', SERVICE_PATHS['AuthenticationURL'], self.login),
+            ('get', SERVICE_PATHS['AuthenticationURL'] + '/(?P<token>[^/]+)', self.keystone_user),
+            ('get', '/CasJobs/RestApi/users/(?P<userid>[^/]+)', self.casjobs_user),
+            ('get', '/CasJobs/RestApi/contexts/(?P<context>[^/]+)/Tables', self.casjobs_tables),
+            ('post', '/CasJobs/RestApi/contexts/(?P<context>[^/]+)/query', self.casjobs_query),
+            ('put', '/CasJobs/RestApi/contexts/(?P<context>[^/]+)/jobs', self.casjobs_submit),
+            ('get', '/CasJobs/RestApi/jobs/?(?P<jobid>\\d*)', self.casjobs_status),
+            ('delete', '/CasJobs/RestApi/jobs/(?P<jobid>\\d+)', self.casjobs_cancel),
+            ('post', '/CasJobs/RestApi/contexts/(?P<context>[^/]+)/Tables/(?P<table>[^/]+)', self.casjobs_upload),
+            ('get', '(/[^/]+)?/SkyServerWS/SearchTools/(?P<search>SqlSearch|RadialSearch|RectangularSearch)',
+             self.skyserver_search),
+            ('get', '(/[^/]+)?/SkyServerWS/SearchTools/ObjectSearch', self.skyserver_object),
+            ('get', '(/[^/]+)?/SkyServerWS/ImgCutout/getjpeg', self.skyserver_cutout),
+            ('get', '/skyquery/Api/V1/Jobs.svc/queues', self.skyquery_queues),
+            ('get', '/skyquery/Api/V1/Jobs.svc/queues/(?P<queue>[^/]+)', self.skyquery_queue),
+            ('get', '/skyquery/Api/V1/Jobs.svc/queues/(?P<queue>[^/]+)/jobs', self.skyquery_jobs),
+            ('post', '/skyquery/Api/V1/Jobs.svc/queues/(?P<queue>[^/]+)/jobs', self.skyquery_submit),
+            ('get', '/skyquery/Api/V1/Jobs.svc/jobs/(?P<guid>[^/]+)', self.skyquery_status),
+            ('delete', '/skyquery/Api/V1/Jobs.svc/jobs/(?P<guid>[^/]+)', self.skyquery_cancel),
+            ('get', '/skyquery/Api/V1/Schema.svc/datasets', self.skyquery_datasets),
+            ('get', '/skyquery/Api/V1/Schema.svc/datasets/(?P<dataset>[^/]+)', self.skyquery_dataset),
+            ('get', '/skyquery/Api/V1/Schema.svc/datasets/(?P<dataset>[^/]+)/tables', self.skyquery_tables),
+            ('get', '/skyquery/Api/V1/Schema.svc/datasets/(?P<dataset>[^/]+)/tables/(?P<table>[^/]+)',
+             self.skyquery_table),
+            ('get', '/skyquery/Api/V1/Schema.svc/datasets/(?P<dataset>[^/]+)/tables/(?P<table>[^/]+)/columns',
+             self.skyquery_columns),
+            ('get', '/skyquery/Api/V1/Data.svc/(?P<dataset>[^/]+)/(?P<table>[^/]+)', self.skyquery_data),
+            ('put', '/skyquery/Api/V1/Data.svc/(?P<dataset>[^/]+)/(?P<table>[^/]+)', self.skyquery_upload),
+            ('delete', '/skyquery/Api/V1/Data.svc/(?P<dataset>[^/]+)/(?P<table>[^/]+)', self.skyquery_drop),
+            ('get', '/scidrive/vospace-2.0/1/media/sandbox/(?P<path>.+)', self.scidrive_public),
+            ('get', '/scidrive/files/(?P<path>.+)', self.scidrive_download),
+            ('put', '/scidrive/vospace-2.0/1/files_put/dropbox/(?P<path>.+)', self.scidrive_upload),
+            ('get', '/scidrive/vospace-2.0/1/metadata/sandbox/(?P<path>.*)', self.scidrive_list),
+            ('put', '/scidrive/vospace-2.0/nodes/(?P<path>.+)', self.scidrive_container),
+            ('delete', '/scidrive/vospace-2.0/nodes/(?P<path>.+)', self.scidrive_delete),
+            ('get', '/racm/jobm/rest/computedomains/rdb', self.compute_domains),
+            ('get', '/racm/jobm/rest/jobs', self.compute_jobs),
+            ('get', '/racm/jobm/rest/jobs/(?P<jobid>\\d+)', self.compute_job),
+            ('post', '/racm/jobm/rest/jobs/rdb', self.compute_submit),
+            ('get', '/fileservice/api/data/results/(?P<jobid>\\d+)/(?P<path>.+)', self.compute_results),
+        ]]
+
+    def __repr__(self):
+        return '<MockServer(url={0}, latency={1}, rows={2})>'.format(self.url, self.latency, self.rows)
+
+    def __enter__(self):
+        self.start()
+        self.configure()
+        return self
+
+    def __exit__(self, *args):
+        self.restore()
+        self.stop()
+
+    @property
+    def url(self):
+        return 'http://{0}:{1}'.format(self.host, self.port) if self._server else None
+
+    def start(self):
+        ''' Starts serving in a background thread '''
+        self._server = _Server((self.host, self.port), _Handler)
+        self._server.mock = self
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever, kwargs={'poll_interval': 0.1})
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        ''' Stops serving '''
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._thread.join()
+            self._server = None
+
+    def service_urls(self):
+        ''' Returns the urls of the services, by config attribute '''
+        return {name: self.url + path for name, path in SERVICE_PATHS.items()}
+
+    def configure(self):
+        ''' Points sciserver.config at the mock services, and logs in with the mock token '''
+        urls = self.service_urls()
+        self._previous = {name: getattr(config, name) for name in list(urls) + ['token']}
+        for name, url in urls.items():
+            setattr(config, name, url)
+        config.token = self.token
+
+    def restore(self):
+        ''' Restores the sciserver.config in place before configure '''
+        if self._previous:
+            for name, val in self._previous.items():
+                setattr(config, name, val)
+            self._previous = None
+
+    def inject(self, pattern, status=503, count=1, method=None, delay=0.):
+        ''' Injects failures into the next requests matching a pattern
+
+        Parameters:
+            pattern (str):
+                A regular expression searched for in the request path
+            status (int):
+                The status to answer with, or 0 to drop the connection.  Default is 503.
+            count (int):
+                The number of requests to fail, or None to fail all.  Default is 1.
+            method (str):
+                The request method to fail, or None for any method
+            delay (float):
+                The number of seconds to wait before failing
+
+        '''
+        with self._lock:
+            self._injected.append([re.compile(pattern), status, count, method, delay])
+
+    def clear(self):
+        ''' Removes the injected failures, jobs, uploads and request counts '''
+        with self._lock:
+            del self._injected[:]
+            self.requests.clear()
+            self.tables.clear()
+            self.files.clear()
+            self.jobs.clear()
+
+    def _failure(self, request):
+        with self._lock:
+            for injected in self._injected:
+                pattern, status, count, method, delay = injected
+                if method in (None, request.method) and pattern.search(request.path):
+                    if count is not None:
+                        injected[2] -= 1
+                        if injected[2] <= 0:
+                            self._injected.remove(injected)
+                    return status, delay
+            if self.failure_rate and self.random.random() < self.failure_rate:
+                return self.failure_status, 0.
+        return None
+
+    def handle(self, request):
+        ''' Answers a request with a (status, body, headers) tuple, or None to drop the connection '''
+        if self.latency:
+            time.sleep(self.latency)
+        failure = self._failure(request)
+        if failure:
+            status, delay = failure
+            time.sleep(delay)
+            with self._lock:
+                self.requests['failure'] += 1
+            if not status:
+                return None
+            return status, 'Injected failure'.encode(), {'Retry-After': '0', 'Content-Type': 'text/plain'}
+
+        allowed = False
+        for method, pattern, handler in self.routes:
+            match = pattern.match(request.path)
+            if match:
+                allowed = True
+                if method == request.method:
+                    break
+        else:
+            status = 405 if allowed else 404
+            return status, 'No route for {0} {1}'.format(request.method.upper(), request.path).encode(), {}
+
+        with self._lock:
+            self.requests[handler.__name__] += 1
+        try:
+            response = handler(request, **match.groupdict())
+        except KeyError as e:
+            return 404, 'Not found: {0}'.format(e).encode(), {}
+        status, body, headers = (tuple(response) + ({},))[:3] if isinstance(response, tuple) else (200, response, {})
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body)
+            headers.setdefault('Content-Type', 'application/json')
+        if not isinstance(body, bytes):
+            body = body.encode('utf8')
+        return status, body, headers
+
+    def write(self, wfile, body):
+        ''' Writes a response body, at the server bandwidth '''
+        if not self.bandwidth:
+            wfile.write(body)
+            return
+        chunk = max(int(self.bandwidth / 100), 1)
+        for start in range(0, len(body), chunk):
+            wfile.write(body[start:start + chunk])
+            time.sleep(chunk / self.bandwidth)
+
+    def _nrows(self, sql=None, limit=None):
+        ''' The number of rows of the result of a query '''
+        top = _TOP.search(sql or '')
+        if top:
+            return int(top.group(1))
+        return int(limit) if limit and int(limit) > 0 else self.rows
+
+    def _photo_range(self, sql):
+        ''' The rows start to stop of the synthetic table selected by a query.  With a keyset
+        predicate "objid > X", the rows after X of a table of rows rows, up to the first top N. '''
+        nrows = self._nrows(sql)
+        after = _AFTER.search(sql or '')
+        if after and after.group(1).lower() == 'objid':
+            start = max(int(after.group(2)) - FIRST_OBJID + 1, 0)
+            return start, max(min(start + nrows, self.rows), start)
+        return 0, nrows
+
+    def photo_table(self, start, stop, fmt='csv'):
+        ''' Returns the rows start to stop of the synthetic table, formatted as csv, tsv, json or
+        SkyServer csv.  The last few tables are cached, so large results are only built once. '''
+        key = (start, stop, fmt)
+        with self._lock:
+            body = self._payloads.get(key)
+        if body is not None:
+            return body
+
+        body = _format([name for name, sqltype in PHOTO_COLUMNS], photo_rows(start, stop), fmt)
+        with self._lock:
+            if len(self._payloads) >= 8:
+                self._payloads.pop(next(iter(self._payloads)))
+            self._payloads[key] = body
+        return body
+
+    def _new_job(self, service, **info):
+        ''' Creates a job, which fails with probability job_failure_rate '''
+        with self._lock:
+            job = dict(info, service=service, id=next(self._ids), submitted=time.time(), canceled=False,
+                       failed=self.random.random() < self.job_failure_rate)
+            self.jobs[(service, str(job['id']))] = job
+        return job
+
+    def _job_state(self, job):
+        ''' The state of a job: queued, running, finished, failed or canceled '''
+        if job['canceled']:
+            return 'canceled'
+        elapsed = time.time() - job['submitted']
+        if elapsed >= self.job_duration:
+            return 'failed' if job['failed'] else 'finished'
+        return 'running' if elapsed >= self.job_duration / 2 else 'queued'
+
+    # Authentication
+
+    def login(self, request):
+        request.json()['auth']['identity']['password']['user']
+        return 201, {'token': {'expires_at': None}}, {'X-Subject-Token': self.token}
+
+    def keystone_user(self, request, token):
+        if token != self.token:
+            return 404, 'Unknown token'
+        return {'token': {'user': {'id': 'mock-user-id', 'name': 'mockuser'}}}
+
+    # CasJobs
+
+    def casjobs_user(self, request, userid):
+        return {'UserId': userid, 'WebServicesId': 123456789}
+
+    def casjobs_tables(self, request, context):
+        tables = [{'Name': name, 'Rows': len(rows), 'Size': 0, 'Date': 0}
+                  for (service, dataset, name), (header, rows) in sorted(self.tables.items())
+                  if service == 'casjobs' and dataset == context]
+        return tables
+
+    def casjobs_query(self, request, context):
+        sql = request.json()['Query']
+        accept = request.headers.get('Accept', '')
+        fmt = 'json' if accept.startswith('application/json') else 'csv' if accept.startswith('text/plain') else None
+        if fmt is None:
+            return 406, 'The mock server does not serve {0}'.format(accept)
+        headers = {'Content-Type': 'application/json' if fmt == 'json' else 'text/plain'}
+
+        drop = _DROP.match(sql)
+        if drop:
+            self.tables.pop(('casjobs', context, drop.group(1)), None)
+            return 200, _format([], [], fmt), headers
+        source = _FROM.search(sql)
+        table = self.tables.get(('casjobs', context, source.group(1))) if source else None
+        if table is None:
+            return 200, self.photo_table(0, self._nrows(sql), fmt), headers
+
+        # queries of MyDB tables select the rows after a keyset predicate, up to the first top N
+        header, rows = table
+        after = _AFTER.search(sql)
+        if after and after.group(1) in header:
+            index = header.index(after.group(1))
+            rows = [row for row in rows if float(row[index]) > int(after.group(2))]
+        top = _TOP.search(sql)
+        return 200, _format(header, rows[:int(top.group(1))] if top else rows, fmt), headers
+
+    def casjobs_submit(self, request, context):
+        sql = request.json()['Query']
+        job = self._new_job('casjobs', query=sql, context=context)
+        # select ... into MyDB.table creates a table of the selected rows, numbered by row_id
+        into = _INTO.search(sql)
+        if into:
+            rows = photo_rows(*self._photo_range(sql))
+            self.tables[('casjobs', 'MyDB', into.group(1))] = (
+                ['row_id'] + [name for name, sqltype in PHOTO_COLUMNS],
+                [[i + 1] + list(row) for i, row in enumerate(rows)])
+        return 200, str(job['id']), {'Content-Type': 'text/plain'}
+
+    def _casjobs_status(self, job):
+        codes = {'queued': 0, 'running': 1, 'canceled': 3, 'failed': 4, 'finished': 5}
+        state = self._job_state(job)
+        return {'JobID': job['id'], 'Status': codes[state], 'Query': job['query'], 'Target': job['context'],
+                'Message': 'Injected job failure' if state == 'failed' else ''}
+
+    def casjobs_status(self, request, jobid):
+        if not jobid:
+            return [self._casjobs_status(job) for (service, key), job in sorted(self.jobs.items())
+                    if service == 'casjobs']
+        return self._casjobs_status(self.jobs[('casjobs', jobid)])
+
+    def casjobs_cancel(self, request, jobid):
+        self.jobs[('casjobs', jobid)]['canceled'] = True
+        return ''
+
+    def casjobs_upload(self, request, context, table):
+        self.tables[('casjobs', context, table)] = request.table()
+        return ''
+
+    # SkyServer
+
+    def skyserver_search(self, request, search):
+        query = request.query
+        count = _COUNT.search(query.get('cmd') or '')
+        if search == 'SqlSearch' and count:
+            # the number of rows, and of distinct values of a column, of the synthetic table
+            index = [name for name, sqltype in PHOTO_COLUMNS].index(count.group(1).lower())
+            rows = photo_rows(*self._photo_range(query.get('cmd')))
+            return 200, _format(['n', 'd'], [[len(rows), len(set(row[index] for row in rows))]], 'skyserver'), \
+                {'Content-Type': 'text/plain'}
+        if search == 'SqlSearch':
+            start, stop = self._photo_range(query.get('cmd'))
+        else:
+            start, stop = 0, self._nrows(limit=query.get('limit'))
+        return 200, self.photo_table(start, min(stop, start + self.max_rows), 'skyserver'), {'Content-Type': 'text/plain'}
+
+    def skyserver_object(self, request):
+        objid = request.query.get('objId') or request.query.get('specObjId') or str(FIRST_OBJID)
+        row = photo_row(int(objid) - FIRST_OBJID if objid.isdigit() else 0)
+        return [{'TableName': 'MetaData',
+                 'Rows': [dict(zip([name for name, sqltype in PHOTO_COLUMNS], row), objId=objid)]}]
+
+    def skyserver_cutout(self, request):
+        width = int(request.query.get('width', 512))
+        height = int(request.query.get('height', 512))
+        return 200, _ppm(width, height), {'Content-Type': 'image/x-portable-pixmap'}
+
+    # SkyQuery
+
+    def skyquery_queues(self, request):
+        return {'queues': [{'name': 'quick', 'timeout': 600}, {'name': 'long', 'timeout': 7200}]}
+
+    def skyquery_queue(self, request, queue):
+        return {'queue': {'name': queue, 'timeout': 600 if queue == 'quick' else 7200}}
+
+    def _skyquery_job(self, job):
+        state = self._job_state(job)
+        status = {'queued': 'queued', 'running': 'executing'}.get(state, state)
+        return {'guid': job['guid'], 'queue': job['queue'], 'query': job['query'],
+                'status': 'completed' if status == 'finished' else status}
+
+    def skyquery_jobs(self, request, queue):
+        return {'jobs': [self._skyquery_job(job) for (service, key), job in sorted(self.jobs.items())
+                         if service == 'skyquery' and job['queue'] == queue]}
+
+    def skyquery_submit(self, request, queue):
+        job = self._new_job('skyquery', query=request.json()['queryJob']['query'], queue=queue)
+        job['guid'] = str(job['id'])
+        return {'queryJob': self._skyquery_job(job)}
+
+    def skyquery_status(self, request, guid):
+        return {'queryJob': self._skyquery_job(self.jobs[('skyquery', guid)])}
+
+    def skyquery_cancel(self, request, guid):
+        job = self.jobs[('skyquery', guid)]
+        job['canceled'] = True
+        return {'queryJob': self._skyquery_job(job)}
+
+    def skyquery_datasets(self, request):
+        return {'datasets': [{'name': 'MyDB'}, {'name': 'SDSSDR7'}]}
+
+    def skyquery_dataset(self, request, dataset):
+        return {'name': dataset, 'description': 'mock dataset'}
+
+    def skyquery_tables(self, request, dataset):
+        names = set(['PhotoObj'] + [name for service, dset, name in self.tables if service == 'skyquery' and
+                                    dset == dataset])
+        return {'tables': [{'name': name} for name in sorted(names)]}
+
+    def skyquery_table(self, request, dataset, table):
+        return {'table': {'name': table, 'dataset': dataset}}
+
+    def _skyquery_header(self, dataset, table):
+        stored = self.tables.get(('skyquery', dataset, table))
+        return stored[0] if stored else None
+
+    def skyquery_columns(self, request, dataset, table):
+        header = self._skyquery_header(dataset, table)
+        if header:
+            return {'columns': [{'name': name, 'dataType': 'varchar', 'isNullable': True} for name in header]}
+        return {'columns': [{'name': name, 'dataType': sqltype, 'isNullable': False}
+                            for name, sqltype in PHOTO_COLUMNS]}
+
+    def skyquery_data(self, request, dataset, table):
+        skip = int(request.query.get('skip') or 0)
+        top = request.query.get('top')
+        stored = self.tables.get(('skyquery', dataset, table))
+        if stored:
+            header, rows = stored
+            body = _delimited(header, rows[skip:skip + int(top) if top else None], sep='\t')
+        else:
+            body = self.photo_table(skip, skip + int(top) if top else max(skip, self.rows), 'tsv')
+        return 200, body, {'Content-Type': 'text/tab-separated-values'}
+
+    def skyquery_upload(self, request, dataset, table):
+        header, rows = request.table()
+        with self._lock:
+            stored = self.tables.get(('skyquery', dataset, table))
+            # batches of an upload append to the table they created
+            if stored and stored[0] == header:
+                stored[1].extend(rows)
+            else:
+                self.tables[('skyquery', dataset, table)] = (header, rows)
+        return {'table': {'name': table}}
+
+    def skyquery_drop(self, request, dataset, table):
+        del self.tables[('skyquery', dataset, table)]
+        return {}
+
+    # SciDrive
+
+    def scidrive_public(self, request, path):
+        self.files[path]
+        return {'url': '{0}/scidrive/files/{1}'.format(self.url, path), 'expires': None}
+
+    def scidrive_download(self, request, path):
+        return 200, self.files[path], {'Content-Type': 'application/octet-stream'}
+
+    def scidrive_upload(self, request, path):
+        self.files[path] = request.body
+        return {'path': '/' + path, 'bytes': len(request.body), 'is_dir': False}
+
+    def scidrive_list(self, request, path):
+        prefix = path.rstrip('/') + '/' if path else ''
+        contents = [{'path': '/' + name, 'bytes': len(data), 'is_dir': False}
+                    for name, data in sorted(self.files.items()) if name.startswith(prefix)]
+        return {'path': '/' + path, 'is_dir': True, 'contents': contents}
+
+    def scidrive_container(self, request, path):
+        return 200, request.body, {'Content-Type': 'application/xml'}
+
+    def scidrive_delete(self, request, path):
+        prefix = path.rstrip('/') + '/'
+        with self._lock:
+            for name in [name for name in self.files if name == path or name.startswith(prefix)]:
+                del self.files[name]
+        return ''
+
+    # Compute
+
+    def compute_domains(self, request):
+        return [{'id': 1, 'name': 'Small Jobs Domain (short)'}, {'id': 2, 'name': 'Large Jobs Domain (long)'}]
+
+    def _compute_job(self, job):
+        codes = {'queued': 2, 'running': 8, 'finished': 32, 'failed': 64, 'canceled': 128}
+        state = self._job_state(job)
+        submitted = int(job['submitted'] * 1000)
+        info = dict(job['input'], id=job['id'], status=codes[state], submissionTime=submitted,
+                    startTime=submitted + int(self.job_duration * 500), resultsFolderURI='/results/{0}/'.format(job['id']),
+                    workspacePath='/home/idies/workspace', type='jobm.model.RDBJob',
+                    messages=[{'content': 'Injected job failure'}] if state == 'failed' else [])
+        if state == 'finished':
+            info['endTime'] = submitted + int(self.job_duration * 1000)
+        return info
+
+    def compute_jobs(self, request):
+        start = int(request.query.get('start', 0))
+        top = int(request.query.get('top', 100))
+        onlyopen = request.query.get('open') == 'true'
+        jobs = [self._compute_job(job) for (service, key), job in sorted(self.jobs.items(), reverse=True)
+                if service == 'compute']
+        if onlyopen:
+            jobs = [job for job in jobs if job['status'] < 16]
+        return jobs[start:start + top]
+
+    def compute_job(self, request, jobid):
+        return self._compute_job(self.jobs[('compute', jobid)])
+
+    def compute_submit(self, request):
+        job = self._new_job('compute', input=request.json())
+        return {'id': job['id']}
+
+    def compute_results(self, request, jobid, path):
+        job = self.jobs[('compute', jobid)]
+        if not path.lower().endswith('.csv'):
+            return 406, 'The mock server only serves CSV results'
+        return 200, self.photo_table(0, self._nrows(job['input'].get('inputSql'))), {'Content-Type': 'text/csv'}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Runs a local stand-in for the SciServer services')
+    parser.add_argument('--host', default='127.0.0.1', help='the host to listen on')
+    parser.add_argument('--port', type=int, default=8000, help='the port to listen on')
+    parser.add_argument('--latency', type=float, default=0., help='the seconds to wait before each response')
+    parser.add_argument('--bandwidth', type=float, default=None, help='the bytes per second of responses')
+    parser.add_argument('--rows', type=int, default=1000, help='the rows of queries without a "top N"')
+    parser.add_argument('--failure-rate', type=float, default=0., help='the fraction of requests that fail')
+    parser.add_argument('--failure-status', type=int, default=503, help='the status of failed requests')
+    parser.add_argument('--job-duration', type=float, default=1., help='the seconds jobs take to finish')
+    parser.add_argument('--job-failure-rate', type=float, default=0., help='the fraction of jobs that fail')
+    parser.add_argument('--seed', type=int, default=None, help='the seed of the random failures')
+    args = parser.parse_args()
+
+    server = MockServer(host=args.host, port=args.port, latency=args.latency, bandwidth=args.bandwidth,
+                        rows=args.rows, failure_rate=args.failure_rate, failure_status=args.failure_status,
+                        job_duration=args.job_duration, job_failure_rate=args.job_failure_rate, seed=args.seed)
+    server.start()
+    print('Serving the SciServer mock services.  Point sciserver at them with:')
+    for name, url in sorted(server.service_urls().items()):
+        print('    config.{0} = "{1}"'.format(name, url))
+    print('    config.token = "{0}"'.format(server.token))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
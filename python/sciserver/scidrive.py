@@ -135,11 +135,11 @@ class SciDrive(object):
             with open(localFilePath, 'rb') as file:
                 data = file
                 errmsg = 'Error when uploading local file {0} to SciDrive path {1}'.format(localFilePath, path)
-                response = send_request(url, reqtype='put', data=data, stream=True, errmsg=errmsg)
+                response = send_request(url, reqtype='put', data=data, stream=True, errmsg=errmsg, compress=True)
         else:
             data = data
             errmsg = 'Error when uploading data to SciDrive path {0}'.format(path)
-            response = send_request(url, reqtype='put', data=data, stream=True, errmsg=errmsg)
+            response = send_request(url, reqtype='put', data=data, stream=True, errmsg=errmsg, compress=True)
 
         if response.ok:
             return json.loads(response.content.decode())
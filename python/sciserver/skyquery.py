@@ -9,12 +9,79 @@
 # @Last Modified time: 2017-08-30 10:53:50
 
 from __future__ import print_function, division, absolute_import
-from io import StringIO
+from io import BytesIO
+from collections import deque
+import heapq
 import json
+import os
 import time
+import threading
+import warnings
 import pandas
-from sciserver import config
-from sciserver.utils import checkAuth, send_request
+from sciserver import config, metrics
+from sciserver.exceptions import SciServerError, SciServerTimeoutError, SciServerUploadError, SciServerWarning
+from sciserver.spill import over_budget, spill_csv, spill_frames, SpilledTable
+from sciserver.sqlcache import cache_key, invalidate, is_cacheable
+from sciserver.transport import bind_deadline, effective_timeout, RetryPolicy
+from sciserver.utils import checkAuth, send_request, ResponseStream, Task
+
+# Numpy dtypes of the SQL column data types
+SQL_DTYPES = {'bigint': 'int64', 'int': 'int32', 'smallint': 'int16', 'tinyint': 'uint8',
+              'real': 'float32', 'float': 'float64', 'double': 'float64', 'decimal': 'float64',
+              'numeric': 'float64', 'money': 'float64', 'bit': 'bool', 'char': 'object',
+              'varchar': 'object', 'nchar': 'object', 'nvarchar': 'object', 'text': 'object',
+              'ntext': 'object'}
+
+# job statuses after which a SkyQuery job no longer changes
+TERMINAL_STATUSES = ('completed', 'failed', 'canceled', 'cancelled', 'timedout')
+
+# (initial, maximum) seconds between job status checks, per queue
+POLL_INTERVALS = {'quick': (0.5, 5.), 'long': (2., 30.)}
+
+
+def _poll_interval(queue, elapsed, poll=None, max_poll=None):
+    ''' Returns the time to wait before the next status check of a job
+
+    The interval starts small and grows with the time the job has been running,
+    so short jobs are picked up quickly while long jobs are not polled needlessly.
+
+    '''
+    start, cap = POLL_INTERVALS.get(queue, POLL_INTERVALS['long'])
+    start = poll if poll is not None else start
+    cap = max_poll if max_poll is not None else cap
+    return min(cap, max(start, elapsed / 10.))
+
+
+def _column_dtype(column):
+    ''' Returns the dtype of a column description, or None if the type is unknown '''
+    sqltype = column.get('dataType', column.get('type'))
+    if isinstance(sqltype, dict):
+        sqltype = sqltype.get('name')
+    if not sqltype:
+        return None
+    dtype = SQL_DTYPES.get(sqltype.lower().split('(')[0].strip())
+    nullable = column.get('isNullable', column.get('nullable'))
+    if dtype and (nullable or nullable is None) and dtype.startswith(('int', 'uint', 'bool')):
+        # missing values cannot be stored in numpy integer columns
+        dtype = 'float64' if dtype != 'bool' else 'object'
+    return dtype
+
+
+def _read_arrow_tsv(stream, columns=None, dtype=None, chunksize=None):
+    ''' Reads a tab-separated stream into an Arrow table, or an iterator of record batches '''
+    try:
+        import pyarrow
+        from pyarrow import csv
+    except ImportError:
+        raise SciServerError('pyarrow is required for the arrow output format.')
+
+    types = {name: pyarrow.from_numpy_dtype(val) for name, val in (dtype or {}).items() if val != 'object'}
+    # arrow reads in blocks of bytes, so size the blocks for ~64 bytes per row
+    readopts = csv.ReadOptions(block_size=chunksize * 64) if chunksize else csv.ReadOptions()
+    reader = csv.open_csv(stream, read_options=readopts,
+                          parse_options=csv.ParseOptions(delimiter='\t'),
+                          convert_options=csv.ConvertOptions(include_columns=columns, column_types=types))
+    return reader if chunksize else reader.read_all()
 
 
 class SkyQuery(object):
@@ -160,7 +227,7 @@ class SkyQuery(object):
             return r['queue']
 
     @checkAuth
-    def submitJob(self, query, queue='quick'):
+    def submitJob(self, query, queue='quick', cache=True):
         """ Submit a job
 
         Submits a new job (more info in http://www.voservices.net/skyquery).
@@ -170,6 +237,10 @@ class SkyQuery(object):
                 the sql query string
             queue (str):
                 the name of the queue.  Can be 'quick' (quick job) or 'long' (long job). Default is quick.
+            cache (bool):
+                if True, and config.queryCache is enabled, returns the jobId of an identical query
+                (after normalization) submitted earlier by the same user to the same queue, unless that
+                job failed or was canceled.  Queries writing into tables or reading MyDB are never cached.
 
         Returns:
             returns the jobId, unique identifier of the job.
@@ -185,6 +256,20 @@ class SkyQuery(object):
 
         """
 
+        qcache = config.queryCache
+        key = None
+        if cache and qcache is not None and is_cacheable(query):
+            key = cache_key(query, 'skyquery', self.SkyQueryUrl, queue)
+            guid = qcache.get(key)
+            if guid is not None:
+                try:
+                    status = self.getJobStatus(guid)['status'].lower()
+                except SciServerError:
+                    status = 'failed'
+                if status == 'completed' or status not in TERMINAL_STATUSES:
+                    return guid
+                qcache.pop(key)
+
         jobsURL = '{0}/Jobs.svc/queues/{1}/jobs'.format(self.SkyQueryUrl, queue)
 
         body = {"queryJob": {"query": query}}
@@ -194,55 +279,108 @@ class SkyQuery(object):
                                 acceptHeader='application/json', errmsg='Error when submitting job on queue {0}'.format(queue))
         if response.ok:
             r = response.json()
-            return r['queryJob']['guid']
+            guid = r['queryJob']['guid']
+            if key is not None:
+                qcache.set(key, guid, sql=query)
+            return guid
 
-    def waitForJob(self, jobId, verbose=True):
+    def waitForJob(self, jobId, verbose=True, timeout=None, cancel_on_timeout=False, poll=None, max_poll=None):
         """ Wait for a running job to finish
 
-        Queries the job status from SkyQuery every 2 seconds and waits
-        for the SkyQuery job to be completed.
+        Queries the job status from SkyQuery and waits for the SkyQuery job to reach
+        a terminal status (completed, failed, canceled or timed out).  The time between
+        status checks starts short and grows with the time spent waiting, more slowly
+        for the quick queue than for the long queue.
 
         Parameters:
             jobId (str):
                 the ID of the job, which is obtained at the moment of submitting the job.
             verbose (bool):
                 if True, prints 'wait' messages while the job is running.
+            timeout (float):
+                the maximum number of seconds to wait.  Default is to wait forever, or until the
+                current sciserver.deadline.
+            cancel_on_timeout (bool):
+                if True, cancels the job when the timeout is reached.
+            poll (float):
+                the initial number of seconds between status checks.  Default depends on the queue.
+            max_poll (float):
+                the maximum number of seconds between status checks.  Default depends on the queue.
 
         Returns:
             dict: a dictionary with the job status and other related metadata.
 
         Raises:
             SciServerAPIError: Throws an exception if the HTTP request to the SkyQuery API returns an error.
+            SciServerTimeoutError: if the job is not finished before the timeout
 
         Example:
             >>> skyquery.waitForJob(skyquery.submitJob("select 1"))
+            >>> skyquery.waitForJob(jobId, timeout=600, cancel_on_timeout=True)
 
         See Also:
-            SkyQuery.submitJob, SkyQuery.getJobStatus.
+            SkyQuery.submitJob, SkyQuery.getJobStatus, SkyQuery.waitForJobs
 
         """
-        try:
-            complete = False
 
-            waitingStr = "Waiting..."
-            back = "\b" * len(waitingStr)
+        waitingStr = "Waiting..."
+        if verbose:
+            print(waitingStr, end="")
+
+        timeout = effective_timeout(timeout)
+        start = time.time()
+        while True:
+            jobDesc = self.getJobStatus(jobId)
+            if jobDesc['status'].lower() in TERMINAL_STATUSES:
+                if verbose:
+                    print("Done!")
+                return jobDesc
+
+            elapsed = time.time() - start
+            if timeout is not None and elapsed >= timeout:
+                if cancel_on_timeout:
+                    self.cancelJob(jobId)
+                raise SciServerTimeoutError('Timed out after {0} seconds waiting for job {1}'.format(timeout, jobId))
+
             if verbose:
                 print(waitingStr, end="")
+            interval = _poll_interval(jobDesc.get('queue'), elapsed, poll=poll, max_poll=max_poll)
+            if timeout is not None:
+                interval = min(interval, max(timeout - elapsed, 0))
+            time.sleep(interval)
 
-            while not complete:
-                if verbose:
-                    print(waitingStr, end="")
-                jobDesc = self.getJobStatus(jobId)
-                if jobDesc['status'] == 'completed':
-                    complete = True
-                    if verbose:
-                        print("Done!")
-                else:
-                    time.sleep(2)
+    def waitForJobs(self, jobIds, timeout=None, cancel_on_timeout=False):
+        """ Wait for many jobs to finish
+
+        Waits on all jobs with a single background poller thread.
+
+        Parameters:
+            jobIds (list):
+                the IDs of the jobs
+            timeout (float):
+                the maximum number of seconds to wait.  Default is to wait forever, or until the
+                current sciserver.deadline.
+            cancel_on_timeout (bool):
+                if True, cancels the unfinished jobs when the timeout is reached.
 
-            return jobDesc
-        except Exception as e:
-            raise e
+        Returns:
+            list: the final job descriptions, in the order of jobIds
+
+        Raises:
+            SciServerTimeoutError: if any job is not finished before the timeout
+
+        See Also:
+            SkyQuery.waitForJob, JobWaiter
+
+        """
+
+        waiter = JobWaiter(skyquery=self)
+        try:
+            for jobId in jobIds:
+                waiter.add(jobId)
+            return waiter.wait(jobIds, timeout=timeout, cancel_on_timeout=cancel_on_timeout)
+        finally:
+            waiter.stop()
 
     @checkAuth
     def listJobs(self, queue="quick"):
@@ -452,12 +590,45 @@ class SkyQuery(object):
             r = response.json()
             return r['columns']
 
+    def getColumnTypes(self, tableName, datasetName="MyDB"):
+        """ Returns the column data types of a table
+
+        Maps the SQL data types of the table columns, as given by listTableColumns,
+        onto Pandas/Numpy dtypes.  Integer columns that can hold nulls are read as floats.
+        Columns with unknown types are left out.
+
+        Parameters:
+            tableName (str):
+                the name of the table in a dataset
+            datasetName (str):
+                the name of the dataset
+
+        Returns:
+            dict: a dictionary of column name to dtype
+
+        Example:
+            >>> dtypes = SkyQuery.getColumnTypes("myTable", datasetName="MyDB")
+
+        See Also:
+            SkyQuery.listTableColumns, SkyQuery.getTable
+
+        """
+
+        dtypes = {}
+        for column in self.listTableColumns(tableName, datasetName=datasetName):
+            dtype = _column_dtype(column)
+            if dtype:
+                dtypes[column['name']] = dtype
+        return dtypes
+
     @checkAuth
-    def getTable(self, tableName, datasetName="MyDB", top=None):
+    def getTable(self, tableName, datasetName="MyDB", top=None, skip=None, columns=None, dtype=None,
+                 chunksize=None, outformat="pandas"):
         """ Return a table
 
         Returns a dataset table as a pandas DataFrame
-        (more info in http://www.voservices.net/skyquery).
+        (more info in http://www.voservices.net/skyquery).  The table is streamed
+        from the server and parsed as it arrives.
 
         Parameters:
             tableName (str):
@@ -466,33 +637,128 @@ class SkyQuery(object):
                 the name of the dataset
             top (int):
                 the top number of rows in the table
+            skip (int):
+                the number of rows to skip before the first returned row
+            columns (list):
+                the subset of columns to read.  Default is all columns.
+            dtype (dict|bool):
+                a dictionary of column name to dtype.  If True, the dtypes are looked up
+                with SkyQuery.getColumnTypes.
+            chunksize (int):
+                if set, returns an iterator of DataFrames (or Arrow record batches) of
+                about chunksize rows each instead of a single table
+            outformat (str):
+                the output format.  Either 'pandas' (default) or 'arrow' (requires pyarrow)
 
         Returns:
-            the table as a Pandas dataframe
+            the table as a Pandas dataframe, or a sciserver.spill.SpilledTable if it is larger than
+            config.memoryBudget
 
         Raises:
             SciServerAPIError: Throws an exception if the HTTP request to the SkyQuery API returns an error.
 
         Example:
             >>> table = SkyQuery.getTable("myTable", datasetName="MyDB", top=10)
+            >>> for chunk in SkyQuery.getTable("myTable", columns=['ra', 'dec'], dtype=True, chunksize=100000):
+            >>>     process(chunk)
 
         See Also:
             SkyQuery.listQueues, SkyQuery.listAllDatasets, SkyQuery.getDatasetInfo,
             SkyQuery.listDatasetTables, SkyQuery.getTableInfo, SkyQuery.listTableColumns,
-            SkyQuery.dropTable
+            SkyQuery.dropTable, SkyQuery.iterTable
 
         """
 
+        assert outformat in ('pandas', 'arrow'), 'outformat must be either pandas or arrow'
+
+        if dtype is True:
+            dtype = self.getColumnTypes(tableName, datasetName=datasetName)
+        if dtype and columns:
+            dtype = {name: val for name, val in dtype.items() if name in columns}
+
         url = '{0}/Data.svc/{1}/{2}'.format(self.SkyQueryUrl, datasetName, tableName)
-        if top is not None and top != "":
-            url = url + '?top=' + str(top)
+        params = [(key, val) for key, val in (('top', top), ('skip', skip)) if val is not None and val != ""]
+        if params:
+            url = url + '?' + '&'.join('{0}={1}'.format(key, val) for key, val in params)
+
+        with metrics.task(Task('getTable', use_base=True, component='SkyQuery').name):
+            response = send_request(url, content_type='application/json',
+                                    acceptHeader='application/json', stream=True,
+                                    errmsg='Error when getting table {0} from dataset {1}'.format(tableName, datasetName))
+            # the table is parsed as it is streamed, so parsing includes the download
+            stream = ResponseStream(response)
+            if outformat == 'pandas' and not chunksize and over_budget(stream):
+                with metrics.parsing('spill_csv'), metrics.stage('spill_csv'):
+                    return spill_csv(stream, delimiter='\t', columns=columns, dtype=dtype)
+            if outformat == 'arrow':
+                with metrics.parsing('pyarrow.csv (streamed)'), metrics.stage('pyarrow.csv (streamed)'):
+                    return _read_arrow_tsv(stream, columns=columns, dtype=dtype, chunksize=chunksize)
+            with metrics.parsing('pandas.read_csv (streamed)'), metrics.stage('read_csv (streamed)'):
+                return pandas.read_csv(stream, sep="\t", usecols=columns, dtype=dtype, chunksize=chunksize)
+
+    def iterTable(self, tableName, datasetName="MyDB", pagesize=100000, workers=4, **kwargs):
+        """ Iterate over a table in pages
+
+        Downloads a large table in pages of pagesize rows using top/skip, fetching
+        up to workers pages in parallel.  Pages are yielded in table order.  Iteration
+        stops at the first page with fewer than pagesize rows.
 
-        response = send_request(url, content_type='application/json',
-                                acceptHeader='application/json', stream=True,
-                                errmsg='Error when getting table {0} from dataset {1}'.format(tableName, datasetName))
-        if response.ok:
-            r = response.content.decode()
-            return pandas.read_csv(StringIO(r), sep="\t")
+        Parameters:
+            tableName (str):
+                the name of the table in a dataset
+            datasetName (str):
+                the name of the dataset
+            pagesize (int):
+                the number of rows per page.  Default is 100000.
+            workers (int):
+                the number of pages to download in parallel.  Default is 4.
+            kwargs:
+                additional keyword arguments passed to SkyQuery.getTable (e.g. columns, dtype)
+
+        Returns:
+            a generator of Pandas dataframes
+
+        Example:
+            >>> df = pandas.concat(SkyQuery.iterTable("myTable", pagesize=500000, dtype=True))
+
+        See Also:
+            SkyQuery.getTable
+
+        """
+
+        assert 'chunksize' not in kwargs, 'iterTable does not support chunksize'
+        if kwargs.get('dtype') is True:
+            kwargs['dtype'] = self.getColumnTypes(tableName, datasetName=datasetName)
+
+        start = 0
+        while True:
+            pages = [None] * workers
+            errors = []
+
+            def fetch(index):
+                try:
+                    pages[index] = self.getTable(tableName, datasetName=datasetName, top=pagesize,
+                                                 skip=start + index * pagesize, **kwargs)
+                except Exception as e:
+                    errors.append(e)
+
+            threads = [threading.Thread(target=bind_deadline(fetch), args=(i,)) for i in range(workers)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            if errors:
+                raise errors[0]
+
+            # a server that ignores skip would return the same page forever
+            if start == 0 and workers > 1 and len(pages[1]) == pagesize and pages[0].equals(pages[1]):
+                raise SciServerError('SkyQuery ignored the skip parameter when paging table {0}'.format(tableName))
+
+            for page in pages:
+                yield page
+                if len(page) < pagesize:
+                    return
+            start += workers * pagesize
 
     @checkAuth
     def dropTable(self, tableName, datasetName="MyDB"):
@@ -532,30 +798,47 @@ class SkyQuery(object):
             return True
 
     @checkAuth
-    def uploadTable(self, uploadData, tableName, datasetName="MyDB", informat="csv"):
+    def uploadTable(self, uploadData, tableName, datasetName="MyDB", informat="csv", batch_rows=None,
+                    start_batch=0):
         """ Uploads a table
 
         Uploads a data table into a database
-        (more info in http://www.voservices.net/skyquery).
+        (more info in http://www.voservices.net/skyquery).  DataFrames, files and row
+        batches are encoded to CSV on the fly and streamed into the request body, so
+        the full CSV is never held in memory.
+
+        Large uploads can be split into batches of rows.  The first batch creates the
+        table and each following batch is appended to it in a separate request.  If a
+        batch fails, a SciServerUploadError is raised with the failed batch number, and
+        the upload can be resumed from that batch with start_batch.
 
         Parameters:
-            uploadData (str):
-                the table data in CSV string format
+            uploadData (str|DataFrame|file|iterable):
+                the table data.  Either a CSV string, a Pandas DataFrame, the path to a local
+                CSV file, an open file object, or an iterable of DataFrames where each
+                DataFrame is uploaded as one batch.
             tableName (str):
                 the name of the table in a dataset
             datasetName (str):
                 the name of the dataset
             informat (str):
                 The format of the input data.  Default is 'csv'.
+            batch_rows (int):
+                the maximum number of rows per upload batch.  Default is a single batch.
+            start_batch (int):
+                the batch to start uploading from, to resume a failed upload.  Default is 0.  Needs
+                batch_rows, unless uploadData is an iterable of DataFrames.
 
         Returns:
             True if the table was uploaded successfully
 
         Raises:
             SciServerAPIError: Throws an exception if the HTTP request to the SkyQuery API returns an error.
+            SciServerUploadError: Raised when a batch of a multi-batch upload fails
 
         Example:
             >>> result = SkyQuery.uploadTable("Column1,Column2\n4.5,5.5\n", tableName="myTable", datasetName="MyDB", informat="csv")
+            >>> result = SkyQuery.uploadTable(df, tableName="myTable", batch_rows=1000000)
 
         See Also:
             SkyQuery.listQueues, SkyQuery.listAllDatasets, SkyQuery.getDatasetInfo,
@@ -571,10 +854,739 @@ class SkyQuery(object):
         else:
             raise Exception("Unknown format {0} when trying to upload data in SkyQuery.".format(informat))
 
-        response = send_request(url, reqtype='put', data=uploadData, content_type=ctype, stream=True,
-                                acceptHeader='application/json',
-                                errmsg='Error when uploading data to table {0} in dataset {1}'.format(tableName, datasetName))
-        if response.ok:
-            return True
+        errmsg = 'Error when uploading data to table {0} in dataset {1}'.format(tableName, datasetName)
+        batches = _iter_csv_batches(uploadData, batch_rows=batch_rows, start_batch=start_batch)
+        try:
+            for batch, body in batches:
+                try:
+                    response = send_request(url, reqtype='put', data=body, content_type=ctype, stream=True,
+                                            compress=True, acceptHeader='application/json', errmsg=errmsg)
+                except SciServerError as e:
+                    if batch == 0 and start_batch == 0:
+                        raise
+                    raise SciServerUploadError(e, batch=batch)
+                response.close()
+        finally:
+            # earlier batches may have changed the table even if a later one failed
+            invalidate(tableName)
+
+        return True
+
+
+def _dataframe_csv(df, header=True, chunk_rows=10000):
+    ''' Encodes a DataFrame to CSV bytes, a chunk of rows at a time '''
+    index = df.index.name is not None and df.index.name != ""
+    for start in range(0, max(len(df), 1), chunk_rows):
+        chunk = df.iloc[start:start + chunk_rows]
+        yield chunk.to_csv(index=index, header=header and start == 0).encode('utf8')
+
+
+def _to_bytes(text):
+    return text if isinstance(text, bytes) else text.encode('utf8')
+
+
+def _file_csv_batches(fileobj, batch_rows=None, chunk_size=2**20):
+    ''' Splits an open CSV file into batches of lines, each starting with the header line '''
+    header = _to_bytes(fileobj.readline())
+    lines = (_to_bytes(line) for line in fileobj)
+    pending = [next(lines, None)]
+
+    def batch():
+        chunk, size, nrows = [header], len(header), 0
+        while pending[0] is not None and not (batch_rows and nrows >= batch_rows):
+            line = pending[0]
+            chunk.append(line)
+            size += len(line)
+            nrows += 1
+            pending[0] = next(lines, None)
+            if size >= chunk_size:
+                yield b''.join(chunk)
+                chunk, size = [], 0
+        if chunk:
+            yield b''.join(chunk)
+
+    # each batch must be fully consumed before asking for the next one
+    while True:
+        yield batch()
+        if pending[0] is None:
+            break
+
+
+def _iter_csv_batches(uploadData, batch_rows=None, start_batch=0):
+    ''' Yields the batch number and request body of each upload batch, from start_batch on '''
+    if start_batch and not batch_rows and (isinstance(uploadData, (pandas.DataFrame, str, bytes)) or
+                                           hasattr(uploadData, 'readline')):
+        # a single batch upload has nothing to resume, so nothing would be uploaded
+        raise ValueError('start_batch needs the batch_rows of the upload being resumed')
+
+    if isinstance(uploadData, pandas.DataFrame):
+        nrows = batch_rows or max(len(uploadData), 1)
+        for batch, start in enumerate(range(0, max(len(uploadData), 1), nrows)):
+            if batch >= start_batch:
+                yield batch, _dataframe_csv(uploadData.iloc[start:start + nrows])
+        return
+
+    if isinstance(uploadData, (str, bytes)):
+        newline = b'\n' if isinstance(uploadData, bytes) else '\n'
+        if newline not in uploadData and os.path.isfile(uploadData):
+            with open(uploadData, 'rb') as fileobj:
+                for item in _iter_csv_batches(fileobj, batch_rows=batch_rows, start_batch=start_batch):
+                    yield item
+        elif batch_rows:
+            for item in _iter_csv_batches(BytesIO(_to_bytes(uploadData)), batch_rows=batch_rows,
+                                          start_batch=start_batch):
+                yield item
+        else:
+            yield 0, uploadData
+        return
+
+    if hasattr(uploadData, 'readline'):
+        batches = _file_csv_batches(uploadData, batch_rows=batch_rows)
+    else:
+        # an iterable of DataFrames, each uploaded as one batch
+        batches = (_dataframe_csv(df) for df in uploadData)
+
+    for batch, body in enumerate(batches):
+        if batch < start_batch:
+            # skipped file batches still have to be read past
+            deque(body, maxlen=0)
+            continue
+        yield batch, body
+
+
+class JobWaiter(object):
+    ''' Waits on many SkyQuery jobs with a single background poller thread
+
+    Each job is polled on its own adaptive schedule, as in SkyQuery.waitForJob.  A failed
+    status check is retried with backoff, and the job only fails once the checks failed
+    more times in a row than the retry policy allows.
+
+    Parameters:
+        skyquery (SkyQuery):
+            The SkyQuery instance to use.  Default is a new instance.
+        retry (RetryPolicy):
+            When to retry failed status checks.  Default is a RetryPolicy with its defaults.
+
+    Example:
+        >>> waiter = JobWaiter()
+        >>> for jobId in jobIds:
+        >>>     waiter.add(jobId)
+        >>> results = waiter.wait(jobIds, timeout=3600)
+        >>> waiter.stop()
+
+    '''
+
+    def __init__(self, skyquery=None, retry=None):
+        self.skyquery = skyquery or SkyQuery()
+        self.retry = retry or RetryPolicy()
+        self.results = {}
+        self.errors = {}
+        self._schedule = []
+        self._started = {}
+        self._failures = {}
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._loop)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __repr__(self):
+        return '<JobWaiter(waiting={0}, done={1})>'.format(len(self._schedule), len(self.results))
+
+    def add(self, jobId):
+        ''' Starts waiting on a job '''
+        with self._cond:
+            self._started[jobId] = time.time()
+            heapq.heappush(self._schedule, (time.time(), jobId))
+            self._cond.notify_all()
+
+    def done(self, jobId):
+        ''' True once the job reached a terminal status '''
+        return jobId in self.results or jobId in self.errors
+
+    def _loop(self):
+        while True:
+            with self._cond:
+                while not self._stopped and (not self._schedule or self._schedule[0][0] > time.time()):
+                    self._cond.wait(self._schedule[0][0] - time.time() if self._schedule else None)
+                if self._stopped:
+                    return
+                due, jobId = heapq.heappop(self._schedule)
+
+            try:
+                jobDesc = self.skyquery.getJobStatus(jobId)
+            except Exception as e:
+                jobDesc, error = None, e
+            else:
+                error = None
+
+            with self._cond:
+                if error is not None:
+                    failures = self._failures.get(jobId, 0)
+                    if self.retry.can_retry('get', failures):
+                        self._failures[jobId] = failures + 1
+                        heapq.heappush(self._schedule, (time.time() + self.retry.delay(failures), jobId))
+                    else:
+                        self.errors[jobId] = error
+                elif jobDesc['status'].lower() in TERMINAL_STATUSES:
+                    self.results[jobId] = jobDesc
+                else:
+                    self._failures.pop(jobId, None)
+                    elapsed = time.time() - self._started[jobId]
+                    interval = _poll_interval(jobDesc.get('queue'), elapsed)
+                    heapq.heappush(self._schedule, (time.time() + interval, jobId))
+                self._cond.notify_all()
+
+    def wait(self, jobIds, timeout=None, cancel_on_timeout=False):
+        ''' Waits for the given jobs to finish
+
+        Parameters:
+            jobIds (list):
+                the IDs of jobs previously added to the waiter
+            timeout (float):
+                the maximum number of seconds to wait.  Default is to wait forever, or until the
+                current sciserver.deadline.
+            cancel_on_timeout (bool):
+                if True, cancels the unfinished jobs when the timeout is reached.
+
+        Returns:
+            list: the final job descriptions, in the order of jobIds
+
+        Raises:
+            SciServerTimeoutError: if any job is not finished before the timeout
+
+        '''
+        timeout = effective_timeout(timeout)
+        deadline = time.time() + timeout if timeout is not None else None
+        with self._cond:
+            while not all(self.done(jobId) for jobId in jobIds):
+                remaining = deadline - time.time() if deadline is not None else None
+                if remaining is not None and remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+
+            pending = [jobId for jobId in jobIds if not self.done(jobId)]
+            errors = [self.errors[jobId] for jobId in jobIds if jobId in self.errors]
+
+        if errors:
+            raise errors[0]
+        if pending:
+            if cancel_on_timeout:
+                for jobId in pending:
+                    self.skyquery.cancelJob(jobId)
+            raise SciServerTimeoutError('Timed out after {0} seconds waiting for {1} jobs'.format(timeout, len(pending)))
+
+        return [self.results[jobId] for jobId in jobIds]
+
+    def stop(self):
+        ''' Stops the poller thread '''
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+
+
+class ScheduledJob(object):
+    ''' A SkyQuery job held by a JobScheduler
+
+    Attributes:
+        query (str):
+            The sql query string
+        queue (str):
+            The queue the job was routed to, once submitted
+        jobId (str):
+            The SkyQuery job guid, once submitted
+        status (str):
+            'pending' until submitted, then the last known SkyQuery job status
+        error (Exception):
+            The error raised when submitting the job, if any
+
+    '''
+
+    def __init__(self, query, queue=None, overflow=False):
+        self.query = query
+        self.requested = queue
+        self.overflow = overflow
+        self.queue = None
+        self.jobId = None
+        self.status = 'pending'
+        self.error = None
+        self.jobDesc = None
+        self._done = threading.Event()
+
+    def __repr__(self):
+        return '<ScheduledJob(jobId={0}, queue={1}, status={2})>'.format(self.jobId, self.queue, self.status)
+
+    def done(self):
+        ''' True once the job reached a terminal status or failed to submit '''
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        ''' Waits for the job to finish and returns its last job description '''
+        if not self._done.wait(timeout):
+            raise SciServerTimeoutError('Timed out waiting for scheduled job {0}'.format(self.jobId))
+        if self.error:
+            raise self.error
+        return self.jobDesc
+
+    def _finish(self, jobDesc=None, error=None):
+        self.jobDesc = jobDesc
+        self.error = error
+        if jobDesc:
+            self.status = jobDesc['status']
+        self._done.set()
+
+
+class JobScheduler(object):
+    ''' A client-side, queue-aware SkyQuery job scheduler
+
+    Jobs handed to the scheduler are held in a client-side queue and submitted by a
+    background thread only when their SkyQuery queue has room, so the server never
+    rejects them for exceeding its limits.  The limit of each queue is read from
+    getQueueInfo, and the number of jobs of the user already running in it from
+    listJobs, which also includes jobs submitted outside of the scheduler.
+
+    Jobs are routed to the quick queue unless asked for otherwise.  Jobs submitted
+    with overflow=True go to whichever allowed queue has room first.
+
+    Parameters:
+        skyquery (SkyQuery):
+            The SkyQuery instance to use.  Default is a new instance.
+        limits (dict):
+            The maximum number of running jobs per queue.  Overrides the server limits.
+        default_limit (int):
+            The limit of a queue whose info does not give one.  Default is 2.
+        poll (float):
+            The number of seconds between scheduling rounds.  Default is 2.
+
+    Example:
+        >>> scheduler = JobScheduler()
+        >>> jobs = [scheduler.submit(query, overflow=True) for query in queries]
+        >>> results = scheduler.wait()
+        >>> scheduler.stop()
+
+    '''
+
+    # queue info keys that may hold the maximum number of running jobs
+    limit_keys = ('maxOutstandingJobs', 'maxRunningJobs', 'maxJobs')
+
+    def __init__(self, skyquery=None, limits=None, default_limit=2, poll=2.):
+        self.skyquery = skyquery or SkyQuery()
+        self.default_limit = default_limit
+        self.poll = poll
+        self.limits = {}
+        self._overrides = dict(limits or {})
+        self.pending = deque()
+        self.active = []
+        self.jobs = []
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = False
+        self._thread = None
+
+    def __repr__(self):
+        return '<JobScheduler(pending={0}, active={1})>'.format(len(self.pending), len(self.active))
+
+    def queue_limit(self, queue):
+        ''' Returns the maximum number of running jobs allowed in a queue '''
+        if queue in self._overrides:
+            return self._overrides[queue]
+        if queue not in self.limits:
+            info = self.skyquery.getQueueInfo(queue) or {}
+            limit = [info[key] for key in self.limit_keys if info.get(key)]
+            self.limits[queue] = int(limit[0]) if limit else self.default_limit
+        return self.limits[queue]
+
+    def running(self, queue):
+        ''' Returns the user's jobs that are not finished in a queue, keyed by guid '''
+        jobs = self.skyquery.listJobs(queue) or []
+        return {job.get('guid'): job for job in jobs if job.get('status', '').lower() not in TERMINAL_STATUSES}
+
+    def submit(self, query, queue=None, overflow=False):
+        ''' Adds a job to the client-side queue
+
+        Parameters:
+            query (str):
+                the sql query string
+            queue (str):
+                the queue to run the job in.  Default is quick.
+            overflow (bool):
+                if True, and no queue is given, the job runs in the first of quick or long with room
 
+        Returns:
+            a ScheduledJob
+
+        '''
+        job = ScheduledJob(query, queue=queue, overflow=overflow)
+        with self._lock:
+            self.pending.append(job)
+            self.jobs.append(job)
+        self.start()
+        self._wakeup.set()
+        return job
+
+    def _route(self, job, room):
+        ''' Picks the queue for a job, or None if none of its allowed queues has room '''
+        if job.requested:
+            queues = [job.requested]
+        elif job.overflow:
+            queues = ['quick', 'long']
+        else:
+            queues = ['quick']
+        for queue in queues:
+            if room.get(queue, 0) > 0:
+                return queue
+        return None
+
+    def schedule(self):
+        ''' Runs a single scheduling round
+
+        Updates the status of the submitted jobs, then submits as many pending jobs
+        as the queues have room for.
+
+        '''
+        with self._lock:
+            pending = list(self.pending)
+            active = list(self.active)
+
+        queues = set(job.queue for job in active)
+        for job in pending:
+            queues.update([job.requested] if job.requested else ['quick', 'long'] if job.overflow else ['quick'])
+
+        room = {}
+        for queue in queues:
+            running = self.running(queue)
+            room[queue] = self.queue_limit(queue) - len(running)
+            for job in [j for j in active if j.queue == queue]:
+                if job.jobId in running:
+                    job.status = running[job.jobId].get('status', job.status)
+                    continue
+                # no longer running, so fetch its final status
+                jobDesc = self.skyquery.getJobStatus(job.jobId)
+                if jobDesc['status'].lower() in TERMINAL_STATUSES:
+                    job._finish(jobDesc)
+                    with self._lock:
+                        self.active.remove(job)
+
+        for job in pending:
+            queue = self._route(job, room)
+            if not queue:
+                continue
+            with self._lock:
+                self.pending.remove(job)
+            try:
+                job.jobId = self.skyquery.submitJob(job.query, queue=queue)
+            except Exception as e:
+                job._finish(error=e)
+                continue
+            job.queue = queue
+            job.status = 'submitted'
+            room[queue] -= 1
+            with self._lock:
+                self.active.append(job)
+
+    def _exit(self, idle=False):
+        ''' Whether the scheduling thread should exit, clearing it if so, under the lock '''
+        with self._lock:
+            if self._stopped or (idle and not self.pending and not self.active):
+                # cleared together with the decision, so start() either sees this thread or starts a new one
+                self._thread = None
+                return True
+        return False
+
+    def _loop(self):
+        while not self._exit():
+            try:
+                self.schedule()
+            except Exception as e:
+                warnings.warn('JobScheduler round failed: {0}'.format(e), SciServerWarning)
+            self._wakeup.wait(self.poll)
+            self._wakeup.clear()
+            if self._exit(idle=True):
+                return
+
+    def start(self):
+        ''' Starts the background scheduling thread, if it is not already running '''
+        with self._lock:
+            self._stopped = False
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._loop)
+                self._thread.daemon = True
+                self._thread.start()
+
+    def stop(self):
+        ''' Stops the background scheduling thread.
+
+        Unfinished jobs stay queued, and are submitted or updated again once the scheduler is
+        started again.  Meanwhile wait raises an error instead of waiting for them.
+        '''
+        self._stopped = True
+        self._wakeup.set()
+
+    def wait(self, timeout=None):
+        ''' Waits for all scheduled jobs to finish
+
+        Parameters:
+            timeout (float):
+                The number of seconds to wait for all the jobs.  Default is no limit.
+
+        Returns:
+            a list of the final job descriptions, in submission order
+
+        Raises:
+            SciServerTimeoutError: if the jobs do not finish within timeout
+            SciServerError: if the scheduler is stopped before the jobs finish
+
+        '''
+        end = None if timeout is None else time.time() + timeout
+        for job in list(self.jobs):
+            while not job.done():
+                if self._stopped:
+                    unfinished = len([j for j in self.jobs if not j.done()])
+                    raise SciServerError('JobScheduler was stopped with {0} jobs unfinished.  '
+                                         'Start it again to finish them.'.format(unfinished))
+                left = None if end is None else end - time.time()
+                if left is not None and left <= 0:
+                    raise SciServerTimeoutError('Timed out after {0} seconds waiting for scheduled jobs'.format(timeout))
+                # wake up regularly to notice the scheduler being stopped
+                job._done.wait(0.1 if left is None else min(left, 0.1))
+        return [job.wait(timeout=0) for job in list(self.jobs)]
+
+
+class CrossMatchPipeline(object):
+    ''' An end-to-end SkyQuery cross-match pipeline
+
+    Runs the upload, submit, wait and download stages of a cross-match in one go.
+    The input catalog can be split into several sky regions (slices in right ascension
+    holding about the same number of rows), each cross-matched as a separate job.
+    Up to workers partitions run in parallel, so the stages of different partitions
+    overlap, and jobs can be spread over several queues.  Without a scheduler, no more
+    jobs run in a queue at a time than its limit.  The time spent in each stage is
+    recorded per partition.
+
+    Parameters:
+        query (str):
+            The cross-match query.  It must contain the {input} and {output} placeholders,
+            which are replaced with the names of the uploaded catalog table and of the
+            results table of each partition.
+        catalog (DataFrame):
+            The input catalog
+        tableName (str):
+            The base name of the uploaded catalog tables.  Default is 'xmatch_input'.
+        resultTable (str):
+            The base name of the results tables.  Default is 'xmatch_output'.
+        datasetName (str):
+            The dataset holding the input and results tables.  Default is MyDB.
+        queue (str|list):
+            The queue, or list of queues to spread the partitions over.  Default is quick.
+            With a scheduler, None lets the scheduler pick the queue.  Without one, None means quick.
+        partitions (int):
+            The number of sky regions to split the catalog into.  Default is 1.
+        ra (str):
+            The name of the right ascension column of the catalog.  Default is 'ra'.
+        poll (float):
+            The initial number of seconds between job status checks.  Default depends on the queue.
+        max_poll (float):
+            The maximum number of seconds between job status checks.  Default depends on the queue.
+        cleanup (bool):
+            If True, drops the uploaded and results tables of each partition once it is done,
+            or has failed.  Default is True.
+        workers (int):
+            The maximum number of partitions run at a time.  Default is 4.
+        scheduler (JobScheduler):
+            Optional scheduler to submit the jobs through.  Partitions with no queue set
+            are then routed to whichever of quick or long has room.
+        skyquery (SkyQuery):
+            The SkyQuery instance to use.  Default is a new instance.
+        verbose (bool):
+            If True, prints the progress of each partition
+
+    Example:
+        >>> query = ('SELECT x.matchid, a.ra, a.dec, b.objid INTO {output} '
+        >>>          'FROM XMATCH(MUST EXIST IN MyDB:{input} AS a WITH(POINT(a.ra, a.dec)), '
+        >>>          'MUST EXIST IN SDSSDR13:PhotoObjAll AS b WITH(POINT(b.ra, b.dec)), '
+        >>>          'LIMIT BAYESFACTOR TO 1e3) AS x')
+        >>> pipeline = CrossMatchPipeline(query, catalog, partitions=4, queue=['quick', 'long'])
+        >>> df = pipeline.run()
+        >>> pipeline.summary()
+
+    '''
+
+    def __init__(self, query, catalog, tableName='xmatch_input', resultTable='xmatch_output',
+                 datasetName='MyDB', queue='quick', partitions=1, ra='ra', poll=None, max_poll=None,
+                 cleanup=True, workers=4, scheduler=None, skyquery=None, verbose=None):
+        assert '{input}' in query and '{output}' in query, 'query must contain {input} and {output} placeholders'
+        self.query = query
+        self.catalog = catalog
+        self.tableName = tableName
+        self.resultTable = resultTable
+        self.datasetName = datasetName
+        self.queues = [queue] if isinstance(queue, str) or queue is None else list(queue)
+        if not scheduler:
+            self.queues = ['quick' if q is None else q for q in self.queues]
+        self.partitions = partitions
+        self.ra = ra
+        self.poll = poll
+        self.max_poll = max_poll
+        self.cleanup = cleanup
+        self.workers = workers
+        self.scheduler = scheduler
+        self.skyquery = skyquery or (scheduler.skyquery if scheduler else SkyQuery())
+        self.verbose = verbose
+        self.timings = []
+        self.jobs = []
+
+    def __repr__(self):
+        return '<CrossMatchPipeline(partitions={0}, queues={1})>'.format(self.partitions, self.queues)
+
+    def split(self):
+        ''' Splits the catalog into sky regions of about equal size
+
+        Returns:
+            A list of DataFrames, one per partition, ordered by right ascension
+
+        Raises:
+            SciServerError: if the right ascension of any row is missing or infinite, as the row
+            would be in no partition
+
+        '''
+        if self.partitions <= 1:
+            return [self.catalog]
+        ra = self.catalog[self.ra]
+        invalid = ra.isnull() | (ra.abs() == float('inf'))
+        if invalid.any():
+            raise SciServerError('Cannot split the catalog by {0}: {1} rows have no finite value, e.g. row {2}'.format(
+                self.ra, invalid.sum(), self.catalog.index[invalid.values][0]))
+        quantiles = [i / float(self.partitions) for i in range(1, self.partitions)]
+        edges = list(self.catalog[self.ra].quantile(quantiles))
+        bins = [-float('inf')] + edges + [float('inf')]
+        labels = pandas.cut(self.catalog[self.ra], bins=bins, labels=False, duplicates='drop', right=False)
+        return [self.catalog[labels == label] for label in sorted(labels.unique())]
+
+    def _log(self, partition, message):
+        if self.verbose:
+            print('[partition {0}] {1}'.format(partition, message))
+
+    def _drop(self, partition, *tables):
+        ''' Drops the tables of a partition, warning about those that cannot be dropped '''
+        for table in tables:
+            try:
+                self.skyquery.dropTable(table, datasetName=self.datasetName)
+            except SciServerError as e:
+                warnings.warn('Could not drop table {0} of partition {1}: {2}'.format(table, partition, e),
+                              SciServerWarning)
+
+    def _run_partition(self, partition, catalog, queue, slots=None):
+        ''' Runs all stages of the cross-match for a single partition '''
+        timing = {'partition': partition, 'queue': queue, 'rows': len(catalog)}
+        inputTable = '{0}_{1}'.format(self.tableName, partition)
+        outputTable = '{0}_{1}'.format(self.resultTable, partition)
+        sky = self.skyquery
+
+        start = time.time()
+        sky.uploadTable(catalog, tableName=inputTable, datasetName=self.datasetName)
+        timing['upload'] = time.time() - start
+        self._log(partition, 'uploaded {0} rows'.format(len(catalog)))
+
+        try:
+            result = self._match(partition, inputTable, outputTable, queue, timing, slots)
+        finally:
+            if self.cleanup:
+                self._drop(partition, inputTable, outputTable)
+
+        return result, timing
+
+    def _match(self, partition, inputTable, outputTable, queue, timing, slots):
+        ''' Runs the cross-match job of a partition and downloads its results '''
+        sky = self.skyquery
+        query = self.query.format(input=inputTable, output=outputTable)
+        start = time.time()
+        if self.scheduler:
+            scheduled = self.scheduler.submit(query, queue=queue, overflow=queue is None)
+            jobDesc = scheduled.wait()
+            jobId = scheduled.jobId
+            timing['queue'] = scheduled.queue
+            timing['submit'] = 0.0
+        else:
+            # wait for room in the queue, so its limit is never exceeded
+            with slots[queue]:
+                jobId = sky.submitJob(query, queue=queue)
+                timing['submit'] = time.time() - start
+                start = time.time()
+                jobDesc = sky.waitForJob(jobId, verbose=False, poll=self.poll, max_poll=self.max_poll)
+        timing['wait'] = time.time() - start
+        timing['jobId'] = jobId
+        timing['status'] = jobDesc['status']
+        self._log(partition, 'job {0} {1}'.format(jobId, jobDesc['status']))
+        if jobDesc['status'].lower() != 'completed':
+            raise SciServerError('Cross-match job {0} of partition {1} ended with status {2}'.format(
+                jobId, partition, jobDesc['status']))
+
+        start = time.time()
+        result = sky.getTable(outputTable, datasetName=self.datasetName)
+        timing['download'] = time.time() - start
+        return result
+
+    def run(self):
+        ''' Runs the cross-match pipeline
+
+        Returns:
+            A Pandas DataFrame of the cross-match results of all partitions, or a SpilledTable
+            if the results of any partition were spilled (see config.memoryBudget)
+
+        Raises:
+            SciServerError: if the cross-match job of any partition does not complete
+
+        '''
+        parts = self.split()
+        results = [None] * len(parts)
+        timings = [None] * len(parts)
+        errors = []
+        pending = deque(range(len(parts)))
+        lock = threading.Lock()
+
+        slots = None
+        if not self.scheduler:
+            limits = JobScheduler(skyquery=self.skyquery)
+            slots = {queue: threading.BoundedSemaphore(limits.queue_limit(queue)) for queue in set(self.queues)}
+
+        def run():
+            while True:
+                with lock:
+                    # once a partition failed, the others are not started
+                    if not pending or errors:
+                        return
+                    partition = pending.popleft()
+                queue = self.queues[partition % len(self.queues)]
+                try:
+                    results[partition], timings[partition] = self._run_partition(partition, parts[partition],
+                                                                                 queue, slots)
+                except Exception as e:
+                    with lock:
+                        errors.append(e)
+
+        threads = [threading.Thread(target=bind_deadline(run)) for i in range(min(self.workers, len(parts)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.timings = [t for t in timings if t]
+        self.jobs = [t['jobId'] for t in self.timings]
+        if errors:
+            raise errors[0]
+
+        if any(isinstance(result, SpilledTable) for result in results):
+            # keep the combined results out of memory too, loading one partition at a time
+            frames = (result.to_pandas() if isinstance(result, SpilledTable) else result for result in results)
+            return spill_frames(frames)
+        return pandas.concat(results, ignore_index=True)
+
+    def summary(self):
+        ''' Summarizes the time spent in each stage
+
+        Returns:
+            A Pandas DataFrame with one row of stage timings (in seconds) per partition
 
+        '''
+        columns = ['partition', 'queue', 'rows', 'jobId', 'status', 'upload', 'submit', 'wait', 'download']
+        return pandas.DataFrame(self.timings, columns=columns)
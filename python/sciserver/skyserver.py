@@ -9,11 +9,172 @@
 # @Last Modified time: 2017-08-30 14:50:47
 
 from __future__ import print_function, division, absolute_import
-from io import StringIO, BytesIO
+from io import BytesIO
+import numbers
+import re
+import uuid
+import warnings
 import pandas
 import skimage.io
-from sciserver import config
-from sciserver.utils import send_request, Task
+from sciserver import config, metrics
+from sciserver.casjobs import CasJobs
+from sciserver.exceptions import SciServerError, SciServerAPIError, SciServerWarning
+from sciserver.spill import over_budget, spill_csv, spill_frames
+from sciserver.sqlcache import cached_query
+from sciserver.utils import send_request, should_stream, ResponseStream, Task
+
+try:
+    import pyarrow
+    from pyarrow import csv as pyarrow_csv
+except ImportError:
+    pyarrow = None
+
+# dtypes of the standard photometric columns of search results, by lower-case name.  Other
+# columns, and all columns of results that do not fit these, are inferred.
+PHOTO_DTYPES = dict([(name, 'int64') for name in ('objid', 'specobjid', 'run', 'rerun', 'camcol', 'field',
+                                                  'obj', 'type', 'mode', 'flags', 'mjd', 'plate', 'fiberid')] +
+                    [(name, 'float64') for name in ('ra', 'dec', 'u', 'g', 'r', 'i', 'z', 'err_u', 'err_g',
+                                                    'err_r', 'err_i', 'err_z', 'distance')])
+
+# the dtypes applied to the results of each search
+SEARCH_DTYPES = {'sqlSearch': PHOTO_DTYPES, 'radialSearch': PHOTO_DTYPES, 'rectangularSearch': PHOTO_DTYPES}
+
+# the most rows SqlSearch returns.  Larger results are truncated to it.
+SQL_ROW_LIMIT = 500000
+
+# unique columns that results can be paged by, in order of preference
+KEY_COLUMNS = ('objid', 'specobjid', 'photoobjid', 'apstar_id', 'fieldid', 'plateid')
+
+_ORDER_BY = re.compile(r'\border\s+by\s+[^()]*$', re.IGNORECASE)
+_SELECT_TOP = re.compile(r'^\s*select\s+(?:distinct\s+)?top\s+(\d+)?', re.IGNORECASE)
+_REPEATED = re.compile(r'^(.+)\.\d+$')
+
+_SUBQUERY_HINT = ('Paging runs the query as a subquery, so each of its columns needs a unique name: '
+                  'alias expressions, e.g. count(*) as n, and repeated columns, e.g. s.objid as specobjid.')
+
+
+def read_csv(content, dtype=None, engine=None):
+    ''' Reads a SkyServer csv result from its bytes into a DataFrame
+
+    The leading # lines are skipped by offset, without copying or decoding the body, which is
+    parsed by the pyarrow csv reader when pyarrow is installed, and by the pandas C parser
+    otherwise.  Both give the same DataFrame as pandas.read_csv, up to the last digit of floats.
+
+    Parameters:
+        content (bytes):
+            The csv result
+        dtype (dict):
+            Dtypes of known columns, by lower-case name.  Columns missing from the result are
+            ignored, and if the result does not fit them, all column types are inferred.
+        engine (str):
+            'pyarrow' or 'c', to override the choice of parser
+
+    Returns:
+        a Pandas dataframe
+
+    '''
+    start = 0
+    while content.startswith(b'#', start):
+        end = content.find(b'\n', start)
+        start = len(content) if end < 0 else end + 1
+    end = content.find(b'\n', start)
+    names = content[start:end if end >= 0 else len(content)].decode().strip().split(',')
+    types = dict((name, dtype[name.lower()]) for name in names if name.lower() in (dtype or {}))
+
+    engine = engine or ('pyarrow' if pyarrow is not None else 'c')
+    if engine == 'pyarrow' and len(set(names)) < len(names):
+        # pandas renames duplicate columns, arrow does not
+        engine = 'c'
+    parse = _read_arrow if engine == 'pyarrow' else _read_pandas
+    try:
+        return parse(content, start, types)
+    except ValueError:
+        if not types:
+            raise
+        return parse(content, start, {})
+
+
+def _read_pandas(content, start, types):
+    # BytesIO shares the bytes until written to
+    data = BytesIO(content)
+    data.seek(start)
+    return pandas.read_csv(data, dtype=types or None, index_col=None)
+
+
+def _read_arrow(content, start, types):
+    data = pyarrow.py_buffer(content).slice(start)
+    options = pyarrow_csv.ConvertOptions(strings_can_be_null=True,
+                                         column_types=dict((name, pyarrow.from_numpy_dtype(val))
+                                                           for name, val in types.items()))
+    table = pyarrow_csv.read_csv(pyarrow.BufferReader(data), convert_options=options)
+    # pandas leaves dates and times as strings, so read them again as such
+    temporal = [field.name for field in table.schema
+                if pyarrow.types.is_temporal(field.type) and field.name not in types]
+    if temporal:
+        strings = pyarrow_csv.read_csv(pyarrow.BufferReader(data), convert_options=pyarrow_csv.ConvertOptions(
+            strings_can_be_null=True, include_columns=temporal,
+            column_types=dict((name, pyarrow.string()) for name in temporal)))
+        for name in temporal:
+            table = table.set_column(table.schema.get_field_index(name), name, strings.column(name))
+    return table.to_pandas()
+
+
+def _subquery(sql):
+    ''' Prepares a query to be paged as a subquery, without its final semicolon, and without its
+    final order by unless it selects the top rows '''
+    sql = sql.strip().rstrip(';')
+    return sql if _SELECT_TOP.match(sql) else _ORDER_BY.sub('', sql)
+
+
+def _check_columns(columns):
+    ''' Raises SciServerError if a query cannot be paged as a subquery, as columns are unnamed or repeated '''
+    # pandas names unnamed columns "Unnamed: 0", and repeated ones "objid.1"
+    repeated = [_REPEATED.match(str(name)) for name in columns]
+    bad = [name for name, match in zip(columns, repeated) if not name or str(name).startswith('Unnamed:') or
+           (match and match.group(1) in columns)]
+    if bad:
+        raise SciServerError('The query cannot be paged, as columns {0} are unnamed or repeated.  {1}'.format(
+            bad, _SUBQUERY_HINT))
+
+
+def _sql_literal(value):
+    if isinstance(value, numbers.Integral):
+        return str(int(value))
+    if isinstance(value, numbers.Real):
+        return repr(float(value))
+    return "'{0}'".format(str(value).replace("'", "''"))
+
+
+def _keyset_pages(run, query, key, pagesize, first=None):
+    ''' Yields the pages of a result in order of a unique key column, pagesize rows at a time
+
+    Parameters:
+        run (callable):
+            Runs a query, and returns its result
+        query (callable):
+            Returns the query of a page, from its number of rows and its where clause
+        key (tuple):
+            The name of the key column in the results, and in the where clause
+        pagesize (int):
+            The number of rows of each page
+        first (int):
+            The number of rows of the first page.  Default is pagesize.
+
+    '''
+    column, name = key
+    last = None
+    while True:
+        where = '' if last is None else 'where {0} > {1}'.format(name, _sql_literal(last))
+        size = first if last is None and first else pagesize
+        page = run(query(size, where))
+        # rows sharing a key across a page boundary would be skipped
+        if not page[column].is_unique:
+            raise SciServerError('The paging key {0} is not unique in the result'.format(column))
+        if len(page):
+            yield page
+        if len(page) < size:
+            return
+        last = page[column].iloc[-1]
 
 
 class SkyServer(object):
@@ -86,20 +247,37 @@ class SkyServer(object):
 
         return url
 
-    def sqlSearch(self, sql, dataRelease=None):
+    def sqlSearch(self, sql, dataRelease=None, cache=True, key=None, pagesize=100000, autopage=False):
         """ Perform an SQL query
 
         Executes a SQL query to the SDSS database, and retrieves the result table as a dataframe.
-        Maximum number of rows retrieved is set currently to 500,000.
+        SqlSearch returns at most 500,000 rows.  Given a unique key column, the result is fetched
+        in order of the key, and the rows beyond the first 500,000 in pages, as by
+        SkyServer.iterSqlSearch.  The pages are concatenated, or spilled to a local file if
+        config.memoryBudget is set.  Without a key, a truncated result is returned with a
+        warning, unless autopage is set.
 
         Parameters:
             sql (str):
                 a string containing the sql query
             dataRelease (str):
                 SDSS data release, E.g, 'DR13'. Default value already set in sciserver.config.DataRelease
+            cache (bool):
+                if True, and config.queryCache is enabled, returns a copy of the cached result of an identical
+                query (after normalization) in the same data release.  Set to False to always query the server.
+            key (str):
+                a unique column of the result to page it by.  The query is then run as a subquery, so its
+                columns must be named and unique.
+            pagesize (int):
+                the number of rows of each page after the first.  Default is 100000.
+            autopage (bool):
+                if True, and no key is given, a truncated result is fetched again in pages, by the first
+                of sciserver.skyserver.KEY_COLUMNS in the result if a count query shows it is unique,
+                or else through a CasJobs job.  These take extra requests, so are off by default.
 
         Returns:
-            returns the result set as a Pandas data frame
+            returns the result set as a Pandas data frame, or a sciserver.spill.SpilledTable if it is
+            larger than config.memoryBudget
 
         Raises:
             SciServerAPIError: Throws an exception if the HTTP request to the SkyServer API returns an error.
@@ -114,11 +292,161 @@ class SkyServer(object):
 
         url = self.get_url('SkyServerWS/SearchTools/SqlSearch?', data_release=dataRelease)
 
+        return cached_query(sql, ('skyserver', url, key, autopage),
+                            lambda: self._sql_search_all(url, sql, dataRelease, key, pagesize, autopage), cache=cache)
+
+    def _sql_search_all(self, url, sql, dataRelease, key, pagesize, autopage):
+        ''' Sends a sql query, and fetches the rest of its result in pages if it is truncated '''
+
+        top = _SELECT_TOP.match(sql)
+        capped = top and top.group(1) and int(top.group(1)) <= SQL_ROW_LIMIT
+        if key is not None and not capped:
+            # the first page holds as many rows as SqlSearch returns, so a result that fits takes one request
+            pages = self._pages(url, sql, dataRelease, key, pagesize, None, first=SQL_ROW_LIMIT)
+        else:
+            result = self._sql_search(url, sql)
+            if capped or len(result) < SQL_ROW_LIMIT:
+                return result
+            if not autopage:
+                warnings.warn('The result of the query was truncated to {0} rows.  Pass a unique key column, '
+                              'or autopage=True, to fetch all of it.'.format(SQL_ROW_LIMIT), SciServerWarning)
+                return result
+            # rows in no particular order cannot be continued from, so the result is fetched again
+            columns = list(result.columns)
+            del result
+            pages = self._pages(url, sql, dataRelease, None, pagesize, columns)
+
+        if config.memoryBudget is not None:
+            return spill_frames(pages)
+        return pandas.concat(list(pages), ignore_index=True)
+
+    def iterSqlSearch(self, sql, dataRelease=None, key=None, pagesize=100000, autopage=False):
+        """ Iterate over the result of an SQL query in pages
+
+        Executes a SQL query to the SDSS database in pages of pagesize rows, so results beyond the
+        500,000 rows of SqlSearch can be read with bounded memory.  Pages are fetched by keyset
+        pagination: each page is the next pagesize rows of the query ordered by a unique key column,
+        by wrapping the query as "select top pagesize * from (sql) as q where q.key > last order by q.key".
+        The columns of the query must therefore be named and unique.  A given key that turns out not
+        to be unique within a page raises SciServerError.
+
+        Without a key, autopage=True finds one by name, checked to be unique with a count query.
+        Results without a unique key column are instead written to a MyDB table by a CasJobs job,
+        which is read in pages and dropped (this needs a SciServer token).
+
+        Parameters:
+            sql (str):
+                a string containing the sql query.  A final order by is dropped, unless the query selects
+                the top rows, as pages are ordered by the key.
+            dataRelease (str):
+                SDSS data release, E.g, 'DR13'. Default value already set in sciserver.config.DataRelease
+            key (str):
+                a unique column of the result to page it by.  Needed unless autopage is set.
+            pagesize (int):
+                the number of rows of each page.  Default is 100000.
+            autopage (bool):
+                if True, and no key is given, pages by the first of sciserver.skyserver.KEY_COLUMNS in the
+                result if a count query shows it is unique, or else through a CasJobs table.  These take
+                extra requests, so are off by default.
+
+        Returns:
+            a generator of Pandas dataframes
+
+        Example:
+            >>> for df in skyserver.iterSqlSearch('select objid, ra, dec, r from PhotoObj where r < 22'):
+            >>>     bright = df[df.r < 17]
+
+        See Also:
+            SkyServer.sqlSearch, CasJobs.submitJob
+
+        """
+
+        assert 0 < pagesize < SQL_ROW_LIMIT, 'pagesize must be below {0}'.format(SQL_ROW_LIMIT)
+        assert key is not None or autopage, 'iterSqlSearch needs a unique key column, or autopage=True'
+        url = self.get_url('SkyServerWS/SearchTools/SqlSearch?', data_release=dataRelease)
+        columns = None
+        if key is None:
+            columns = list(self._subquery_search(url, 'select top 0 * from ({0}) as q'.format(_subquery(sql))).columns)
+        return self._pages(url, sql, dataRelease, key, pagesize, columns)
+
+    def _subquery_search(self, url, sql):
+        ''' Sends a query wrapping another as a subquery, explaining the likely cause if it fails '''
+        try:
+            return self._sql_search(url, sql)
+        except SciServerAPIError as e:
+            raise SciServerError('{0}\n{1}'.format(e, _SUBQUERY_HINT))
+
+    def _pages(self, url, sql, dataRelease, key, pagesize, columns, first=None):
+        ''' Returns the pages of a query, by keyset pagination on key or a key column, or through CasJobs '''
+
+        subquery = _subquery(sql)
+        if key is None:
+            _check_columns(columns)
+            # a key column found by name is only used if it is unique in this result, e.g. not after a join
+            key = next((name for lower in KEY_COLUMNS for name in columns if name.lower() == lower), None)
+            if key is not None:
+                counts = self._subquery_search(url, 'select count_big(*) as n, count_big(distinct q.[{0}]) as d '
+                                                    'from ({1}) as q'.format(key, subquery))
+                if counts['n'].iloc[0] != counts['d'].iloc[0]:
+                    key = None
+        if key is None:
+            return self._export_pages(sql, dataRelease, pagesize)
+
+        def query(top, where):
+            return 'select top {0} * from ({1}) as q {2} order by q.[{3}]'.format(top, subquery, where, key)
+
+        return _keyset_pages(lambda page: self._subquery_search(url, page), query, (key, 'q.[{0}]'.format(key)),
+                             pagesize, first=first)
+
+    def _export_pages(self, sql, dataRelease, pagesize):
+        ''' Yields the pages of a query written to a MyDB table, numbered by row_id, by a CasJobs job '''
+
+        casjobs = CasJobs()
+        table = 'sqlsearch_{0}'.format(uuid.uuid4().hex[:16])
+        export = ('select row_number() over (order by (select null)) as row_id, q.* into MyDB.{0} '
+                  'from ({1}) as q'.format(table, _subquery(sql)))
+        jobid = casjobs.submitJob(export, context=dataRelease or self.DataRelease)
+        status = casjobs.waitForJob(jobid, verbose=False)
+        if int(status['Status']) != 5:
+            raise SciServerError('The CasJobs job {0} writing the result of a query to MyDB failed: {1}\n{2}'.format(
+                jobid, status.get('Message', ''), _SUBQUERY_HINT))
+
+        def query(top, where):
+            return 'select top {0} * from {1} {2} order by row_id'.format(top, table, where)
+
+        try:
+            pages = _keyset_pages(lambda page: casjobs.executeQuery(page, context='MyDB', cache=False), query,
+                                  ('row_id', 'row_id'), pagesize)
+            for page in pages:
+                yield page[[name for name in page.columns if name != 'row_id']]
+        finally:
+            casjobs.executeQuery('drop table {0}'.format(table), context='MyDB', outformat='json', cache=False)
+
+    def _sql_search(self, url, sql):
+        ''' Sends a sql query to the SqlSearch service and reads the csv result '''
+
         url = self.pad_url(url, format='csv', cmd=sql, taskname='sqlSearch')
 
-        response = send_request(url, errmsg='Error when executing a sql query.', stream=True)
-        r = response.content.decode()
-        return pandas.read_csv(StringIO(r), comment='#', index_col=None)
+        return self._search(url, 'sqlSearch', 'Error when executing a sql query.')
+
+    def _search(self, url, taskname, errmsg):
+        ''' Sends a search request and reads its csv result into a DataFrame '''
+
+        with metrics.task(Task(taskname, use_base=True, component='SkyServer').name):
+            response = send_request(url, errmsg=errmsg, stream=True)
+            stream = ResponseStream(response)
+            if over_budget(stream):
+                with metrics.parsing('spill_csv'), metrics.stage('spill_csv'):
+                    return spill_csv(stream)
+            if should_stream(stream):
+                # large results are parsed as they arrive, without a copy of the whole body
+                with metrics.parsing('pandas.read_csv (streamed)'), metrics.stage('read_csv (streamed)'):
+                    return pandas.read_csv(stream, comment='#', index_col=None)
+
+            with metrics.stage('download'):
+                content = stream.read()
+            with metrics.parsing('pyarrow.csv' if pyarrow is not None else 'pandas.read_csv'), metrics.stage('read_csv'):
+                return read_csv(content, dtype=SEARCH_DTYPES.get(taskname))
 
     def getJpegImgCutout(self, ra, dec, scale=0.7, width=512, height=512, opt="", query="", dataRelease=None):
         """ Get an SDSS image cutout
@@ -214,7 +542,8 @@ class SkyServer(object):
                 SDSS data release, E.g, 'DR13'. Default value already set in sciserver.config.DataRelease
 
         Returns:
-            Returns the results table as a Pandas data frame.
+            Returns the results table as a Pandas data frame, or a sciserver.spill.SpilledTable if it
+            is larger than config.memoryBudget.
 
         Raises:
             SciServerAPIError: Throws an exception if the HTTP request to the SkyServer API returns an error.
@@ -232,9 +561,7 @@ class SkyServer(object):
         url = self.pad_url(url, format='csv', ra=ra, dec=dec, radius=radius, coordType=coordType,
                            whichPhotometry=whichPhotometry, limit=limit, taskname='radialSearch')
 
-        response = send_request(url, errmsg='Error when executing a radial search.', stream=True)
-        r = response.content.decode()
-        return pandas.read_csv(StringIO(r), comment='#', index_col=None)
+        return self._search(url, 'radialSearch', 'Error when executing a radial search.')
 
     def rectangularSearch(self, min_ra, max_ra, min_dec, max_dec, coordType="equatorial", whichPhotometry="optical",
                           limit="10", dataRelease=None):
@@ -263,7 +590,8 @@ class SkyServer(object):
                 SDSS data release, E.g, 'DR13'. Default value already set in sciserver.config.DataRelease
 
         Returns:
-            Returns the results table as a Pandas data frame.
+            Returns the results table as a Pandas data frame, or a sciserver.spill.SpilledTable if it
+            is larger than config.memoryBudget.
 
         Raises:
             SciServerAPIError: Throws an exception if the HTTP request to the SkyServer API returns an error.
@@ -281,9 +609,7 @@ class SkyServer(object):
         url = self.pad_url(url, format='csv', min_ra=min_ra, max_ra=max_ra, min_dec=min_dec, coordType=coordType,
                            max_dec=max_dec, whichPhotometry=whichPhotometry, limit=limit, taskname='rectangularSearch')
 
-        response = send_request(url, errmsg='Error when executing a rectangular search.', stream=True)
-        r = response.content.decode()
-        return pandas.read_csv(StringIO(r), comment='#', index_col=None)
+        return self._search(url, 'rectangularSearch', 'Error when executing a rectangular search.')
 
     def objectSearch(self, objId=None, specObjId=None, apogee_id=None, apstar_id=None, ra=None, dec=None,
                      plate=None, mjd=None, fiber=None, run=None, rerun=None, camcol=None, field=None,
@@ -344,7 +670,7 @@ class SkyServer(object):
                            ra=ra, dec=dec, plate=plate, mjd=mjd, fiber=fiber, run=run, rerun=rerun, camcol=camcol,
                            field=field, obj=obj, taskname='objectSearch')
 
-        response = send_request(url, errmsg='Error when doing an object search.', stream=True)
+        response = send_request(url, errmsg='Error when doing an object search.')
         r = response.json()
         return r
 
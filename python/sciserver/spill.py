@@ -0,0 +1,293 @@
+# !usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Licensed under a 3-clause BSD license.
+#
+
+''' Spilling of query results larger than the memory budget to local files
+
+When config.memoryBudget is set, results of CasJobs.executeQuery (pandas), SkyServer searches
+and SkyQuery.getTable whose decoded size exceeds it are converted in batches, as they are
+streamed, to an Arrow IPC (Feather v2) file in config.spillDir.  They are returned as a
+SpilledTable, which memory-maps the file and only loads the columns and rows that are asked for.
+
+Example:
+    >>> config.memoryBudget = 2**30
+    >>> table = SkyServer().sqlSearch('select objid, ra, dec, r from PhotoObj')
+    >>> bright = table[table['r'] < 17]
+
+'''
+
+from __future__ import print_function, division, absolute_import
+import itertools
+import os
+import tempfile
+import pandas
+from sciserver import config
+from sciserver.exceptions import SciServerError
+
+_STRINGS = (str, type(u''))
+
+
+def _pyarrow():
+    try:
+        import pyarrow
+        from pyarrow import csv, ipc
+    except ImportError:
+        raise SciServerError('pyarrow is required to spill results larger than config.memoryBudget. '
+                             'Install it with pip install pyarrow, or set config.memoryBudget to None.')
+    return pyarrow, csv, ipc
+
+
+def over_budget(stream):
+    ''' Whether a response is larger than config.memoryBudget once decoded
+
+    The size is counted as the body is read, up to the budget, as the Content-Length of a
+    compressed response is its compressed size.  The bytes read stay buffered in the stream.
+
+    Parameters:
+        stream (ResponseStream):
+            The response stream, not yet read from
+    '''
+    if config.memoryBudget is None:
+        return False
+    return len(stream.peek(config.memoryBudget + 1)) > config.memoryBudget
+
+
+def _write(schema, tables):
+    ''' Writes Arrow tables or record batches to a new spill file, and returns its SpilledTable '''
+    pyarrow, csv, ipc = _pyarrow()
+    fd, path = tempfile.mkstemp(prefix='sciserver-', suffix='.arrow', dir=config.spillDir)
+    os.close(fd)
+    try:
+        with pyarrow.OSFile(path, 'wb') as sink:
+            writer = ipc.new_file(sink, schema)
+            for table in tables:
+                if isinstance(table, pyarrow.Table):
+                    writer.write_table(table)
+                else:
+                    writer.write_batch(table)
+            writer.close()
+    except Exception:
+        os.remove(path)
+        raise
+    return SpilledTable(path, delete=True)
+
+
+def spill_csv(stream, delimiter=',', columns=None, dtype=None, block_size=2**24):
+    ''' Converts a csv stream to a spilled table, one block at a time
+
+    Column types are inferred from the first block of block_size bytes, unless given in dtype.
+
+    Parameters:
+        stream:
+            A file-like object of csv bytes, e.g. a sciserver.utils.ResponseStream.  Leading lines
+            starting with # are skipped.
+        delimiter (str):
+            The field delimiter
+        columns (list):
+            The columns to keep, or None for all
+        dtype (dict):
+            Numpy dtypes of columns, by name
+
+    Returns:
+        a SpilledTable
+
+    '''
+    pyarrow, csv, ipc = _pyarrow()
+    while stream.peek(1) == b'#':
+        stream.readline()
+    types = {name: pyarrow.from_numpy_dtype(val) for name, val in (dtype or {}).items() if val != 'object'}
+    reader = csv.open_csv(stream, read_options=csv.ReadOptions(block_size=block_size),
+                          parse_options=csv.ParseOptions(delimiter=delimiter),
+                          convert_options=csv.ConvertOptions(include_columns=columns, column_types=types))
+    return _write(reader.schema, reader)
+
+
+def spill_rows(columns, rows, batch_rows=65536):
+    ''' Converts rows to a spilled table, batch_rows at a time
+
+    Column types are those pandas infers for the first batch.  Columns with no values in
+    the first batch are stored as strings.
+
+    Parameters:
+        columns (list):
+            The column names
+        rows (iterable):
+            The rows, as sequences of values
+        batch_rows (int):
+            The number of rows converted at a time
+
+    Returns:
+        a SpilledTable
+
+    '''
+    def frames():
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) == batch_rows:
+                yield pandas.DataFrame(batch, columns=columns)
+                batch = []
+        if batch:
+            yield pandas.DataFrame(batch, columns=columns)
+
+    return spill_frames(frames(), columns=columns)
+
+
+def spill_frames(frames, columns=None):
+    ''' Converts DataFrames with the same columns, e.g. the pages of a result, to a spilled table
+
+    Column types are those of the first DataFrame.  Columns with no values in it are stored
+    as strings.
+
+    Parameters:
+        frames (iterable):
+            The DataFrames, converted and freed one at a time
+        columns (list):
+            The column names, for an empty table if there are no frames
+
+    Returns:
+        a SpilledTable
+
+    '''
+    pyarrow, csv, ipc = _pyarrow()
+    tables = (pyarrow.Table.from_pandas(frame, preserve_index=False) for frame in frames)
+    first = next(tables, None)
+    if first is None:
+        first = pyarrow.Table.from_pandas(pandas.DataFrame([], columns=columns), preserve_index=False)
+    schema = pyarrow.schema([pyarrow.field(field.name, pyarrow.string()) if field.type == pyarrow.null() else field
+                             for field in first.schema])
+
+    def cast(table):
+        try:
+            return table.cast(schema)
+        except (pyarrow.ArrowInvalid, pyarrow.ArrowNotImplementedError) as e:
+            raise SciServerError('Column types of the result changed between batches, so it cannot be '
+                                 'spilled: {0}'.format(e))
+
+    return _write(schema, (cast(table) for table in itertools.chain([first], tables)))
+
+
+class _SpillFile(object):
+    ''' A spill file, removed when no table uses it anymore '''
+
+    def __init__(self, path, delete):
+        self.path = path
+        self.delete = delete
+
+    def __del__(self):
+        if self.delete:
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+
+
+class SpilledTable(object):
+    ''' A query result stored in a local Arrow IPC file, memory-mapped and loaded lazily
+
+    Supports the DataFrame operations used to access and filter results: table['col'] returns
+    a column as a Series, table[['a', 'b']] a DataFrame of columns, table[mask] a DataFrame of the
+    rows where the boolean mask is True, and table[start:stop] a DataFrame of rows.  Only the
+    parts of the file that are used are read, by the operating system, as they are accessed.
+    Spill files are removed when the tables using them are garbage collected.
+
+    Parameters:
+        path (str):
+            The path of an uncompressed Arrow IPC (Feather v2) file
+        delete (bool):
+            If True, removes the file once the table and its copies are garbage collected
+
+    Example:
+        >>> table = SpilledTable('photo.arrow')
+        >>> table[table['type'] == 6][['ra', 'dec']]
+
+    '''
+
+    def __init__(self, path, delete=False):
+        pyarrow, csv, ipc = _pyarrow()
+        self._file = path if isinstance(path, _SpillFile) else _SpillFile(path, delete)
+        self.path = self._file.path
+        self._table = ipc.open_file(pyarrow.memory_map(self.path)).read_all()
+
+    def __repr__(self):
+        return '<SpilledTable(path={0!r}, rows={1}, columns={2})>'.format(self.path, len(self), len(self.columns))
+
+    def __len__(self):
+        return self._table.num_rows
+
+    def __iter__(self):
+        return iter(self.columns)
+
+    def __contains__(self, name):
+        return name in self.columns
+
+    def __getattr__(self, name):
+        if name.startswith('_') or name not in self._table.column_names:
+            raise AttributeError(name)
+        return self[name]
+
+    def __getitem__(self, key):
+        if isinstance(key, _STRINGS):
+            return self._table.column(key).to_pandas().rename(key)
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            if step != 1:
+                return self.to_pandas()[key]
+            return self._table.slice(start, stop - start).to_pandas()
+        key = list(key) if not hasattr(key, 'dtype') else key
+        if len(key) and all(isinstance(name, _STRINGS) for name in key):
+            return self.to_pandas(columns=key)
+        return self.filter(key)
+
+    @property
+    def columns(self):
+        ''' The column names, as a pandas Index '''
+        return pandas.Index(self._table.column_names)
+
+    @property
+    def dtypes(self):
+        ''' The pandas dtypes of the columns '''
+        return pandas.Series([field.type.to_pandas_dtype() for field in self._table.schema], index=self.columns)
+
+    @property
+    def shape(self):
+        return (len(self), self._table.num_columns)
+
+    @property
+    def nbytes(self):
+        ''' The size of the spill file in bytes '''
+        return os.path.getsize(self.path)
+
+    def copy(self):
+        ''' Returns another table over the same file, as results are read-only '''
+        return SpilledTable(self._file)
+
+    def filter(self, mask, columns=None):
+        ''' Returns a DataFrame of the rows where mask is True
+
+        Parameters:
+            mask:
+                A boolean Series, array or list with one value per row
+            columns (list):
+                The columns to load, or None for all
+
+        '''
+        pyarrow, csv, ipc = _pyarrow()
+        mask = pyarrow.array(pandas.Series(mask).to_numpy(dtype=bool))
+        table = self._table.select(columns) if columns is not None else self._table
+        return table.filter(mask).to_pandas()
+
+    def head(self, n=5):
+        ''' Returns the first n rows as a DataFrame '''
+        return self._table.slice(0, n).to_pandas()
+
+    def to_pandas(self, columns=None):
+        ''' Loads the table, or some of its columns, into a DataFrame '''
+        table = self._table.select(columns) if columns is not None else self._table
+        return table.to_pandas()
+
+    def to_arrow(self):
+        ''' Returns the memory-mapped Arrow table '''
+        return self._table
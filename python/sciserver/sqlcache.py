@@ -0,0 +1,353 @@
+# !usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Licensed under a 3-clause BSD license.
+#
+
+from __future__ import print_function, division, absolute_import
+from collections import OrderedDict
+from io import StringIO, BytesIO
+import copy
+import hashlib
+import re
+import threading
+import time
+from sciserver import config
+
+# tokens of a SQL statement, in order of precedence
+_TOKENS = re.compile(r'''
+    (?P<comment>--[^\n]*|/\*.*?\*/)
+  | (?P<string>[Nn]?'(?:[^']|'')*')
+  | (?P<quoted>\[[^\]]*\]|"(?:[^"]|"")*")
+  | (?P<number>(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?)
+  | (?P<word>[@#]{0,2}[A-Za-z_][\w$@#]*)
+  | (?P<space>\s+)
+  | (?P<symbol><>|!=|>=|<=|\|\||.)
+''', re.VERBOSE | re.DOTALL)
+
+KEYWORDS = set('''
+    ADD ALL ALTER AND ANY AS ASC BETWEEN BY CASE CAST CONVERT CREATE CROSS DECLARE DEFAULT DELETE DESC
+    DISTINCT DROP ELSE END ESCAPE EXCEPT EXEC EXECUTE EXISTS FROM FULL GROUP HAVING IN INNER INSERT
+    INTERSECT INTO IS JOIN LEFT LIKE LIMIT NOT NULL OF OFFSET ON OR ORDER OUTER OVER PARTITION PERCENT
+    RIGHT SELECT SET SOME TABLE THEN TIES TOP TRUNCATE UNION UPDATE USING VALUES WHEN WHERE WITH
+    APPLY ROWS FETCH NEXT ONLY FIRST COUNT SUM AVG MIN MAX XMATCH REGION POINT MUST MAY NEVER
+    BAYESFACTOR
+'''.split())
+
+# keywords of statements that may modify data
+WRITE_KEYWORDS = set('''
+    INSERT UPDATE DELETE DROP CREATE ALTER TRUNCATE INTO EXEC EXECUTE DECLARE SET
+'''.split())
+
+# non-deterministic functions
+NONDETERMINISTIC = set('''
+    GETDATE GETUTCDATE SYSDATETIME CURRENT_TIMESTAMP NEWID RAND
+'''.split())
+
+# databases users write to, whose query results are never cached
+MUTABLE_CONTEXTS = set(['MYDB'])
+
+# the default number of seconds a cached result stays valid
+DEFAULT_TTL = 3600.
+
+
+def _canonical_number(token):
+    ''' Canonicalizes a numeric literal without changing its SQL type or scale '''
+    if 'e' in token.lower():
+        # approximate (float) literals with the same value are identical
+        return repr(float(token))
+    if '.' in token:
+        whole, frac = token.split('.', 1)
+        return '{0}.{1}'.format(whole.lstrip('0') or '0', frac)
+    return token.lstrip('0') or '0'
+
+
+def tokenize(sql):
+    ''' Splits a SQL statement into normalized tokens
+
+    Comments and whitespace are dropped, keywords are upper-cased, numeric literals
+    are canonicalized, and string literals and identifiers are kept as they are.
+
+    Parameters:
+        sql (str):
+            the sql query string
+
+    Returns:
+        a list of tokens
+
+    '''
+    tokens = []
+    for match in _TOKENS.finditer(sql):
+        kind = match.lastgroup
+        token = match.group()
+        if kind in ('comment', 'space'):
+            continue
+        elif kind == 'string':
+            token = "N" + token[1:] if token[0] in 'Nn' else token
+        elif kind == 'number':
+            token = _canonical_number(token)
+        elif kind == 'word' and token.upper() in KEYWORDS:
+            token = token.upper()
+        tokens.append(token)
+
+    # a trailing statement terminator does not change the query
+    while tokens and tokens[-1] == ';':
+        tokens.pop()
+    return tokens
+
+
+def normalize_sql(sql):
+    ''' Normalizes a SQL statement
+
+    Statements that differ only in whitespace, comments, keyword case or the formatting
+    of numeric literals have the same normalized form.
+
+    Parameters:
+        sql (str):
+            the sql query string
+
+    Returns:
+        the normalized sql string
+
+    Example:
+        >>> normalize_sql("select  top 10 ra /* coordinates */ from PhotoObj where r < 017.50;")
+        'SELECT TOP 10 ra FROM PhotoObj WHERE r < 17.50'
+
+    '''
+    return ' '.join(tokenize(sql))
+
+
+def fingerprint(sql, *context):
+    ''' Returns a fingerprint of a SQL statement
+
+    Parameters:
+        sql (str):
+            the sql query string
+        context:
+            any other values the query result depends on, e.g. the database context
+
+    Returns:
+        a hex digest identifying the normalized query and its context
+
+    '''
+    key = '\x00'.join([normalize_sql(sql)] + [str(c) for c in context])
+    return hashlib.sha1(key.encode('utf8')).hexdigest()
+
+
+def is_readonly(sql):
+    ''' Checks whether a SQL statement only reads data, and so is safe to send again '''
+    return not any(token.upper() in WRITE_KEYWORDS for token in tokenize(sql))
+
+
+def _names(tokens):
+    return [token.strip('[]"').upper() for token in tokens]
+
+
+def is_cacheable(sql, context=None):
+    ''' Checks whether the result of a SQL statement can be cached
+
+    Statements that modify data, use non-deterministic functions, or read a database users
+    write to (MyDB), either as their context or by name, are not cacheable.
+
+    Parameters:
+        sql (str):
+            the sql query string
+        context (str):
+            the database context of the query, if any
+
+    '''
+    if context is not None and str(context).upper() in MUTABLE_CONTEXTS:
+        return False
+    return not any(name in WRITE_KEYWORDS | NONDETERMINISTIC | MUTABLE_CONTEXTS for name in _names(tokenize(sql)))
+
+
+def _copy_result(value):
+    ''' Returns a copy of a query result, so cached results cannot be modified by callers '''
+    if hasattr(value, 'copy') and hasattr(value, 'columns'):
+        return value.copy()
+    elif isinstance(value, StringIO):
+        return StringIO(value.getvalue())
+    elif isinstance(value, BytesIO):
+        return BytesIO(value.getvalue())
+    elif isinstance(value, (dict, list)):
+        return copy.deepcopy(value)
+    return value
+
+
+class QueryCache(object):
+    ''' A thread-safe LRU cache of query results keyed by SQL fingerprint
+
+    Parameters:
+        maxsize (int):
+            The maximum number of cached results.  Default is 128.
+        ttl (float):
+            The number of seconds a result stays valid, or None for ever.  Default is 3600.
+
+    Attributes:
+        hits (int):
+            The number of cache hits
+        misses (int):
+            The number of cache misses
+
+    Example:
+        >>> cache = enable_cache(maxsize=256, ttl=3600)
+        >>> df = CasJobs().executeQuery('select top 10 * from PhotoObj')
+        >>> cache.stats()
+
+    '''
+
+    def __init__(self, maxsize=128, ttl=DEFAULT_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return '<QueryCache(size={0}, maxsize={1}, hits={2}, misses={3})>'.format(
+            len(self), self.maxsize, self.hits, self.misses)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        with self._lock:
+            return self._valid(key)
+
+    def _valid(self, key):
+        if key not in self._data:
+            return False
+        if self.ttl is not None and time.time() - self._data[key]['time'] > self.ttl:
+            del self._data[key]
+            return False
+        return True
+
+    def get(self, key, default=None):
+        ''' Returns a copy of the cached result for a key, or default if missing '''
+        with self._lock:
+            if not self._valid(key):
+                self.misses += 1
+                return default
+            self.hits += 1
+            entry = self._data.pop(key)
+            self._data[key] = entry
+            value = entry['value']
+        return _copy_result(value)
+
+    def set(self, key, value, sql=None):
+        ''' Caches a copy of a result under a key '''
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = {'value': _copy_result(value), 'time': time.time(),
+                               'sql': normalize_sql(sql) if sql else None}
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        ''' Removes a key from the cache '''
+        with self._lock:
+            entry = self._data.pop(key, None)
+        return entry['value'] if entry else default
+
+    def invalidate(self, table):
+        ''' Removes the results of queries that read a table, e.g. after it is modified
+
+        Parameters:
+            table (str):
+                the table name
+
+        Returns:
+            the number of results removed
+
+        '''
+        name = table.strip('[]"').upper()
+        with self._lock:
+            keys = [key for key, entry in self._data.items()
+                    if entry['sql'] is None or name in _names(entry['sql'].split())]
+            for key in keys:
+                del self._data[key]
+        return len(keys)
+
+    def clear(self):
+        ''' Empties the cache and resets the counters '''
+        with self._lock:
+            self._data.clear()
+            self.hits = self.misses = 0
+
+    def fingerprints(self):
+        ''' Returns the cached fingerprints, mapped to their normalized sql '''
+        with self._lock:
+            return OrderedDict((key, entry['sql']) for key, entry in self._data.items())
+
+    def stats(self):
+        ''' Returns the cache size, hit and miss counts, and hit rate '''
+        total = self.hits + self.misses
+        return {'size': len(self), 'hits': self.hits, 'misses': self.misses,
+                'hitrate': self.hits / float(total) if total else 0.0}
+
+
+def enable_cache(maxsize=128, ttl=DEFAULT_TTL):
+    ''' Enables query result caching for all services
+
+    Parameters:
+        maxsize (int):
+            The maximum number of cached results.  Default is 128.
+        ttl (float):
+            The number of seconds a result stays valid, or None for ever.  Default is 3600.
+
+    Returns:
+        the new QueryCache, also set as config.queryCache
+
+    '''
+    config.queryCache = QueryCache(maxsize=maxsize, ttl=ttl)
+    return config.queryCache
+
+
+def disable_cache():
+    ''' Disables query result caching '''
+    config.queryCache = None
+
+
+def invalidate(table):
+    ''' Removes the cached results of queries that read a table, e.g. after uploading to it '''
+    if config.queryCache is not None:
+        config.queryCache.invalidate(table)
+
+
+def cache_key(sql, *context):
+    ''' Returns the cache key of a query in a context, for the current user
+
+    Results are keyed by the user's token, so users never see each other's results.
+    '''
+    return fingerprint(sql, config.token or '', *context)
+
+
+def cached_query(sql, context, compute, cache=True, database=None):
+    ''' Returns a query result from the cache, or computes and caches it
+
+    Parameters:
+        sql (str):
+            the sql query string
+        context (tuple):
+            any other values the query result depends on
+        compute (callable):
+            function returning the result when it is not cached
+        cache (bool):
+            if False, bypasses the cache
+        database (str):
+            the database context of the query, as queries of MyDB are never cached
+
+    '''
+    qcache = config.queryCache
+    if not cache or qcache is None or not is_cacheable(sql, database):
+        return compute()
+
+    key = cache_key(sql, *context)
+    missing = object()
+    result = qcache.get(key, missing)
+    if result is missing:
+        result = compute()
+        if result is not None:
+            qcache.set(key, result, sql=sql)
+    return result
@@ -10,6 +10,7 @@
 
 from __future__ import print_function, division, absolute_import
 import pytest
+import requests
 import os
 from sciserver import config
 from sciserver.authentication import Authentication
@@ -90,4 +91,34 @@ def token(auth):
     token = None
 
 
+class FakeResponse(object):
+    ''' A minimal stand-in for a streamed requests response '''
 
+    def __init__(self, content, chunk_size=7, status_code=200, headers=None):
+        self.content = content
+        self.status_code = status_code
+        self.ok = status_code < 400
+        self.headers = headers or {}
+        self.closed = False
+        self._chunk_size = chunk_size
+
+    def iter_content(self, chunk_size=1):
+        for i in range(0, len(self.content), self._chunk_size):
+            yield self.content[i:i + self._chunk_size]
+
+    def json(self):
+        import json
+        return json.loads(self.content.decode())
+
+    def raise_for_status(self):
+        if not self.ok:
+            raise requests.HTTPError('{0} Error'.format(self.status_code), response=self)
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture()
+def fake_response():
+    ''' Fixture returning the FakeResponse class '''
+    return FakeResponse
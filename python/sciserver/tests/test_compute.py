@@ -13,7 +13,9 @@ import pytest
 import os
 import pandas
 from io import StringIO
-from sciserver.compute import Job
+from sciserver import config
+from sciserver.casjobs import CasJobs
+from sciserver.compute import Compute, Job, JobSet, JobTable
 
 Compute_TestTableName1 = "table1"
 Compute_TestDatabase = "MyDB"
@@ -32,6 +34,27 @@ def job(comp):
     job = None
 
 
+@pytest.fixture()
+def offline_comp(monkeypatch):
+    ''' A Compute instance that does not talk to the server when submitting jobs '''
+    domains = [{'name': 'Quick (short)', 'id': 6}, {'name': 'Long (long)', 'id': 7}]
+    monkeypatch.setattr(config, 'token', 'testtoken')
+    monkeypatch.setattr(Compute, 'retrieveDomains', lambda self: domains)
+    comp = Compute()
+    submitted = []
+
+    def submit(job):
+        if 'fail' in job['inputSql']:
+            raise ValueError('bad query')
+        submitted.append(job)
+        return len(submitted)
+
+    monkeypatch.setattr(comp, '_submit_job_input', submit)
+    comp.submitted = submitted
+    yield comp
+    comp = None
+
+
 @pytest.mark.usefixtures('token')
 class TestCompute(object):
 
@@ -94,3 +117,173 @@ class TestJob(object):
         testdf = pandas.read_csv(StringIO(Compute_TestResults))
         assert df.loc[:0]['z'][0] == testdf['z'][0]
 
+
+class TestBatchSubmit(object):
+
+    def test_parse_spec(self, offline_comp):
+        kwargs = offline_comp._parse_spec(('select 1', 'MyDB', {'target_type': 'TABLE', 'tablename': 't1'}))
+        assert kwargs == {'sql': 'select 1', 'context': 'MyDB', 'target_type': 'TABLE',
+                          'tablename': 't1', 'queue': 'quick'}
+        kwargs = offline_comp._parse_spec({'sql': 'select 1', 'queue': 'short'})
+        assert kwargs['queue'] == 'quick'
+
+    def test_submitQueries(self, offline_comp):
+        specs = [('select {0}'.format(i), 'MyDB', 'FILE') for i in range(6)]
+        specs.append({'sql': 'select fail', 'queue': 'long'})
+        jobset = offline_comp.submitQueries(specs, max_inflight={'quick': 2}, rate=100, burst=10)
+        assert isinstance(jobset, JobSet)
+        assert len(jobset) == 7
+        assert len(jobset.submitted) == 6
+        assert jobset[6] is None
+        assert isinstance(jobset.errors[6], ValueError)
+        assert offline_comp.targets == []
+        domains = set(job['rdbDomainId'] for job in offline_comp.submitted)
+        assert domains == set([6])
+
+
+def make_jobinfo(jobid, status=32):
+    return {'id': jobid, 'status': status, 'submissionTime': jobid * 1000., 'startTime': jobid * 1000.}
+
+
+class TestJobListing(object):
+
+    @pytest.fixture()
+    def history(self, offline_comp, monkeypatch):
+        jobs = [make_jobinfo(i) for i in range(250, 0, -1)]
+        jobs[1]['status'] = 8
+        requests = []
+
+        def fetch(start=0, top=100, onlyopen=None):
+            requests.append((start, top, onlyopen))
+            return jobs[start:start + top]
+
+        monkeypatch.setattr(offline_comp, '_fetch_job_page', fetch)
+        offline_comp.requests = requests
+        yield jobs
+
+    def test_iterJobs_stops_early(self, offline_comp, history):
+        jobs = offline_comp.getJobs(limit=5)
+        assert [j.id for j in jobs] == [250, 249, 248, 247, 246]
+        assert offline_comp.requests == [(0, 5, None)]
+
+    def test_getJobs_since(self, offline_comp, history):
+        jobs = offline_comp.getJobs(since=241)
+        assert len(jobs) == 10
+        assert len(offline_comp.requests) == 1
+
+    def test_getJobs_status(self, offline_comp, history):
+        jobs = offline_comp.getJobs(status='STARTED')
+        assert [j.id for j in jobs] == [249]
+        assert offline_comp.requests[0][2] is True
+
+    def test_index_incremental(self, offline_comp, history):
+        jobs = offline_comp.getJobs()
+        assert len(jobs) == 250
+        assert offline_comp.jobindex.floor == 248
+        assert len(offline_comp.requests) == 3
+
+        del offline_comp.requests[:]
+        jobs = offline_comp.getJobs()
+        assert len(jobs) == 250
+        assert [j.id for j in jobs[:3]] == [250, 249, 248]
+        assert offline_comp.requests == [(0, 100, None)]
+
+
+class TestJobRecord(object):
+
+    def test_job_attributes(self):
+        info = make_jobinfo(5, status=32)
+        info['inputSql'] = 'select 1'
+        job = Job(info)
+        assert job.inputSql == 'select 1'
+        assert job.status == 'SUCCESS'
+        assert job.submissionTime.year == 1970
+        assert info['submissionTime'] == 5000.
+        assert not hasattr(job, '__dict__')
+        with pytest.raises(AttributeError):
+            job.notakey
+
+    def test_to_dict_is_copy(self):
+        info = make_jobinfo(5, status=8)
+        job = Job(info)
+        jobdict = job.to_dict()
+        jobdict['id'] = 10
+        assert job.id == 5
+        assert jobdict['status'] == 'STARTED'
+
+    def test_jobtable(self):
+        infos = [make_jobinfo(i) for i in range(1, 4)]
+        infos[0]['inputSql'] = 'select 1'
+        table = JobTable(infos)
+        assert len(table) == 3
+        assert table[0].inputSql == 'select 1'
+        assert table[0].to_dict()['id'] == 1
+        assert list(table.column('id')) == [1, 2, 3]
+        assert table.column('inputSql') == ['select 1', None, None]
+        df = table.to_dataframe()
+        assert list(df['id']) == [1, 2, 3]
+        assert list(df['status']) == ['SUCCESS'] * 3
+        assert str(df['submissionTime'].dtype).startswith('datetime64')
+
+    def test_loadDataFrame_streamed(self, monkeypatch, fake_response):
+        info = make_jobinfo(5)
+        info.update({'resultsFolderURI': '/results/', 'targets': [{'type': 'FILE_CSV', 'location': 'r.csv'}]})
+        job = Job(info)
+        response = fake_response(Compute_TestResults.encode() + b'\n')
+        monkeypatch.setattr(config, 'KeystoneTokenPath', '/nonexistent/keystone.token')
+        monkeypatch.setattr(Job, 'retrieveData', lambda self, stream=False: response)
+        df = job.loadDataFrame()
+        assert df['petroflux_el'][0].startswith('{18.78')
+        assert job.result_path == 'results/r.csv'
+
+    def test_loadDataFrame_workspace(self, monkeypatch, tmpdir):
+        info = make_jobinfo(5)
+        info.update({'resultsFolderURI': '/results/', 'targets': [{'type': 'FILE_CSV', 'location': 'r.csv'}]})
+        job = Job(info)
+        tmpdir.join('keystone.token').write('token')
+        tmpdir.mkdir('workspace').mkdir('results').join('r.csv').write(Compute_TestResults + '\n')
+        monkeypatch.setattr(config, 'KeystoneTokenPath', str(tmpdir.join('keystone.token')))
+        monkeypatch.setattr(config, 'computeWorkspace', str(tmpdir.join('workspace')))
+        monkeypatch.setattr(Job, 'retrieveData', lambda self, stream=False: pytest.fail('results downloaded'))
+        df = job.loadDataFrame()
+        assert df['petroflux_el'][0].startswith('{18.78')
+        assert len(df) == 1
+
+    def test_upload_streamed(self, monkeypatch, fake_response):
+        info = make_jobinfo(5)
+        info.update({'resultsFolderURI': '/results/', 'targets': [{'type': 'FILE_CSV', 'location': 'r.csv'}]})
+        job = Job(info)
+        response = fake_response(b'a,b\n1,2\n')
+        uploads = []
+
+        def upload(self, csvData, tableName, context='MyDB'):
+            uploads.append((b''.join(csvData), tableName, context))
+            return True
+
+        monkeypatch.setattr(Job, 'retrieveData', lambda self, stream=False: response)
+        monkeypatch.setattr(CasJobs, 'uploadCSVDataToTable', upload)
+        assert job.upload('newtable', context='OtherDB') is True
+        assert uploads == [(b'a,b\n1,2\n', 'newtable', 'OtherDB')]
+        assert job.upload_stats['bytes'] == 8
+        assert job.upload_stats['mode'] == 'stream'
+        assert response.closed is True
+
+    def test_upload_table_target(self):
+        info = make_jobinfo(5)
+        info['targets'] = [{'type': 'FILE_CSV', 'location': 'r.csv'}, {'type': 'TABLE', 'location': 'mytable'}]
+        job = Job(info)
+        assert job.upload('mytable') is True
+        assert job.upload_stats['mode'] == 'server'
+
+    def test_upload_failed(self):
+        info = make_jobinfo(6, status=64)
+        info['targets'] = [{'type': 'TABLE', 'location': 'mytable'}]
+        job = Job(info)
+        assert job.status == 'ERROR'
+        with pytest.raises(AssertionError, match='successful'):
+            job.upload('mytable')
+        assert job.upload_stats is None
+
+    def test_multiple_targets(self, offline_comp):
+        job = offline_comp._create_job_input('select 1', target_type=['FILE', 'TABLE'], tablename='t1')
+        assert [t['type'] for t in job['targets']] == ['FILE_CSV', 'TABLE']
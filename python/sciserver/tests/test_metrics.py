@@ -0,0 +1,170 @@
+# !usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Licensed under a 3-clause BSD license.
+#
+
+from __future__ import print_function, division, absolute_import
+import pandas
+import pytest
+from sciserver import config, metrics
+from sciserver.casjobs import CasJobs
+from sciserver.exceptions import SciServerAPIError
+from sciserver.mockserver import MockServer
+from sciserver.skyserver import SkyServer, pyarrow
+from sciserver.transport import Transport, MemorySession, RetryPolicy, set_transport
+from sciserver.utils import send_request, ResponseStream
+
+CSV_PARSER = 'pyarrow.csv' if pyarrow is not None else 'pandas.read_csv'
+
+
+@pytest.fixture()
+def memory(monkeypatch):
+    monkeypatch.setattr(config, 'token', 'testtoken')
+    session = MemorySession()
+    session.add('get', r'/jobs/\d+$', {'status': 'completed'})
+    session.add('get', r'/missing$', 'gone', status_code=404)
+    session.add('get', r'/table$', b'a,b\n1,2\n' * 100)
+    previous = set_transport(Transport(session=session, retry=RetryPolicy(backoff=0.001)))
+    registry = metrics.enable_metrics()
+    yield session, registry
+    metrics.disable_metrics()
+    set_transport(previous)
+
+
+@pytest.fixture()
+def events():
+    received = []
+
+    def hook(event, info):
+        received.append((event, dict(info)))
+
+    for event in metrics.EVENTS:
+        metrics.add_hook(event, hook)
+    yield received
+    for event in metrics.EVENTS:
+        metrics.remove_hook(event, hook)
+
+
+class TestMetrics(object):
+
+    def test_endpoint(self):
+        assert metrics.endpoint('http://test/Jobs.svc/jobs/12345?x=1') == '/Jobs.svc/jobs/{id}'
+        assert metrics.endpoint('http://test/tokens/0123456789abcdef0123456789abcdef') == '/tokens/{id}'
+        assert metrics.endpoint('http://test/contexts/MyDB/query') == '/contexts/MyDB/query'
+
+    def test_registry(self, memory):
+        session, registry = memory
+        with metrics.task('jobs'):
+            for jobid in (1, 2, 3):
+                send_request('http://test/jobs/{0}'.format(jobid))
+        with pytest.raises(SciServerAPIError):
+            send_request('http://test/missing')
+
+        hist = registry.histogram('request_seconds', endpoint='/jobs/{id}', method='get', task='jobs')
+        assert hist['count'] == 3 and hist['buckets'][-1] == (float('inf'), 3)
+        assert registry.counter('requests_total', endpoint='/jobs/{id}', method='get', status='200') == 3
+        assert registry.counter('requests_total', endpoint='/missing', method='get', status='404') == 1
+        assert registry.counter('received_bytes_total', endpoint='/jobs/{id}') == 3 * len(b'{"status": "completed"}')
+        assert registry.quantile('request_seconds', 0.5, endpoint='/jobs/{id}', method='get', task='jobs') == 0.005
+
+    def test_stream_and_retry(self, memory, events):
+        session, registry = memory
+        with ResponseStream(send_request('http://test/table', stream=True)) as stream:
+            stream.read()
+        assert registry.counter('received_bytes_total', endpoint='/table') == 800
+
+        statuses = [503]
+        session.add('get', r'/flaky$', lambda method, url, headers, body: (statuses.pop() if statuses else 200, b'ok'))
+        send_request('http://test/flaky')
+        assert registry.counter('retries_total', endpoint='/flaky', reason='503') == 1
+        names = [event for event, info in events]
+        assert names == ['request_start', 'request_end', 'response_read', 'request_start', 'retry', 'request_end']
+        assert events[-1][1]['status'] == 200
+
+    def test_prometheus(self, memory):
+        session, registry = memory
+        send_request('http://test/jobs/1')
+        text = registry.to_prometheus()
+        assert '# TYPE sciserver_request_seconds histogram' in text
+        assert 'sciserver_request_seconds_bucket{endpoint="/jobs/{id}",method="get",task="",le="+Inf"} 1' in text
+        assert 'sciserver_requests_total{endpoint="/jobs/{id}",method="get",status="200"} 1' in text
+
+    def test_failing_hook(self, memory):
+        def hook(event, info):
+            raise ValueError('broken hook')
+
+        metrics.add_hook('request_end', hook)
+        try:
+            with pytest.warns(Warning, match='broken hook'):
+                assert send_request('http://test/jobs/1').ok
+        finally:
+            metrics.remove_hook('request_end', hook)
+
+    def test_parse(self, events):
+        previous = set_transport(Transport())
+        try:
+            with MockServer(rows=10):
+                SkyServer().sqlSearch('select objid from PhotoObj', cache=False)
+        finally:
+            set_transport(previous)
+        parse = [info for event, info in events if event == 'parse']
+        assert parse[0]['parser'] == CSV_PARSER
+        assert parse[0]['task'].endswith('SkyServer.sqlSearch')
+        request = [info for event, info in events if event == 'request_end'][0]
+        assert request['endpoint'] == '/DR13/SkyServerWS/SearchTools/SqlSearch'
+        assert request['wait'] <= request['elapsed']
+
+    def test_profile_memory(self):
+        pytest.importorskip('tracemalloc')
+        previous = set_transport(Transport())
+        try:
+            with MockServer(rows=2000), metrics.profile_memory() as profile:
+                CasJobs().executeQuery('select top 2000 * from PhotoObj', cache=False)
+                SkyServer().sqlSearch('select top 2000 * from PhotoObj', cache=False)
+        finally:
+            set_transport(previous)
+        calls = [call['call'].split('.')[-1] for call in profile.calls]
+        assert calls == ['executeQuery', 'sqlSearch']
+        stages = [stage['stage'] for stage in profile.calls[0]['stages']]
+        assert stages == ['download', 'decode', 'json.loads', 'DataFrame']
+        assert profile.calls[0]['stages'][2]['peak'] > 0
+        assert 'json.loads' in profile.report()
+        assert len(profile.records()) == 6
+
+    def test_stream_threshold(self, events, monkeypatch):
+        previous = set_transport(Transport())
+        try:
+            with MockServer(rows=10):
+                whole = SkyServer().sqlSearch('select objid, ra from PhotoObj', cache=False)
+                monkeypatch.setattr(config, 'streamThreshold', 100)
+                streamed = SkyServer().sqlSearch('select objid, ra from PhotoObj', cache=False)
+                df = CasJobs().executeQuery('select objid, ra from PhotoObj', cache=False)
+        finally:
+            set_transport(previous)
+        pandas.testing.assert_frame_equal(whole, streamed)
+        assert len(df) == 10
+        parsers = [info['parser'] for event, info in events if event == 'parse']
+        assert parsers == [CSV_PARSER, 'pandas.read_csv (streamed)', 'executeQuery.pandas']
+
+    def test_opentelemetry(self, memory):
+        pytest.importorskip('opentelemetry.sdk')
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import SimpleSpanProcessor
+        from opentelemetry.sdk.trace.export.in_memory_span_exporter import InMemorySpanExporter
+
+        exporter = InMemorySpanExporter()
+        provider = TracerProvider()
+        provider.add_span_processor(SimpleSpanProcessor(exporter))
+        hook = metrics.enable_opentelemetry(provider.get_tracer('test'))
+        try:
+            send_request('http://test/jobs/7')
+            with pytest.raises(SciServerAPIError):
+                send_request('http://test/missing')
+        finally:
+            metrics.disable_opentelemetry(hook)
+
+        spans = exporter.get_finished_spans()
+        assert [span.name for span in spans] == ['GET /jobs/{id}', 'GET /missing']
+        assert spans[0].attributes['http.status_code'] == 200
+        assert not spans[1].status.is_ok
@@ -0,0 +1,110 @@
+# !usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Licensed under a 3-clause BSD license.
+#
+
+from __future__ import print_function, division, absolute_import
+import os
+import time
+import pandas
+import pytest
+from sciserver import config
+from sciserver.authentication import Authentication
+from sciserver.casjobs import CasJobs
+from sciserver.compute import Compute
+from sciserver.exceptions import SciServerError, SciServerAPIError
+from sciserver.mockserver import MockServer
+from sciserver.scidrive import SciDrive
+from sciserver.skyquery import SkyQuery
+from sciserver.skyserver import SkyServer
+from sciserver.transport import Transport, RetryPolicy, set_transport
+
+
+@pytest.fixture()
+def server():
+    previous = set_transport(Transport(retry=RetryPolicy(backoff=0.001)))
+    with MockServer(rows=50, job_duration=0.2) as server:
+        yield server
+    set_transport(previous)
+
+
+class TestMockServer(object):
+
+    def test_authentication(self, server, tmpdir):
+        auth = Authentication(token=config.token)
+        assert auth.getKeystoneUserWithToken().userName == 'mockuser'
+        netrc = tmpdir.join('netrc')
+        netrc.write('machine {0} login user password pass\n'.format(auth.portal_host))
+        os.chmod(str(netrc), 0o600)
+        auth.netrcpath = str(netrc)
+        assert auth.login() == server.token
+
+    def test_casjobs(self, server):
+        cas = CasJobs()
+        df = cas.executeQuery('select top 7 objid, ra, dec from PhotoObj', cache=False)
+        assert len(df) == 7 and list(df.columns)[:3] == ['objid', 'ra', 'dec']
+        assert len(cas.executeQuery('select objid from PhotoObj', outformat='csv').splitlines()) == 51
+        assert cas.getSchemaName() == 'wsid_123456789'
+
+        jobid = cas.submitJob('select 1')
+        assert cas.getJobStatus(jobid)['Status'] == 0
+        assert cas.waitForJob(jobid, verbose=False)['Status'] == 5
+        assert cas.uploadPandasDataFrameToTable(df, 'uploaded')
+        assert cas.getTables()[0]['Rows'] == 7
+
+    def test_skyserver(self, server):
+        sky = SkyServer()
+        assert len(sky.sqlSearch('select top 12 objid from PhotoObj')) == 12
+        assert len(sky.radialSearch(ra=258.25, dec=64.05, limit='3')) == 3
+        assert sky.getJpegImgCutout(ra=197.6, dec=18.4, width=16, height=8).shape == (8, 16, 3)
+
+    def test_skyquery(self, server):
+        skyquery = SkyQuery()
+        guid = skyquery.submitJob('select top 5 objid into MyDB.results from PhotoObj', cache=False)
+        assert skyquery.waitForJob(guid, verbose=False, poll=0.05)['status'] == 'completed'
+        assert [queue['name'] for queue in skyquery.listQueues()] == ['quick', 'long']
+
+        df = pandas.DataFrame({'a': range(10), 'b': list('abcdefghij')})
+        assert skyquery.uploadTable(df, 'mytable', batch_rows=4)
+        assert skyquery.getTable('mytable', top=3, skip=2)['a'].tolist() == [2, 3, 4]
+        assert len(skyquery.getTable('PhotoObj')) == 50
+
+    def test_scidrive(self, server):
+        drive = SciDrive()
+        assert drive.createContainer('data')
+        drive.upload('data/test.csv', data='a,b\n1,2\n')
+        assert drive.download('data/test.csv') == 'a,b\n1,2\n'
+        assert [item['path'] for item in drive.directoryList('data')['contents']] == ['/data/test.csv']
+        assert drive.delete('data')
+        assert not server.files
+
+    def test_compute(self, server):
+        comp = Compute()
+        jobid = comp.submitQuery('select top 4 objid from PhotoObj', context='MyDB')
+        assert comp.getJob(jobid).status == 'QUEUED'
+        time.sleep(0.2)
+        job = comp.getJob(jobid)
+        assert job.status == 'SUCCESS'
+        assert len(job.loadDataFrame()) == 4
+
+    def test_failures(self, server):
+        sky = SkyServer()
+        server.inject(r'/SqlSearch', status=503, count=2)
+        assert len(sky.sqlSearch('select top 2 objid from PhotoObj', cache=False)) == 2
+        assert server.requests['failure'] == 2 and server.requests['skyserver_search'] == 1
+
+        server.inject(r'/SqlSearch', status=0, count=None)
+        with pytest.raises(SciServerError):
+            sky.sqlSearch('select top 2 objid from PhotoObj', cache=False)
+        server.clear()
+
+        server.inject(r'/query$', status=500)
+        with pytest.raises(SciServerAPIError, match='Injected failure'):
+            CasJobs().executeQuery('select top 2 objid from PhotoObj', cache=False)
+
+    def test_job_failures(self, server):
+        server.job_failure_rate = 1.
+        skyquery = SkyQuery()
+        guid = skyquery.submitJob('select 1', cache=False)
+        assert skyquery.waitForJob(guid, verbose=False, poll=0.05)['status'] == 'failed'
@@ -9,7 +9,13 @@
 # @Last Modified time: 2017-08-30 10:37:04
 
 from __future__ import print_function, division, absolute_import
+import time
 import pytest
+import pandas
+from sciserver import config, skyquery
+from sciserver.exceptions import SciServerError, SciServerTimeoutError, SciServerUploadError
+from sciserver.skyquery import SkyQuery, CrossMatchPipeline, JobScheduler, JobWaiter, _to_bytes
+from sciserver.transport import RetryPolicy
 
 SkyQuery_TestTableName = "TestTable_SciScript_R"
 SkyQuery_TestTableCSV = u"Column1,Column2\n4.5,5.5\n"
@@ -109,3 +115,343 @@ class TestSkyQueryGetDbInfo(object):
         tables = skquery.listDatasetTables("MyDB")
         assert tables is not None
 
+
+class TestSkyQueryStreaming(object):
+
+    @pytest.fixture()
+    def table(self, skquery, monkeypatch, fake_response):
+        rows = ['#ID\tra\tdec\tname'] + ['{0}\t{0}.5\t-{0}.25\tobj{0}'.format(i) for i in range(10)]
+        urls = []
+
+        def send(url, **kwargs):
+            urls.append(url)
+            params = dict(p.split('=') for p in url.partition('?')[2].split('&') if p)
+            skip = int(params.get('skip', 0))
+            top = int(params.get('top', len(rows)))
+            body = '\n'.join([rows[0]] + rows[1 + skip:1 + skip + top]) + '\n'
+            return fake_response(body.encode())
+
+        monkeypatch.setattr(skyquery, 'send_request', send)
+        monkeypatch.setattr(config, 'token', 'testtoken')
+        skquery.urls = urls
+        yield rows
+
+    def test_getTable_columns(self, skquery, table):
+        df = skquery.getTable('t1', columns=['ra', 'name'], dtype={'ra': 'float32', 'dec': 'float64'})
+        assert list(df.columns) == ['ra', 'name']
+        assert str(df['ra'].dtype) == 'float32'
+        assert len(df) == 10
+
+    def test_getTable_chunks(self, skquery, table):
+        chunks = list(skquery.getTable('t1', chunksize=4))
+        assert [len(c) for c in chunks] == [4, 4, 2]
+
+    def test_iterTable(self, skquery, table):
+        pages = list(skquery.iterTable('t1', pagesize=3, workers=2))
+        assert [len(p) for p in pages] == [3, 3, 3, 1]
+        assert list(pages[1]['#ID']) == [3, 4, 5]
+
+    def test_column_dtype(self):
+        assert skyquery._column_dtype({'name': 'a', 'dataType': 'bigint', 'isNullable': False}) == 'int64'
+        assert skyquery._column_dtype({'name': 'a', 'dataType': 'int'}) == 'float64'
+        assert skyquery._column_dtype({'name': 'a', 'dataType': {'name': 'nvarchar(32)'}}) == 'object'
+        assert skyquery._column_dtype({'name': 'a', 'dataType': 'geography'}) is None
+
+
+class TestSkyQueryUpload(object):
+
+    @pytest.fixture()
+    def uploads(self, monkeypatch, fake_response):
+        bodies = []
+
+        def send(url, data=None, **kwargs):
+            body = data if isinstance(data, (str, bytes)) else b''.join(data)
+            if b'fail' in _to_bytes(body):
+                raise SciServerError('upload failed')
+            bodies.append(_to_bytes(body))
+            return fake_response(b'{}')
+
+        monkeypatch.setattr(skyquery, 'send_request', send)
+        monkeypatch.setattr(config, 'token', 'testtoken')
+        yield bodies
+
+    def test_upload_string(self, skquery, uploads):
+        assert skquery.uploadTable(SkyQuery_TestTableCSV, tableName='t1') is True
+        assert uploads == [SkyQuery_TestTableCSV.encode()]
+
+    def test_upload_dataframe_batches(self, skquery, uploads):
+        df = pandas.DataFrame({'a': range(5), 'b': [x * 0.5 for x in range(5)]})
+        assert skquery.uploadTable(df, tableName='t1', batch_rows=2) is True
+        assert len(uploads) == 3
+        assert all(body.startswith(b'a,b\n') for body in uploads)
+        assert uploads[2] == b'a,b\n4,2.0\n'
+
+    def test_upload_file(self, skquery, uploads, tmpdir):
+        path = tmpdir.join('table.csv')
+        path.write('a,b\n1,2\n3,4\n5,6\n')
+        assert skquery.uploadTable(str(path), tableName='t1', batch_rows=2) is True
+        assert uploads == [b'a,b\n1,2\n3,4\n', b'a,b\n5,6\n']
+
+    def test_upload_resume(self, skquery, uploads):
+        data = 'a,b\n1,2\n3,fail\n5,6\n'
+        with pytest.raises(SciServerUploadError) as cm:
+            skquery.uploadTable(data, tableName='t1', batch_rows=1)
+        assert cm.value.batch == 1
+        del uploads[:]
+        skquery.uploadTable(data.replace('fail', '4'), tableName='t1', batch_rows=1, start_batch=2)
+        assert uploads == [b'a,b\n5,6\n']
+        with pytest.raises(ValueError, match='batch_rows'):
+            skquery.uploadTable(data, tableName='t1', start_batch=2)
+        assert uploads == [b'a,b\n5,6\n']
+
+
+class FakeSkyQuery(object):
+    ''' Records cross-match calls and completes each job on the second status check '''
+
+    def __init__(self, limit=2):
+        self.limit = limit
+        self.tables = {}
+        self.checks = {}
+        self.dropped = []
+        self.queues = {}
+        self.maxrunning = {}
+
+    def getQueueInfo(self, queue):
+        return {'name': queue, 'maxOutstandingJobs': self.limit}
+
+    def uploadTable(self, uploadData, tableName, datasetName='MyDB'):
+        self.tables[tableName] = uploadData
+
+    def _running(self, queue):
+        return [jobId for jobId, q in self.queues.items() if q == queue and self.checks.get(jobId, 0) < 2]
+
+    def submitJob(self, query, queue='quick'):
+        jobId = 'job-{0}'.format(query.split()[-1])
+        self.tables[query.split()[-1]] = self.tables[query.split()[1]].assign(queue=queue)
+        self.queues[jobId] = queue
+        self.maxrunning[queue] = max(self.maxrunning.get(queue, 0), len(self._running(queue)))
+        return jobId
+
+    def getJobStatus(self, jobId):
+        self.checks[jobId] = self.checks.get(jobId, 0) + 1
+        return {'status': 'completed' if self.checks[jobId] > 1 else 'executing'}
+
+    def getTable(self, tableName, datasetName='MyDB'):
+        return self.tables[tableName]
+
+    def dropTable(self, tableName, datasetName='MyDB'):
+        self.dropped.append(tableName)
+
+    waitForJob = SkyQuery.waitForJob
+
+
+class TestCrossMatchPipeline(object):
+
+    def test_run(self):
+        catalog = pandas.DataFrame({'ra': [float(x) for x in range(100)], 'dec': [0.] * 100})
+        fake = FakeSkyQuery()
+        pipeline = CrossMatchPipeline('SELECT {input} INTO {output}', catalog, partitions=4,
+                                      queue=['quick', 'long'], poll=0.01, skyquery=fake)
+        df = pipeline.run()
+        assert len(df) == 100
+        assert sorted(df['ra']) == list(catalog['ra'])
+        summary = pipeline.summary()
+        assert list(summary['rows']) == [25, 25, 25, 25]
+        assert list(summary['queue']) == ['quick', 'long', 'quick', 'long']
+        assert (summary['wait'] > 0).all()
+        assert len(fake.dropped) == 8
+
+    def test_failed_job(self):
+        fake = FakeSkyQuery()
+        fake.getJobStatus = lambda jobId: {'status': 'failed'}
+        pipeline = CrossMatchPipeline('SELECT {input} INTO {output}', pandas.DataFrame({'ra': [1.]}),
+                                      skyquery=fake)
+        with pytest.raises(SciServerError):
+            pipeline.run()
+        assert fake.dropped == ['xmatch_input_0', 'xmatch_output_0']
+
+    def test_queue_limit(self):
+        catalog = pandas.DataFrame({'ra': [float(x) for x in range(12)]})
+        fake = FakeSkyQuery(limit=1)
+        pipeline = CrossMatchPipeline('SELECT {input} INTO {output}', catalog, partitions=6, workers=3,
+                                      poll=0.01, skyquery=fake)
+        assert len(pipeline.run()) == 12
+        assert fake.maxrunning == {'quick': 1}
+
+    def test_spilled(self, tmpdir, monkeypatch):
+        pytest.importorskip('pyarrow')
+        from sciserver.spill import SpilledTable, spill_frames
+        monkeypatch.setattr(config, 'spillDir', str(tmpdir))
+        catalog = pandas.DataFrame({'ra': [float(x) for x in range(10)]})
+        fake = FakeSkyQuery()
+        fake.getTable = lambda tableName, datasetName='MyDB': spill_frames([fake.tables[tableName]])
+        pipeline = CrossMatchPipeline('SELECT {input} INTO {output}', catalog, partitions=2, poll=0.01,
+                                      skyquery=fake)
+        table = pipeline.run()
+        assert isinstance(table, SpilledTable)
+        assert sorted(table['ra']) == list(catalog['ra'])
+
+    @pytest.mark.parametrize('value', [float('nan'), float('inf')])
+    def test_invalid_ra(self, value):
+        catalog = pandas.DataFrame({'ra': [1., 2., value, 4.]})
+        pipeline = CrossMatchPipeline('SELECT {input} INTO {output}', catalog, partitions=2, skyquery=FakeSkyQuery())
+        with pytest.raises(SciServerError, match='1 rows'):
+            pipeline.split()
+
+    def test_default_queue(self):
+        fake = FakeSkyQuery()
+        pipeline = CrossMatchPipeline('SELECT {input} INTO {output}', pandas.DataFrame({'ra': [1.]}),
+                                      queue=None, poll=0.01, skyquery=fake)
+        pipeline.run()
+        assert list(pipeline.summary()['queue']) == ['quick']
+
+
+class FakeQueues(object):
+    ''' A fake SkyQuery server with queue limits, where jobs finish after a few listings '''
+
+    def __init__(self, limits):
+        self.limits = limits
+        self.jobs = {}
+        self.maxrunning = dict((q, 0) for q in limits)
+
+    def getQueueInfo(self, queue):
+        return {'name': queue, 'maxOutstandingJobs': self.limits[queue]}
+
+    def listJobs(self, queue='quick'):
+        jobs = [j for j in self.jobs.values() if j['queue'] == queue]
+        for job in jobs:
+            job['age'] += 1
+            if job['age'] > 2:
+                job['status'] = 'completed'
+        return [dict(job) for job in jobs]
+
+    def submitJob(self, query, queue='quick'):
+        running = [j for j in self.jobs.values() if j['queue'] == queue and j['status'] == 'executing']
+        assert len(running) < self.limits[queue], 'queue limit exceeded'
+        guid = 'guid-{0}'.format(len(self.jobs))
+        self.jobs[guid] = {'guid': guid, 'queue': queue, 'status': 'executing', 'age': 0, 'query': query}
+        self.maxrunning[queue] = max(self.maxrunning[queue], len(running) + 1)
+        return guid
+
+    def getJobStatus(self, jobId):
+        return dict(self.jobs[jobId])
+
+
+class TestJobScheduler(object):
+
+    def test_respects_limits(self):
+        fake = FakeQueues({'quick': 2, 'long': 1})
+        scheduler = JobScheduler(skyquery=fake, poll=0.01)
+        jobs = [scheduler.submit('select {0}'.format(i), overflow=True) for i in range(7)]
+        results = scheduler.wait(timeout=10)
+        scheduler.stop()
+        assert all(r['status'] == 'completed' for r in results)
+        assert fake.maxrunning == {'quick': 2, 'long': 1}
+        assert set(j.queue for j in jobs) == set(['quick', 'long'])
+
+    def test_requested_queue(self):
+        fake = FakeQueues({'quick': 1, 'long': 1})
+        scheduler = JobScheduler(skyquery=fake, poll=0.01, limits={'long': 1})
+        jobs = [scheduler.submit('select 1', queue='long') for i in range(3)]
+        scheduler.wait(timeout=10)
+        assert [j.queue for j in jobs] == ['long'] * 3
+        assert fake.maxrunning['quick'] == 0
+
+    def test_restart(self):
+        fake = FakeQueues({'quick': 1})
+        scheduler = JobScheduler(skyquery=fake, poll=0.01)
+        jobs = [scheduler.submit('select {0}'.format(i)) for i in range(4)]
+        thread = scheduler._thread
+        scheduler.stop()
+        thread.join(10)
+        assert scheduler._thread is None and len(scheduler.pending) >= 2
+        scheduler.start()
+        results = scheduler.wait(timeout=10)
+        assert [r['status'] for r in results] == ['completed'] * 4
+        assert all(j.jobId for j in jobs)
+        scheduler.stop()
+
+    def test_wait_stopped(self):
+        scheduler = JobScheduler(skyquery=FakeQueues({'quick': 1}), poll=0.01)
+        for i in range(3):
+            scheduler.submit('select {0}'.format(i))
+        scheduler.stop()
+        with pytest.raises(SciServerError, match='stopped'):
+            scheduler.wait()
+
+    def test_wait_timeout(self):
+        # scheduling rounds are far apart, so the jobs cannot finish in time
+        scheduler = JobScheduler(skyquery=FakeQueues({'quick': 1}), poll=60)
+        for i in range(3):
+            scheduler.submit('select {0}'.format(i))
+        start = time.time()
+        with pytest.raises(SciServerTimeoutError):
+            scheduler.wait(timeout=0.3)
+        assert time.time() - start < 0.6
+        scheduler.stop()
+
+
+class TestSkyQueryWait(object):
+
+    @pytest.fixture()
+    def statuses(self, skquery, monkeypatch):
+        jobs = {'done': ['executing', 'completed'], 'bad': ['queued', 'executing', 'failed'],
+                'slow': ['executing'] * 1000}
+        canceled = []
+
+        def status(jobId):
+            states = jobs[jobId]
+            return {'guid': jobId, 'queue': 'quick', 'status': states.pop(0) if len(states) > 1 else states[0]}
+
+        monkeypatch.setattr(skquery, 'getJobStatus', status)
+        monkeypatch.setattr(skquery, 'cancelJob', lambda jobId: canceled.append(jobId) or True)
+        monkeypatch.setattr(skyquery, 'POLL_INTERVALS', {'quick': (0.01, 0.01), 'long': (0.01, 0.01)})
+        skquery.canceled = canceled
+        yield jobs
+
+    def test_failed_job_terminates(self, skquery, statuses):
+        jobDesc = skquery.waitForJob('bad', verbose=False)
+        assert jobDesc['status'] == 'failed'
+
+    def test_timeout_cancels(self, skquery, statuses):
+        with pytest.raises(SciServerTimeoutError):
+            skquery.waitForJob('slow', verbose=False, timeout=0.05, cancel_on_timeout=True)
+        assert skquery.canceled == ['slow']
+
+    def test_waitForJobs(self, skquery, statuses):
+        results = skquery.waitForJobs(['bad', 'done'], timeout=5)
+        assert [r['status'] for r in results] == ['failed', 'completed']
+
+    def test_waiter_timeout(self, skquery, statuses):
+        waiter = JobWaiter(skyquery=skquery)
+        waiter.add('slow')
+        waiter.add('done')
+        with pytest.raises(SciServerTimeoutError):
+            waiter.wait(['slow', 'done'], timeout=0.05, cancel_on_timeout=True)
+        waiter.stop()
+        assert waiter.done('done')
+        assert skquery.canceled == ['slow']
+
+    def test_waiter_retries(self, skquery, statuses):
+        errors = {'flaky': 2, 'gone': 100}
+
+        def status(jobId):
+            if errors.get(jobId):
+                errors[jobId] -= 1
+                raise SciServerError('Service Unavailable')
+            return {'guid': jobId, 'queue': 'quick', 'status': 'completed'}
+
+        skquery.getJobStatus = status
+        waiter = JobWaiter(skyquery=skquery, retry=RetryPolicy(total=3, backoff=0.01))
+        waiter.add('flaky')
+        assert waiter.wait(['flaky'], timeout=5)[0]['status'] == 'completed'
+        waiter.add('gone')
+        with pytest.raises(SciServerError, match='Unavailable'):
+            waiter.wait(['gone'], timeout=5)
+        waiter.stop()
+        assert errors['gone'] == 100 - 4
+
+    def test_poll_interval(self):
+        assert skyquery._poll_interval('quick', 0) == 0.5
+        assert skyquery._poll_interval('quick', 1000) == 5.
+        assert skyquery._poll_interval('long', 100) == 10.
@@ -9,9 +9,16 @@
 # @Last Modified time: 2017-08-30 10:35:59
 
 from __future__ import print_function, division, absolute_import
+from io import StringIO
+import pandas
 import pytest
 import skimage
 import os
+from sciserver import config, skyserver
+from sciserver.exceptions import SciServerError, SciServerWarning
+from sciserver.mockserver import MockServer, photo_rows, FIRST_OBJID
+from sciserver.skyserver import SkyServer, read_csv, PHOTO_DTYPES
+from sciserver.transport import Transport, set_transport
 
 # sky test data
 SkyServer_TestQuery = "select top 1 specobjid, ra, dec from specobj order by specobjid"
@@ -48,3 +55,103 @@ class TestSkyServer(object):
         object = sky.objectSearch(ra=258.25, dec=64.05, dataRelease=SkyServer_DataRelease)
         assert SkyServer_ObjectSearchResultObjID == object[0]["Rows"][0]["id"]
 
+
+
+@pytest.fixture(params=['pyarrow', 'c'])
+def engine(request):
+    if request.param == 'pyarrow':
+        pytest.importorskip('pyarrow')
+    return request.param
+
+
+class TestReadCsv(object):
+
+    @pytest.mark.parametrize('content', [SkyServer_QueryResultCSV, SkyServer_RadialSearchResultCSV,
+                                         'objID,name,when,flag\n1,,2020-01-01 10:00:00,True\n2,x,2020-01-02,False\n',
+                                         'type,objid,objid\nstar,1,2\n,3,4\n'],
+                             ids=['sql', 'radial', 'strings', 'fallback'])
+    def test_read_csv(self, content, engine):
+        expected = pandas.read_csv(StringIO(content), index_col=None)
+        df = read_csv(('#Table1\n#comment\n' + content).encode(), dtype=PHOTO_DTYPES, engine=engine)
+        pandas.testing.assert_frame_equal(df, expected)
+        assert read_csv(content.encode(), engine=engine).equals(df)
+
+    def test_photo_dtypes(self, engine):
+        df = read_csv(b'#Table1\nobjID,ra,type\n1,2,3\n', dtype=PHOTO_DTYPES, engine=engine)
+        assert df.dtypes.tolist() == ['int64', 'float64', 'int64']
+
+
+@pytest.fixture()
+def truncating(monkeypatch):
+    monkeypatch.setattr(skyserver, 'SQL_ROW_LIMIT', 500)
+    previous = set_transport(Transport())
+    with MockServer(rows=1234, max_rows=500, job_duration=0.1) as server:
+        yield server
+    set_transport(previous)
+
+
+class TestLargeResults(object):
+
+    def test_truncated_sqlsearch(self, truncating):
+        df = SkyServer().sqlSearch('select * from PhotoObj order by ra;', pagesize=200, cache=False, autopage=True)
+        assert len(df) == 1234
+        assert list(df['objid']) == list(range(FIRST_OBJID, FIRST_OBJID + 1234))
+        # the query, the count checking objid is unique, and the pages
+        assert truncating.requests['skyserver_search'] == 1 + 1 + 7
+
+    def test_truncated_sqlsearch_key(self, truncating):
+        df = SkyServer().sqlSearch('select * from PhotoObj', key='objid', pagesize=200, cache=False)
+        assert list(df['objid']) == list(range(FIRST_OBJID, FIRST_OBJID + 1234))
+        # the first page is the 500 rows SqlSearch returns, then pages of 200
+        assert truncating.requests['skyserver_search'] == 1 + 4
+
+    def test_truncated_sqlsearch_warns(self, truncating):
+        with pytest.warns(SciServerWarning, match='truncated'):
+            df = SkyServer().sqlSearch('select * from PhotoObj', cache=False)
+        assert len(df) == 500 and truncating.requests['skyserver_search'] == 1
+        with pytest.raises(AssertionError, match='autopage'):
+            SkyServer().iterSqlSearch('select * from PhotoObj', pagesize=400)
+
+    def test_unnamed_columns(self):
+        skyserver._check_columns(['objid', 'ra', 'z.err'])
+        with pytest.raises(SciServerError, match='alias'):
+            skyserver._check_columns(['objid', 'objid.1'])
+        with pytest.raises(SciServerError, match='Unnamed'):
+            skyserver._check_columns(['objid', 'Unnamed: 1'])
+
+    def test_small_sqlsearch(self, truncating):
+        df = SkyServer().sqlSearch('select top 10 * from PhotoObj', pagesize=200, cache=False)
+        assert len(df) == 10 and truncating.requests['skyserver_search'] == 1
+        # exactly the limit, but not truncated
+        df = SkyServer().sqlSearch('select top 500 * from PhotoObj', pagesize=200, cache=False)
+        assert len(df) == 500 and truncating.requests['skyserver_search'] == 2
+
+    def test_iter_sqlsearch(self, truncating):
+        pages = list(SkyServer().iterSqlSearch('select * from PhotoObj', key='objid', pagesize=300))
+        assert [len(page) for page in pages] == [300, 300, 300, 300, 34]
+        assert pages[1]['objid'].iloc[0] == FIRST_OBJID + 300
+
+    def test_iter_sqlsearch_casjobs(self, truncating, monkeypatch):
+        monkeypatch.setattr(skyserver, 'KEY_COLUMNS', ())
+        pages = list(SkyServer().iterSqlSearch('select * from PhotoObj', pagesize=400, autopage=True))
+        assert [len(page) for page in pages] == [400, 400, 400, 34]
+        assert 'row_id' not in pages[0].columns
+        assert list(pages[3].iloc[-1]) == pytest.approx(list(photo_rows(1233, 1234)[0]))
+        assert not truncating.tables
+
+    def test_duplicate_key(self, truncating, monkeypatch):
+        ''' type repeats across page boundaries, so keyset paging on it would drop rows '''
+        monkeypatch.setattr(skyserver, 'KEY_COLUMNS', ('type', 'objid'))
+        df = SkyServer().sqlSearch('select * from PhotoObj', pagesize=400, cache=False, autopage=True)
+        assert len(df) == 1234 and df['objid'].is_unique
+        assert truncating.requests['casjobs_submit'] == 1 and not truncating.tables
+
+        with pytest.raises(SciServerError, match='not unique'):
+            list(SkyServer().iterSqlSearch('select * from PhotoObj', key='type', pagesize=400))
+
+    def test_truncated_sqlsearch_spilled(self, truncating, monkeypatch, tmpdir):
+        pytest.importorskip('pyarrow')
+        monkeypatch.setattr(config, 'memoryBudget', 10**6)
+        monkeypatch.setattr(config, 'spillDir', str(tmpdir))
+        table = SkyServer().sqlSearch('select * from PhotoObj', key='objid', pagesize=200, cache=False)
+        assert len(table) == 1234 and table['objid'].is_unique
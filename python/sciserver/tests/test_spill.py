@@ -0,0 +1,88 @@
+# !usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Licensed under a 3-clause BSD license.
+#
+
+from __future__ import print_function, division, absolute_import
+from io import BytesIO
+import gc
+import json
+import os
+import pandas
+import pytest
+from sciserver import config
+from sciserver.casjobs import CasJobs, _iter_json_rows
+from sciserver.exceptions import SciServerError
+from sciserver.mockserver import MockServer
+from sciserver.skyquery import SkyQuery
+from sciserver.skyserver import SkyServer
+from sciserver.transport import Transport, set_transport
+
+pytest.importorskip('pyarrow')
+from sciserver.spill import SpilledTable, spill_rows  # noqa: E402
+
+
+@pytest.fixture()
+def spilled(tmpdir, monkeypatch):
+    monkeypatch.setattr(config, 'spillDir', str(tmpdir))
+    rows = [[i, i * 0.5, 'star' if i % 2 else 'galaxy', None] for i in range(10)]
+    return spill_rows(['objid', 'ra', 'type', 'note'], iter(rows), batch_rows=4)
+
+
+@pytest.fixture(params=[{}, {'compress': True}, {'chunked': True}], ids=['length', 'gzip', 'chunked'])
+def server(request, tmpdir, monkeypatch):
+    monkeypatch.setattr(config, 'spillDir', str(tmpdir))
+    previous = set_transport(Transport())
+    with MockServer(rows=200, **request.param) as server:
+        yield server
+    set_transport(previous)
+
+
+class TestSpill(object):
+
+    @pytest.mark.parametrize('chunk_size', [1, 7, 2**20])
+    def test_iter_json_rows(self, chunk_size):
+        result = {'Result': [{'TableName': 'Table1', 'Columns': ['a', 'b'],
+                              'Data': [[1, 'x, ]"y'], [2.5, None], [3, 'é']]}]}
+        stream = BytesIO(json.dumps(result, ensure_ascii=False).encode('utf-8'))
+        rows = list(_iter_json_rows(stream, chunk_size=chunk_size))
+        assert rows == [['a', 'b'], [1, 'x, ]"y'], [2.5, None], [3, 'é']]
+
+        with pytest.raises(SciServerError, match='ended'):
+            list(_iter_json_rows(BytesIO(b'{"Result": [{"Columns": ["a"], "Data": [[1], [2'), chunk_size=chunk_size))
+
+    def test_spilled_table(self, spilled):
+        assert len(spilled) == 10 and spilled.shape == (10, 4)
+        assert list(spilled.columns) == ['objid', 'ra', 'type', 'note']
+        assert spilled['ra'].sum() == 22.5 and spilled.ra.name == 'ra'
+        assert list(spilled[['objid', 'type']].columns) == ['objid', 'type']
+        galaxies = spilled[spilled['type'] == 'galaxy']
+        assert list(galaxies['objid']) == [0, 2, 4, 6, 8]
+        assert list(spilled[2:4]['objid']) == [2, 3]
+        assert list(spilled.filter(spilled['objid'] > 7, columns=['ra'])['ra']) == [4.0, 4.5]
+        assert spilled.to_pandas().equals(spilled.copy().to_pandas())
+
+    def test_spill_file_removed(self, tmpdir, monkeypatch):
+        monkeypatch.setattr(config, 'spillDir', str(tmpdir))
+        table = spill_rows(['objid'], ([i] for i in range(10)))
+        path = table.path
+        copy = table.copy()
+        del table
+        gc.collect()
+        assert os.path.exists(path) and len(copy) == 10
+        del copy
+        gc.collect()
+        assert not os.path.exists(path)
+
+    def test_memory_budget(self, server, monkeypatch):
+        sql = 'select top 200 * from PhotoObj'
+        frames = [CasJobs().executeQuery(sql, cache=False), SkyServer().sqlSearch(sql, cache=False),
+                  SkyQuery().getTable('PhotoObj', top=200)]
+        monkeypatch.setattr(config, 'memoryBudget', 8000)
+        tables = [CasJobs().executeQuery(sql, cache=False), SkyServer().sqlSearch(sql, cache=False),
+                  SkyQuery().getTable('PhotoObj', top=200)]
+        for frame, table in zip(frames, tables):
+            assert isinstance(table, SpilledTable)
+            pandas.testing.assert_frame_equal(table.to_pandas(), frame)
+            assert os.path.dirname(table.path) == config.spillDir
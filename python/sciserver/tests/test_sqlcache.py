@@ -0,0 +1,153 @@
+# !usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Licensed under a 3-clause BSD license.
+#
+
+from __future__ import print_function, division, absolute_import
+import time
+import pandas
+import pytest
+from sciserver import casjobs, config, skyquery
+from sciserver.casjobs import CasJobs
+from sciserver.skyquery import SkyQuery
+from sciserver.sqlcache import (QueryCache, normalize_sql, fingerprint, is_cacheable, enable_cache, disable_cache,
+                                DEFAULT_TTL)
+
+
+@pytest.fixture()
+def qcache():
+    cache = enable_cache(maxsize=4)
+    yield cache
+    disable_cache()
+
+
+class TestNormalize(object):
+
+    @pytest.mark.parametrize('sql', ["select top 10 ra from PhotoObj where r < 17.5",
+                                     "SELECT  TOP 010 ra\n  FROM PhotoObj\n WHERE r<17.5;",
+                                     "select top 10 ra -- coordinates\nfrom PhotoObj /* cut */ where r < 017.5"])
+    def test_equivalent(self, sql):
+        assert normalize_sql(sql) == 'SELECT TOP 10 ra FROM PhotoObj WHERE r < 17.5'
+
+    def test_literals(self):
+        assert normalize_sql("select 'Select  -- x' as s") == "SELECT 'Select  -- x' AS s"
+        assert normalize_sql("select 1.50, .5, 1E3") == 'SELECT 1.50 , 0.5 , 1000.0'
+        assert fingerprint('select 1.5') != fingerprint('select 1.50')
+        assert fingerprint('select 1') != fingerprint('select 1.0')
+
+    def test_context(self):
+        assert fingerprint('select 1', 'DR13') == fingerprint('SELECT 1', 'DR13')
+        assert fingerprint('select 1', 'DR13') != fingerprint('select 1', 'DR14')
+
+    def test_cacheable(self):
+        assert is_cacheable('select top 10 * from PhotoObj')
+        assert not is_cacheable('select top 10 * into mydb.t from PhotoObj')
+        assert not is_cacheable('drop table t')
+        assert not is_cacheable('select newid()')
+        assert not is_cacheable('select * from mydb.t')
+        assert not is_cacheable('select * from [MyDB]:t')
+        assert not is_cacheable('select * from t', 'MyDB')
+        assert is_cacheable('select * from t', 'DR13')
+
+
+class TestQueryCache(object):
+
+    def test_lru(self):
+        cache = QueryCache(maxsize=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        assert cache.get('a') == 1
+        cache.set('c', 3)
+        assert 'b' not in cache
+        assert list(cache.fingerprints()) == ['a', 'c']
+        assert cache.stats()['hits'] == 1
+
+    def test_ttl(self):
+        cache = QueryCache(ttl=0.01)
+        cache.set('a', 1)
+        time.sleep(0.02)
+        assert cache.get('a') is None
+        assert len(cache) == 0
+
+    def test_default_ttl(self, qcache):
+        assert QueryCache().ttl == qcache.ttl == DEFAULT_TTL
+
+    def test_invalidate(self):
+        cache = QueryCache()
+        cache.set('a', 1, sql=normalize_sql('select * from PhotoObj'))
+        cache.set('b', 2, sql=normalize_sql('select * from [mytable] join PhotoObj on 1=1'))
+        cache.set('c', 3)
+        assert cache.invalidate('MyTable') == 2
+        assert list(cache.fingerprints()) == ['a']
+
+    def test_copies(self):
+        cache = QueryCache()
+        cache.set('a', pandas.DataFrame({'x': [1, 2]}))
+        df = cache.get('a')
+        df['x'] = 0
+        assert cache.get('a')['x'].tolist() == [1, 2]
+
+
+class TestServiceCache(object):
+
+    def test_executequery(self, qcache, monkeypatch):
+        calls = []
+
+        def fake_execute(self, sql, context, outformat, acceptHeader):
+            calls.append(sql)
+            return pandas.DataFrame({'foo': [1]})
+
+        monkeypatch.setattr(CasJobs, '_execute_query', fake_execute)
+        cas = CasJobs()
+        cas.executeQuery('select 1 as foo', context='DR13')
+        df = cas.executeQuery('SELECT 1 AS foo -- again', context='DR13')
+        assert len(calls) == 1
+        assert df['foo'].tolist() == [1]
+        cas.executeQuery('select 1 as foo', context='DR14')
+        cas.executeQuery('select 1 as foo', context='DR13', cache=False)
+        cas.executeQuery('drop table foo', context='DR13')
+        cas.executeQuery('drop table foo', context='DR13')
+        assert len(calls) == 5
+        cas.executeQuery('select 1 as foo')
+        cas.executeQuery('select 1 as foo')
+        assert len(calls) == 7
+
+    def test_users(self, qcache, monkeypatch):
+        calls = []
+        monkeypatch.setattr(CasJobs, '_execute_query', lambda self, sql, *args: calls.append(config.token) or 1)
+        cas = CasJobs()
+        for token in ['alice', 'bob', 'alice']:
+            monkeypatch.setattr(config, 'token', token)
+            cas.executeQuery('select 1 as foo', context='DR13')
+        assert calls == ['alice', 'bob']
+
+    def test_upload(self, qcache, monkeypatch):
+        calls = []
+        monkeypatch.setattr(config, 'token', 'token')
+        monkeypatch.setattr(CasJobs, '_execute_query', lambda self, sql, *args: calls.append(sql) or 1)
+        monkeypatch.setattr(casjobs, 'send_request', lambda url, **kwargs: type('Response', (object,), {'ok': True})())
+        cas = CasJobs()
+        for i in range(2):
+            cas.executeQuery('select * from Stars', context='DR13')
+            cas.executeQuery('select * from Galaxies', context='DR13')
+            cas.uploadCSVDataToTable(b'a\n1\n', 'stars', context='DR13')
+        assert calls == ['select * from Stars', 'select * from Galaxies', 'select * from Stars']
+
+    def test_submitjob(self, qcache, monkeypatch):
+        jobs = {}
+
+        def fake_send(url, reqtype='get', **kwargs):
+            guid = str(len(jobs))
+            jobs[guid] = 'failed' if 'long' in url else 'executing'
+            return type('Response', (object,), {'ok': True, 'json': lambda self: {'queryJob': {'guid': guid}}})()
+
+        monkeypatch.setattr(config, 'token', 'token')
+        monkeypatch.setattr(skyquery, 'send_request', fake_send)
+        monkeypatch.setattr(SkyQuery, 'getJobStatus', lambda self, guid: {'status': jobs[guid]})
+        sky = SkyQuery()
+        assert sky.submitJob('select 1') == sky.submitJob('SELECT 1;')
+        assert len(jobs) == 1
+        sky.submitJob('select 1', queue='long')
+        sky.submitJob('select 1', queue='long')
+        assert len(jobs) == 3
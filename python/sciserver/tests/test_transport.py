@@ -0,0 +1,451 @@
+# !usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Licensed under a 3-clause BSD license.
+#
+
+from __future__ import print_function, division, absolute_import
+from io import BytesIO
+import threading
+import time
+import zlib
+try:
+    import asyncio
+except ImportError:
+    asyncio = None
+import pytest
+import requests
+import sciserver
+from sciserver import config
+from sciserver.exceptions import SciServerError, SciServerAPIError, SciServerCircuitOpenError, SciServerTimeoutError
+from sciserver.transport import (SingleFlight, Transport, HTTP2Session, RetryPolicy, CircuitBreaker, ServiceLimiter,
+                                 FileRateLimiter, get_transport, set_transport, _flock, bind_deadline, remaining,
+                                 accept_encoding, new_session)
+from sciserver.utils import (send_request, ResponseStream, MemorySession, MemoryResponse, RecordingSession,
+                             ReplaySession)
+
+
+class FakeSession(object):
+    ''' A requests.Session stand-in answering every request after a delay '''
+
+    def __init__(self, fake_response, delay=0.05, statuses=None):
+        self.fake_response = fake_response
+        self.delay = delay
+        self.statuses = statuses or []
+        self.retry_after = '0'
+        self.sent = []
+        self._lock = threading.Lock()
+
+    def request(self, method, url, headers=None, data=None, stream=None, timeout=None):
+        if data is not None and not isinstance(data, bytes):
+            data = b''.join(data)
+        with self._lock:
+            self.sent.append((method, url))
+            self.timeout = timeout
+            self.headers = headers
+            self.data = data
+            status = self.statuses.pop(0) if self.statuses else 200
+        time.sleep(self.delay)
+        if isinstance(status, Exception):
+            raise status
+        return self.fake_response(url.encode(), status_code=status, headers={'Retry-After': self.retry_after})
+
+
+@pytest.fixture()
+def session(monkeypatch, fake_response):
+    session = FakeSession(fake_response)
+    monkeypatch.setattr(config, 'token', 'testtoken')
+    previous = set_transport(Transport(session=session))
+    yield session
+    set_transport(previous)
+
+
+def concurrently(func, n=8):
+    results = [None] * n
+    threads = [threading.Thread(target=lambda i=i: results.__setitem__(i, func())) for i in range(n)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+class TestSingleFlight(object):
+
+    def test_shared_error(self):
+        flight = SingleFlight()
+        errors = []
+
+        def fail():
+            time.sleep(0.05)
+            raise ValueError('boom')
+
+        def call():
+            try:
+                flight.do('key', fail)
+            except ValueError as e:
+                errors.append(e)
+
+        concurrently(call, n=4)
+        assert len(errors) == 4
+        assert flight.deduplicated == 3
+        assert len(flight) == 0
+
+
+class TestTransport(object):
+
+    def test_coalesced_gets(self, session):
+        responses = concurrently(lambda: send_request('http://test/tables'))
+        assert len(session.sent) == 1
+        assert all(r.content == b'http://test/tables' for r in responses)
+        stats = get_transport().stats()
+        assert stats['requests'] == 8
+        assert stats['sent'] == 1
+        assert stats['coalesced'] == 7
+
+    def test_distinct_requests(self, session):
+        concurrently(lambda: send_request('http://test/tables', stream=True), n=3)
+        concurrently(lambda: send_request('http://test/jobs', reqtype='post', data=b'{}'), n=3)
+        assert len(session.sent) == 6
+        send_request('http://test/tables')
+        send_request('http://test/tables')
+        assert len(session.sent) == 8
+        assert get_transport().stats()['coalesced'] == 0
+
+
+class TestRetry(object):
+
+    @pytest.fixture()
+    def flaky(self, session):
+        session.delay = 0
+        session.statuses = [503, requests.ConnectionError('reset'), 200]
+        return session
+
+    def test_retry_get(self, flaky):
+        assert send_request('http://test/tables').status_code == 200
+        assert len(flaky.sent) == 3
+        stats = get_transport().stats()
+        assert (stats['retries'], stats['retry_statuses'], stats['retry_errors']) == (2, 1, 1)
+
+    def test_post_not_retried(self, flaky):
+        with pytest.raises(SciServerAPIError):
+            send_request('http://test/jobs', reqtype='post', data=b'{}')
+        assert len(flaky.sent) == 1
+
+    def test_idempotent_post(self, flaky):
+        send_request('http://test/query', reqtype='post', data=b'{}', idempotent=True)
+        assert len(flaky.sent) == 3
+
+    def test_streamed_body(self, flaky):
+        body = BytesIO(b'a,b\n1,2\n')
+        body.read(2)
+        send_request('http://test/upload', reqtype='put', data=body, idempotent=True)
+        assert len(flaky.sent) == 3 and flaky.data == b'b\n1,2\n'
+        del flaky.sent[:]
+        flaky.statuses = [503, 200]
+        with pytest.raises(SciServerAPIError):
+            send_request('http://test/upload', reqtype='put', data=iter([b'a,b\n', b'1,2\n']), idempotent=True)
+        assert len(flaky.sent) == 1
+
+    def test_policy(self, flaky):
+        get_transport().set_policy('http://test/jobs', RetryPolicy(total=0))
+        with pytest.raises(SciServerAPIError):
+            send_request('http://test/jobs/1')
+        assert len(flaky.sent) == 1
+
+    def test_delay(self):
+        policy = RetryPolicy(backoff=1, max_backoff=10)
+        assert policy.delay(0, '3') == 3
+        assert policy.delay(0, 'Wed, 21 Oct 2015 07:28:00 GMT') == 0
+        assert policy.delay(0, '120') == 10
+        assert all(0 <= policy.delay(5) <= 10 for i in range(20))
+
+    def test_circuit_breaker(self, session):
+        session.delay = 0
+        session.statuses = [503] * 3
+        get_transport().breaker('http://test').threshold = 2
+        get_transport().set_policy('http://test', RetryPolicy(total=0))
+        for i in range(2):
+            with pytest.raises(SciServerAPIError):
+                send_request('http://test/tables')
+        with pytest.raises(SciServerCircuitOpenError):
+            send_request('http://test/tables')
+        assert len(session.sent) == 2
+        assert get_transport().stats()['circuit_rejected'] == 1
+
+    def test_circuit_breaker_errors(self, session):
+        ''' 500s, e.g. for bad queries, do not open the circuit '''
+        session.delay = 0
+        session.statuses = [500] * 5
+        get_transport().breaker('http://test').threshold = 2
+        for i in range(5):
+            with pytest.raises(SciServerAPIError):
+                send_request('http://test/tables')
+        assert get_transport().breaker('http://test').state == 'closed'
+        assert send_request('http://test/tables').ok
+        assert len(session.sent) == 6
+
+    def test_half_open(self):
+        breaker = CircuitBreaker(threshold=1, reset_timeout=0.01)
+        breaker.failure()
+        assert breaker.state == 'open' and breaker.allow()
+        time.sleep(0.02)
+        assert breaker.allow() == 0
+        assert breaker.allow()
+        breaker.success()
+        assert breaker.state == 'closed'
+
+
+class TestServiceLimits(object):
+
+    @pytest.fixture()
+    def limited(self, session, monkeypatch):
+        monkeypatch.setattr(config, 'rateLimits', {'http://test': {'concurrency': 2},
+                                                   'http://test/casjobs': {'rate': 50, 'burst': 1}})
+        active = []
+        peak = []
+        request = session.request
+
+        def counting(*args, **kwargs):
+            active.append(1)
+            peak.append(len(active))
+            try:
+                return request(*args, **kwargs)
+            finally:
+                active.pop()
+
+        monkeypatch.setattr(session, 'request', counting)
+        return peak
+
+    def test_concurrency(self, limited):
+        concurrently(lambda: send_request('http://test/jobs', reqtype='post', data=b'{}'), n=6)
+        assert max(limited) == 2
+        assert get_transport().stats()['throttled'] > 0
+
+    def test_rate(self, limited):
+        start = time.time()
+        concurrently(lambda: send_request('http://test/casjobs/query', reqtype='post', data=b'{}'), n=4)
+        assert time.time() - start >= 3 / 50.
+
+    def test_shared_files(self, tmpdir):
+        path = str(tmpdir.join('limits'))
+        with ServiceLimiter(concurrency=1, lockfile=path).limit():
+            assert _flock(open(path + '.slot.0', 'a'), blocking=False) is False
+        bucket = FileRateLimiter(path + '.rate', rate=1, burst=2)
+        assert bucket.acquire(block=False) and bucket.acquire(block=False)
+        assert FileRateLimiter(path + '.rate', rate=1, burst=2).acquire(block=False) is False
+
+
+class TestDeadline(object):
+
+    def test_timeouts(self, session, monkeypatch):
+        monkeypatch.setattr(config, 'connectTimeout', 5)
+        monkeypatch.setattr(config, 'readTimeout', 60)
+        send_request('http://test/tables')
+        assert session.timeout == (5, 60)
+        send_request('http://test/tables', timeout=2)
+        assert session.timeout == (2, 2)
+        with sciserver.deadline(1):
+            send_request('http://test/tables', timeout=(0.5, 30))
+            assert session.timeout[0] == 0.5 and session.timeout[1] <= 1
+
+    def test_nested(self):
+        assert remaining() is None
+        with sciserver.deadline(10):
+            with sciserver.deadline(60):
+                assert remaining() <= 10
+            assert remaining() <= 10
+        assert remaining() is None
+
+    def test_expired(self, session):
+        with pytest.raises(SciServerTimeoutError):
+            with sciserver.deadline(0.05):
+                send_request('http://test/tables')
+                send_request('http://test/tables')
+        assert len(session.sent) == 1
+
+    def test_no_retry_past_deadline(self, session):
+        session.delay = 0
+        session.statuses = [503, 200]
+        session.retry_after = '5'
+        with pytest.raises(SciServerAPIError):
+            with sciserver.deadline(1):
+                send_request('http://test/tables')
+        assert len(session.sent) == 1
+
+    def test_bind(self):
+        results = []
+        with sciserver.deadline(5):
+            worker = bind_deadline(lambda: results.append(remaining()))
+        thread = threading.Thread(target=worker)
+        thread.start()
+        thread.join()
+        assert 0 < results[0] <= 5
+
+    def test_wait(self, skquery, monkeypatch):
+        monkeypatch.setattr(skquery, 'getJobStatus', lambda jobId: {'status': 'executing', 'queue': 'quick'})
+        start = time.time()
+        with pytest.raises(sciserver.exceptions.SciServerError):
+            with sciserver.deadline(0.2):
+                skquery.waitForJob('1', verbose=False)
+        assert time.time() - start < 1
+
+
+class TestCompression(object):
+
+    @pytest.fixture()
+    def gzipped(self, session, monkeypatch):
+        session.delay = 0
+        monkeypatch.setattr(config, 'compressUploads', ['http://test/upload'])
+        monkeypatch.setattr(config, 'compressMinSize', 100)
+        return session
+
+    def test_accept_encoding(self, session, monkeypatch):
+        send_request('http://test/tables')
+        assert 'gzip' in session.headers['Accept-Encoding']
+        monkeypatch.setattr(config, 'acceptEncoding', None)
+        assert accept_encoding() == 'identity'
+
+    def test_compressed_upload(self, gzipped):
+        body = b'a,b\n' + b'1,2\n' * 1000
+        send_request('http://test/upload/t', reqtype='put', data=body, compress=True)
+        assert gzipped.headers['Content-Encoding'] == 'gzip'
+        assert zlib.decompress(gzipped.data, 16 + zlib.MAX_WBITS) == body
+        send_request('http://test/upload/t', reqtype='put', data=iter([body[:10], body[10:]]), compress=True)
+        assert zlib.decompress(gzipped.data, 16 + zlib.MAX_WBITS) == body
+        stats = get_transport().stats()
+        assert stats['upload_bytes'] == 2 * len(body)
+        assert stats['upload_saved'] > len(body)
+
+    def test_uncompressed(self, gzipped):
+        for url, data, compress in [('http://test/upload/t', b'1,2\n', True),
+                                    ('http://test/other', b'1,2\n' * 1000, True),
+                                    ('http://test/upload/t', b'{}' * 1000, False)]:
+            send_request(url, reqtype='put', data=data, compress=compress)
+            assert gzipped.data == data
+            assert 'Content-Encoding' not in gzipped.headers
+
+    def test_unsupported(self, gzipped):
+        gzipped.statuses = [415]
+        send_request('http://test/upload/t', reqtype='put', data=b'1,2\n' * 1000, compress=True)
+        assert gzipped.data == b'1,2\n' * 1000
+        assert len(gzipped.sent) == 2
+        assert get_transport().compresses('http://test/upload/t') is None
+
+    def test_download_counters(self, session):
+        with ResponseStream(send_request('http://test/tables', stream=True)) as stream:
+            stream.read()
+        assert get_transport().stats()['download_bytes'] == len(b'http://test/tables')
+
+
+class TestHTTP2(object):
+
+    @pytest.fixture()
+    def h2session(self, monkeypatch):
+        httpx = pytest.importorskip('httpx')
+        failures = [httpx.ConnectError('refused')]
+
+        def handler(request):
+            if request.url.path == '/flaky' and failures:
+                raise failures.pop()
+            status = 404 if request.url.path == '/missing' else 200
+            return httpx.Response(status, content=request.url.path.encode() * 3)
+
+        monkeypatch.setattr(config, 'token', 'testtoken')
+        session = HTTP2Session(transport=httpx.MockTransport(handler))
+        previous = set_transport(Transport(session=session, retry=RetryPolicy(backoff=0.001)))
+        yield session
+        set_transport(previous)
+
+    def test_send(self, h2session):
+        response = send_request('https://test/tables')
+        assert response.ok and response.content == b'/tables' * 3
+        with ResponseStream(send_request('https://test/jobs', stream=True), chunk_size=4) as stream:
+            assert stream.read() == b'/jobs' * 3
+
+    def test_errors(self, h2session):
+        with pytest.raises(SciServerAPIError):
+            send_request('https://test/missing')
+        assert send_request('https://test/flaky').ok
+        assert get_transport().stats()['retry_errors'] == 1
+
+    def test_backend(self, monkeypatch):
+        pytest.importorskip('httpx')
+        previous = set_transport(None)
+        try:
+            monkeypatch.setattr(config, 'httpBackend', 'http2')
+            assert isinstance(get_transport().session, HTTP2Session)
+            monkeypatch.setattr(config, 'httpBackend', 'requests')
+            assert isinstance(get_transport().session, requests.Session)
+        finally:
+            set_transport(previous)
+
+    def test_async(self, session):
+        aio = pytest.importorskip('sciserver.aio')
+        session.delay = 0.1
+
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        start = time.time()
+        # aio calls need a running loop, so start them from a loop callback
+        calls = []
+        loop.call_soon(lambda: calls.append(asyncio.gather(
+            *[aio.send_request('http://test/{0}'.format(i)) for i in range(10)])))
+        loop.run_until_complete(asyncio.sleep(0))
+        responses = loop.run_until_complete(calls[0])
+        loop.close()
+        assert [r.content for r in responses] == ['http://test/{0}'.format(i).encode() for i in range(10)]
+        assert time.time() - start < 0.5
+
+
+class TestBackends(object):
+
+    @pytest.fixture()
+    def memory(self, monkeypatch):
+        monkeypatch.setattr(config, 'token', 'testtoken')
+        memory = MemorySession()
+        memory.add('get', r'/tables$', {'tables': ['PhotoObj']})
+        memory.add('post', r'/query$', lambda method, url, headers, body: (200, body.upper()))
+        memory.add('get', r'/missing$', 'gone', status_code=410)
+        previous = set_transport(Transport(session=memory, retry=RetryPolicy(backoff=0.001)))
+        yield memory
+        set_transport(previous)
+
+    def test_memory(self, memory):
+        assert send_request('http://test/tables').json() == {'tables': ['PhotoObj']}
+        assert send_request('http://test/query', reqtype='post', data='select 1').content == b'SELECT 1'
+        with pytest.raises(SciServerAPIError, match='gone'):
+            send_request('http://test/missing')
+        with pytest.raises(SciServerAPIError):
+            send_request('http://test/nowhere')
+        assert memory.requests[1] == ('post', 'http://test/query', b'select 1')
+
+    def test_record_replay(self, memory, tmpdir):
+        path = str(tmpdir.join('session.jsonl'))
+        memory.add('get', r'/jobs', lambda method, url, headers, body: MemoryResponse(
+            200, str(len(memory.requests)), headers={'X-Subject-Token': 'secret'}))
+        set_transport(Transport(session=RecordingSession(path, session=memory), coalesce=False))
+        recorded = [send_request('http://test/jobs/testtoken').content for i in range(3)]
+        recorded.append(send_request('http://test/query', reqtype='post', data='select 1').content)
+        assert 'testtoken' not in tmpdir.join('session.jsonl').read()
+        assert 'secret' not in tmpdir.join('session.jsonl').read()
+
+        config.token = 'othertoken'
+        set_transport(Transport(session=ReplaySession(path), coalesce=False))
+        replayed = [send_request('http://test/jobs/othertoken').content for i in range(4)]
+        assert replayed == recorded[:3] + recorded[2:3]
+        assert send_request('http://test/query', reqtype='post', data='select 1').content == recorded[3]
+        with pytest.raises(SciServerError, match='No recorded response'):
+            send_request('http://test/query', reqtype='post', data='select 2')
+
+    def test_backend(self, monkeypatch, tmpdir):
+        assert isinstance(new_session('memory'), MemorySession)
+        monkeypatch.setattr(config, 'transportRecording', None)
+        with pytest.raises(SciServerError, match='transportRecording'):
+            new_session('replay')
+        monkeypatch.setattr(config, 'transportRecording', str(tmpdir.join('session.jsonl')))
+        assert isinstance(new_session('record'), RecordingSession)
+        tmpdir.join('session.jsonl').write('')
+        assert isinstance(new_session('replay'), ReplaySession)
+        with pytest.raises(SciServerError, match='Unknown http backend'):
+            new_session('carrier-pigeon')
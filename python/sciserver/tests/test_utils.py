@@ -0,0 +1,59 @@
+# !usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Licensed under a 3-clause BSD license.
+#
+
+from __future__ import print_function, division, absolute_import
+import time
+from sciserver import config
+from sciserver.utils import RateLimiter, ResponseStream, should_stream
+
+
+class TestRateLimiter(object):
+
+    def test_burst(self):
+        limiter = RateLimiter(rate=1, burst=3)
+        assert all(limiter.acquire(block=False) for i in range(3))
+        assert limiter.acquire(block=False) is False
+
+    def test_refill(self):
+        limiter = RateLimiter(rate=50, burst=1)
+        assert limiter.acquire() is True
+        start = time.time()
+        assert limiter.acquire() is True
+        assert time.time() - start >= 0.01
+
+
+class TestResponseStream(object):
+
+    def test_read(self, fake_response):
+        stream = ResponseStream(fake_response(b'a,b\n1,2\n3,4\n'))
+        assert stream.read(2) == b'a,'
+        assert stream.read() == b'b\n1,2\n3,4\n'
+        assert stream.read() == b''
+        assert stream.nbytes == 12
+
+    def test_readline(self, fake_response):
+        stream = ResponseStream(fake_response(b'line one\nline two\nend'))
+        assert list(stream) == [b'line one\n', b'line two\n', b'end']
+
+    def test_transform(self, fake_response):
+        stream = ResponseStream(fake_response(b'{1 2},{3}'), transform=lambda c: c.replace(b'{', b'['))
+        assert stream.read() == b'[1 2},[3}'
+
+    def test_should_stream(self, fake_response, monkeypatch):
+        # no Content-Length, as for chunked or compressed responses
+        monkeypatch.setattr(config, 'streamThreshold', 100)
+        stream = ResponseStream(fake_response(b'x' * 101))
+        assert should_stream(stream) is True
+        assert stream.read() == b'x' * 101
+        stream = ResponseStream(fake_response(b'x' * 100))
+        assert should_stream(stream) is False
+        assert stream.read() == b'x' * 100
+
+    def test_pandas(self, fake_response):
+        import pandas
+        stream = ResponseStream(fake_response(b'a,b\n1,2\n3,4\n'))
+        df = pandas.read_csv(stream)
+        assert list(df['b']) == [2, 4]
@@ -0,0 +1,1294 @@
+# !usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Licensed under a 3-clause BSD license.
+#
+
+from __future__ import print_function, division, absolute_import
+from collections import Counter
+from contextlib import contextmanager
+from email.utils import parsedate_tz, mktime_tz
+from functools import wraps
+import base64
+import hashlib
+import json
+import os
+import re
+import random
+import threading
+import time
+import zlib
+import requests
+from requests.compat import urlparse
+from sciserver import config, metrics
+from sciserver.exceptions import SciServerError, SciServerCircuitOpenError, SciServerTimeoutError
+
+
+_deadlines = threading.local()
+
+
+def _deadline_stack():
+    if not hasattr(_deadlines, 'stack'):
+        _deadlines.stack = []
+    return _deadlines.stack
+
+
+@contextmanager
+def _deadline_at(expiry):
+    stack = _deadline_stack()
+    stack.append(min(expiry, stack[-1]) if stack else expiry)
+    try:
+        yield
+    finally:
+        stack.pop()
+
+
+def deadline(seconds):
+    ''' Context setting a time budget for all service calls made within it
+
+    Every request sent inside the context has its timeouts cut to the remaining
+    budget, retries stop when the budget runs out, and waits such as
+    SkyQuery.waitForJob and JobSet.wait give up at the deadline.  Nested deadlines
+    can only shorten the budget.  The deadline applies to the current thread, and
+    to the worker threads started by calls made within it.
+
+    Parameters:
+        seconds (float):
+            The time budget in seconds
+
+    Raises:
+        SciServerTimeoutError: when a call is made after the deadline has passed
+
+    Example:
+        >>> with sciserver.deadline(30):
+        >>>     df = CasJobs().executeQuery('select top 10 * from PhotoObj')
+
+    '''
+    return _deadline_at(time.time() + seconds)
+
+
+def remaining():
+    ''' Returns the seconds left before the current deadline, or None if there is no deadline '''
+    stack = _deadline_stack()
+    return stack[-1] - time.time() if stack else None
+
+
+def check_deadline():
+    ''' Raises SciServerTimeoutError if the current deadline has passed; returns the seconds left '''
+    left = remaining()
+    if left is not None and left <= 0:
+        raise SciServerTimeoutError('Deadline exceeded by {0:.1f} seconds'.format(-left))
+    return left
+
+
+def effective_timeout(timeout):
+    ''' Returns the smaller of timeout and the time left before the current deadline '''
+    left = check_deadline()
+    if left is None:
+        return timeout
+    return left if timeout is None else min(timeout, left)
+
+
+def bind_deadline(func):
+    ''' Wraps func to run under the current deadline, e.g. in a worker thread '''
+    stack = _deadline_stack()
+    if not stack:
+        return func
+    expiry = stack[-1]
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        with _deadline_at(expiry):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+class RetryPolicy(object):
+    ''' When and how often to retry a failed request
+
+    Requests failing with a connection error, or with one of the retryable status
+    codes, are retried with exponential backoff and full jitter: before the n-th
+    retry the transport sleeps a random time between 0 and ``backoff * 2**n``
+    seconds, at most ``max_backoff``.  A Retry-After header on the response, when
+    present, is used instead.  Only idempotent methods are retried, unless the
+    request is explicitly marked as idempotent.  Requests with a streamed body, e.g.
+    a generator, are never retried, as the body cannot be sent again.
+
+    Parameters:
+        total (int):
+            The maximum number of retries.  Default is 3.
+        backoff (float):
+            The base backoff time in seconds.  Default is 0.5.
+        max_backoff (float):
+            The maximum time to sleep between attempts, in seconds.  Default is 30.
+        statuses (tuple):
+            The HTTP status codes to retry.  Default is 429, 502, 503 and 504.
+        methods (tuple):
+            The request methods that are safe to retry.  Default is get and delete.
+
+    Example:
+        >>> get_transport().set_policy('https://skyserver.sdss.org', RetryPolicy(total=5, backoff=1))
+
+    '''
+
+    def __init__(self, total=3, backoff=0.5, max_backoff=30., statuses=(429, 502, 503, 504),
+                 methods=('get', 'delete')):
+        self.total = total
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.statuses = statuses
+        self.methods = methods
+
+    def __repr__(self):
+        return '<RetryPolicy(total={0}, backoff={1}, statuses={2})>'.format(self.total, self.backoff, self.statuses)
+
+    def can_retry(self, method, attempt, idempotent=None):
+        ''' Checks whether a request may be retried after a number of failed attempts '''
+        return attempt < self.total and (idempotent or method in self.methods)
+
+    def delay(self, attempt, retry_after=None):
+        ''' Returns the number of seconds to wait before retrying
+
+        Parameters:
+            attempt (int):
+                The number of failed attempts so far, minus one
+            retry_after (str):
+                The Retry-After header of the failed response, in seconds or as an HTTP date
+
+        '''
+        if retry_after:
+            try:
+                seconds = float(retry_after)
+            except ValueError:
+                date = parsedate_tz(retry_after)
+                seconds = mktime_tz(date) - time.time() if date else None
+            if seconds is not None:
+                return min(max(seconds, 0.), self.max_backoff)
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+
+class CircuitBreaker(object):
+    ''' Stops sending requests to a host after too many consecutive failures
+
+    After ``threshold`` consecutive failures the circuit opens, and requests are
+    rejected with SciServerCircuitOpenError for ``reset_timeout`` seconds.  The
+    first request after that is let through as a trial: the circuit closes again
+    if it succeeds, and reopens if it fails.
+
+    Parameters:
+        threshold (int):
+            The number of consecutive failures opening the circuit.  Default is 5.
+        reset_timeout (float):
+            The number of seconds the circuit stays open.  Default is 30.
+
+    '''
+
+    def __init__(self, threshold=5, reset_timeout=30.):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return '<CircuitBreaker(state={0}, failures={1})>'.format(self.state, self.failures)
+
+    @property
+    def state(self):
+        ''' The circuit state: closed, open or half-open '''
+        if self.opened is None:
+            return 'closed'
+        return 'open' if time.time() - self.opened < self.reset_timeout else 'half-open'
+
+    def allow(self):
+        ''' Returns 0 if a request may be sent, or else the seconds until the circuit may close '''
+        with self._lock:
+            if self.opened is None:
+                return 0
+            remaining = self.opened + self.reset_timeout - time.time()
+            if remaining > 0 or self._trial:
+                return max(remaining, 0.) or self.reset_timeout
+            self._trial = True
+            return 0
+
+    def success(self):
+        ''' Records a successful request, closing the circuit '''
+        with self._lock:
+            self.failures = 0
+            self.opened = None
+            self._trial = False
+
+    def failure(self):
+        ''' Records a failed request; returns True if this opened the circuit '''
+        with self._lock:
+            self.failures += 1
+            reopen = self._trial
+            self._trial = False
+            if reopen or (self.opened is None and self.failures >= self.threshold):
+                self.opened = time.time()
+                return True
+            return False
+
+
+def _flock(fileobj, blocking=True):
+    ''' Locks a file exclusively, returning False if it is locked and blocking is False '''
+    try:
+        import fcntl
+    except ImportError:
+        raise SciServerError('Process-shared rate limits need fcntl, which is not available on this platform')
+    try:
+        fcntl.flock(fileobj, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except (IOError, OSError):
+        if blocking:
+            raise
+        return False
+    return True
+
+
+def _funlock(fileobj):
+    import fcntl
+    fcntl.flock(fileobj, fcntl.LOCK_UN)
+
+
+class RateLimiter(object):
+    ''' A thread-safe token bucket rate limiter
+
+    Tokens are added to the bucket at a constant rate, up to a maximum
+    of ``burst`` tokens.  Each call to :meth:`acquire` removes tokens from
+    the bucket, blocking until enough tokens are available.
+
+    Parameters:
+        rate (float):
+            The number of tokens added per second
+        burst (int):
+            The maximum number of tokens the bucket can hold.  Default is 1.
+
+    Example:
+        >>> limiter = RateLimiter(rate=5, burst=5)
+        >>> limiter.acquire()
+
+    '''
+
+    def __init__(self, rate, burst=1):
+        assert rate > 0, 'rate must be a positive number'
+        assert burst >= 1, 'burst must be at least 1'
+        self.rate = float(rate)
+        self.burst = burst
+        self._tokens = float(burst)
+        self._last = time.time()
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return '<RateLimiter(rate={0}, burst={1})>'.format(self.rate, self.burst)
+
+    @contextmanager
+    def _state(self):
+        ''' Context holding the bucket exclusively; yields its [tokens, last refill time], stored on exit '''
+        with self._lock:
+            state = [self._tokens, self._last]
+            yield state
+            self._tokens, self._last = state
+
+    def _take(self, tokens):
+        ''' Refills the bucket and takes tokens from it; returns 0 if taken, or else the seconds to wait '''
+        with self._state() as state:
+            now = time.time()
+            available = min(self.burst, state[0] + (now - state[1]) * self.rate)
+            wait = 0 if available >= tokens else (tokens - available) / self.rate
+            state[:] = [available if wait else available - tokens, now]
+        return wait
+
+    def acquire(self, tokens=1, block=True):
+        ''' Acquire tokens from the bucket
+
+        Parameters:
+            tokens (int):
+                The number of tokens to acquire.  Default is 1.
+            block (bool):
+                If True, waits until the tokens are available.  Otherwise returns immediately.
+
+        Returns:
+            True if the tokens were acquired, False otherwise
+
+        '''
+        assert tokens <= self.burst, 'Cannot acquire more tokens than the burst size'
+        while True:
+            wait = self._take(tokens)
+            if not wait:
+                return True
+            if not block:
+                return False
+            time.sleep(wait)
+
+
+class FileRateLimiter(RateLimiter):
+    ''' A token bucket rate limiter shared by all processes using the same file
+
+    The bucket state is kept in a small file, read and updated under an exclusive
+    file lock, instead of in memory.
+
+    Parameters:
+        path (str):
+            The path of the state file
+        rate (float):
+            The number of tokens added per second
+        burst (int):
+            The maximum number of tokens the bucket can hold.  Default is 1.
+
+    '''
+
+    def __init__(self, path, rate, burst=1):
+        super(FileRateLimiter, self).__init__(rate, burst)
+        self.path = path
+
+    def __repr__(self):
+        return '<FileRateLimiter(path={0}, rate={1}, burst={2})>'.format(self.path, self.rate, self.burst)
+
+    @contextmanager
+    def _state(self):
+        with os.fdopen(os.open(self.path, os.O_RDWR | os.O_CREAT), 'r+') as fileobj:
+            _flock(fileobj)
+            try:
+                values = fileobj.read().split()
+                state = [float(values[0]), float(values[1])] if len(values) == 2 else [float(self.burst), time.time()]
+                yield state
+                fileobj.seek(0)
+                fileobj.truncate()
+                fileobj.write('{0!r} {1!r}'.format(*state))
+                fileobj.flush()
+            finally:
+                _funlock(fileobj)
+
+
+class FileSemaphore(object):
+    ''' A counting semaphore shared by all processes using the same files
+
+    Each of the ``value`` slots is a lock file; acquiring the semaphore locks a free
+    slot.  Slots are released automatically if the holding process exits.
+
+    Parameters:
+        path (str):
+            The path prefix of the slot files
+        value (int):
+            The number of slots
+
+    '''
+
+    def __init__(self, path, value, poll=0.01):
+        self.path = path
+        self.value = value
+        self.poll = poll
+
+    def __repr__(self):
+        return '<FileSemaphore(path={0}, value={1})>'.format(self.path, self.value)
+
+    def acquire(self):
+        ''' Waits for a free slot, and returns the locked slot file '''
+        while True:
+            for i in range(self.value):
+                slot = open('{0}.{1}'.format(self.path, i), 'a')
+                if _flock(slot, blocking=False):
+                    return slot
+                slot.close()
+            time.sleep(self.poll)
+
+    def release(self, slot):
+        ''' Releases a slot returned by acquire '''
+        _funlock(slot)
+        slot.close()
+
+
+class ServiceLimiter(object):
+    ''' Limits the request rate and the number of concurrent requests to a service
+
+    Used by the Transport for each base url listed in config.rateLimits.  The limits
+    are shared by all threads, and, with a lockfile, by all processes on the machine.
+
+    Parameters:
+        rate (float):
+            The maximum number of requests per second.  Default is no limit.
+        burst (int):
+            The number of requests that can be sent at once before the rate applies.  Default is 1.
+        concurrency (int):
+            The maximum number of requests in flight.  Default is no limit.
+        lockfile (str):
+            If set, the path prefix of the files sharing the limits across processes
+
+    '''
+
+    def __init__(self, rate=None, burst=1, concurrency=None, lockfile=None):
+        self.rate = rate
+        self.burst = burst
+        self.concurrency = concurrency
+        self.lockfile = lockfile
+        self.rate_limiter = None
+        if rate:
+            self.rate_limiter = FileRateLimiter(lockfile + '.rate', rate, burst) if lockfile else RateLimiter(rate, burst)
+        self.semaphore = threading.BoundedSemaphore(concurrency) if concurrency else None
+        self.slots = FileSemaphore(lockfile + '.slot', concurrency) if concurrency and lockfile else None
+
+    def __repr__(self):
+        return '<ServiceLimiter(rate={0}, burst={1}, concurrency={2})>'.format(self.rate, self.burst, self.concurrency)
+
+    @contextmanager
+    def limit(self):
+        ''' Context holding a concurrency slot and a rate token; yields the seconds waited for them '''
+        start = time.time()
+        if self.semaphore:
+            self.semaphore.acquire()
+        try:
+            slot = self.slots.acquire() if self.slots else None
+            try:
+                if self.rate_limiter:
+                    self.rate_limiter.acquire()
+                yield time.time() - start
+            finally:
+                if slot:
+                    self.slots.release(slot)
+        finally:
+            if self.semaphore:
+                self.semaphore.release()
+
+
+def accept_encoding():
+    ''' Returns the Accept-Encoding header value for requests, from config.acceptEncoding
+
+    With config.acceptEncoding set to 'auto', accepts every content coding the
+    installed urllib3 can decode: gzip and deflate, plus zstd and br when the
+    zstandard and brotli packages are installed.
+
+    '''
+    if config.acceptEncoding != 'auto':
+        return config.acceptEncoding or 'identity'
+    try:
+        from urllib3.util.request import ACCEPT_ENCODING
+    except ImportError:
+        return 'gzip, deflate'
+    return ', '.join(coding.strip() for coding in ACCEPT_ENCODING.split(','))
+
+
+def _gzip_chunks(chunks, counters=None):
+    ''' Gzip-compresses an iterable of byte strings incrementally '''
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        if not isinstance(chunk, bytes):
+            chunk = chunk.encode('utf8')
+        out = compressor.compress(chunk)
+        if counters is not None:
+            counters('upload_bytes', len(chunk))
+            counters('upload_wire_bytes', len(out))
+        if out:
+            yield out
+    out = compressor.flush()
+    if counters is not None:
+        counters('upload_wire_bytes', len(out))
+    yield out
+
+
+def _iter_file(fileobj, chunk_size=2**20):
+    return iter(lambda: fileobj.read(chunk_size), b'')
+
+
+def _replayer(data):
+    ''' Returns a function returning the request body for another attempt, or None if it cannot be resent
+
+    Bytes, strings and form data are resent as they are, and seekable files from where they started.
+    Iterators, such as streamed uploads, are consumed by the first attempt.
+    '''
+    if data is None or isinstance(data, (bytes, type(u''), dict, list, tuple)):
+        return lambda: data
+    if hasattr(data, 'seek') and hasattr(data, 'tell'):
+        try:
+            start = data.tell()
+        except (IOError, OSError):
+            return None
+
+        def rewind():
+            data.seek(start)
+            return data
+        return rewind
+    return None
+
+
+class SingleFlight(object):
+    ''' Runs at most one call per key at a time
+
+    Callers asking for a key while a call for that key is in flight wait for it
+    and receive its result (or its exception) instead of making their own call.
+
+    Attributes:
+        deduplicated (int):
+            The number of calls that were answered by another in-flight call
+
+    Example:
+        >>> flight = SingleFlight()
+        >>> flight.do(('get', url), lambda: requests.get(url))
+
+    '''
+
+    def __init__(self):
+        self.deduplicated = 0
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._calls)
+
+    def do(self, key, func):
+        ''' Calls func, or waits for the in-flight call of the same key
+
+        Parameters:
+            key:
+                a hashable identifying the call
+            func (callable):
+                the function to call
+
+        Returns:
+            the result of func
+
+        '''
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = {'event': threading.Event(), 'result': None, 'error': None}
+            else:
+                self.deduplicated += 1
+
+        if not leader:
+            call['event'].wait()
+            if call['error'] is not None:
+                raise call['error']
+            return call['result']
+
+        try:
+            call['result'] = func()
+        except Exception as e:
+            call['error'] = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call['event'].set()
+        return call['result']
+
+
+class Session(object):
+    ''' The interface of the sessions a Transport sends requests with
+
+    A session has a request method taking the method, url, headers, data, stream and
+    (connect, read) timeout of a request, and returning an object with the parts of
+    the requests.Response interface used by the services: status_code, ok, headers,
+    content, text, json, iter_content, raise_for_status and close.  requests.Session
+    is a session; the other sessions here subclass this class.
+
+    '''
+
+    def request(self, method, url, headers=None, data=None, stream=None, timeout=None):
+        raise NotImplementedError('Sessions must implement request')
+
+    def close(self):
+        pass
+
+
+class MemoryResponse(object):
+    ''' An in-memory response, with the parts of the requests.Response interface used by the services '''
+
+    def __init__(self, status_code=200, content=b'', headers=None, url=None, reason=None):
+        if isinstance(content, type(u'')):
+            content = content.encode('utf8')
+        self.status_code = status_code
+        self.content = content
+        self.headers = requests.structures.CaseInsensitiveDict(headers or {})
+        self.url = url
+        self.reason = reason or ('OK' if status_code < 400 else 'Error')
+        self.raw = None
+
+    def __repr__(self):
+        return '<MemoryResponse [{0}]>'.format(self.status_code)
+
+    @property
+    def ok(self):
+        return self.status_code < 400
+
+    @property
+    def text(self):
+        return self.content.decode('utf8')
+
+    def json(self, **kwargs):
+        return json.loads(self.text, **kwargs)
+
+    def iter_content(self, chunk_size=1):
+        chunk_size = chunk_size or len(self.content) or 1
+        for i in range(0, len(self.content), chunk_size):
+            yield self.content[i:i + chunk_size]
+
+    def raise_for_status(self):
+        if not self.ok:
+            raise requests.HTTPError('{0} Error: {1} for url: {2}'.format(self.status_code, self.reason, self.url),
+                                     response=self)
+
+    def close(self):
+        pass
+
+
+def _body_bytes(data):
+    ''' Reads a request body of bytes, text, a file or an iterable of chunks into bytes '''
+    if data is None:
+        return b''
+    if isinstance(data, type(u'')):
+        return data.encode('utf8')
+    if isinstance(data, bytes):
+        return data
+    if hasattr(data, 'read'):
+        data = _iter_file(data)
+    return b''.join(chunk.encode('utf8') if isinstance(chunk, type(u'')) else chunk for chunk in data)
+
+
+class MemorySession(Session):
+    ''' An in-memory fake of the SciServer services
+
+    Answers requests from registered routes, without any network access.  Each route
+    matches a method and a url regular expression, and answers with a fixed
+    response or with the result of a handler.
+
+    Attributes:
+        requests (list):
+            The (method, url, body) of every request received
+
+    Example:
+        >>> session = MemorySession()
+        >>> session.add('get', r'/SqlSearch', b'#Table1\nobjid\n1237\n')
+        >>> session.add('post', r'/contexts/[^/]+/query', lambda method, url, headers, body: (200, b'{}'))
+        >>> set_transport(Transport(session=session))
+
+    '''
+
+    def __init__(self):
+        self.routes = []
+        self.requests = []
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return '<MemorySession(routes={0})>'.format(len(self.routes))
+
+    def add(self, method, pattern, response=b'', status_code=200, headers=None):
+        ''' Adds a route
+
+        Parameters:
+            method (str):
+                The request method, or None for any method
+            pattern (str):
+                A regular expression searched for in the request url
+            response:
+                The response body (bytes, text, or a JSON-serializable dict or list), or a
+                handler called with the method, url, headers and body bytes of the request,
+                and returning a MemoryResponse, or a (status_code, body[, headers]) tuple
+            status_code (int):
+                The status code of a fixed response.  Default is 200.
+            headers (dict):
+                The headers of a fixed response
+
+        '''
+        self.routes.insert(0, (method.lower() if method else None, re.compile(pattern), response,
+                               status_code, headers))
+
+    def request(self, method, url, headers=None, data=None, stream=None, timeout=None):
+        body = _body_bytes(data)
+        with self._lock:
+            self.requests.append((method, url, body))
+        for rmethod, pattern, response, status_code, rheaders in self.routes:
+            if rmethod in (None, method.lower()) and pattern.search(url):
+                break
+        else:
+            return MemoryResponse(404, 'No route for {0} {1}'.format(method.upper(), url), url=url)
+
+        if callable(response):
+            response = response(method, url, headers or {}, body)
+            if isinstance(response, MemoryResponse):
+                response.url = response.url or url
+                return response
+            status_code, response, rheaders = (tuple(response) + (None,))[:3]
+        if isinstance(response, (dict, list)):
+            response = json.dumps(response)
+        return MemoryResponse(status_code, response, rheaders, url=url)
+
+
+SENSITIVE_HEADERS = ('X-Auth-Token', 'X-Subject-Token')
+
+
+def _mask_token(url):
+    ''' Replaces the user token in a url with a placeholder '''
+    return url.replace(config.token, '{token}') if config.token else url
+
+
+class RecordingSession(Session):
+    ''' Sends requests with another session, and records them and their responses to a file
+
+    Each exchange is appended to the file as a line of JSON, with the method, the url,
+    a digest of the request body, the response status, headers and body, and the time
+    the response took.  Tokens in urls and headers are not recorded.  Streamed
+    responses are read in full before they are returned.
+
+    Parameters:
+        path (str):
+            The path of the recording
+        session (Session):
+            The session sending the requests.  Default is a requests.Session.
+
+    Example:
+        >>> config.httpBackend = 'record'
+        >>> config.transportRecording = 'session.jsonl'
+
+    '''
+
+    def __init__(self, path, session=None):
+        self.path = path
+        self.session = session or requests.Session()
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return '<RecordingSession(path={0})>'.format(self.path)
+
+    def request(self, method, url, headers=None, data=None, stream=None, timeout=None):
+        body = _body_bytes(data) if data is not None else None
+        start = time.time()
+        response = self.session.request(method, url, headers=headers, data=body, stream=stream, timeout=timeout)
+        content = response.content
+        elapsed = time.time() - start
+        rheaders = dict((key, 'recorded' if key.title() in SENSITIVE_HEADERS else value)
+                        for key, value in response.headers.items()
+                        if key.lower() not in ('content-encoding', 'content-length', 'transfer-encoding'))
+        record = {'method': method.lower(), 'url': _mask_token(url),
+                  'body': hashlib.sha1(body or b'').hexdigest(), 'status': response.status_code,
+                  'headers': rheaders, 'content': base64.b64encode(content).decode(), 'elapsed': elapsed}
+        with self._lock:
+            with open(self.path, 'a') as recording:
+                recording.write(json.dumps(record) + '\n')
+        return MemoryResponse(response.status_code, content, response.headers, url=url)
+
+    def close(self):
+        self.session.close()
+
+
+class ReplaySession(Session):
+    ''' Answers requests from a recording made with RecordingSession
+
+    Requests are matched to recorded exchanges by method, url and request body.
+    Repeated identical requests get the recorded responses in their recorded order,
+    and the last one once those run out.  Requests missing from the recording raise
+    requests.ConnectionError.
+
+    Parameters:
+        path (str):
+            The path of the recording
+        latency (float):
+            If set, each response is delayed by its recorded time multiplied by latency,
+            e.g. 1 to replay at the recorded speed.  Default is to answer at once.
+
+    Example:
+        >>> config.httpBackend = 'replay'
+        >>> config.transportRecording = 'session.jsonl'
+
+    '''
+
+    def __init__(self, path, latency=None):
+        self.path = path
+        self.latency = latency
+        self.records = {}
+        self._lock = threading.Lock()
+        with open(path) as recording:
+            for line in recording:
+                if line.strip():
+                    record = json.loads(line)
+                    self.records.setdefault((record['method'], record['url'], record['body']), []).append(record)
+
+    def __repr__(self):
+        return '<ReplaySession(path={0}, exchanges={1})>'.format(self.path, sum(map(len, self.records.values())))
+
+    def request(self, method, url, headers=None, data=None, stream=None, timeout=None):
+        key = (method.lower(), _mask_token(url), hashlib.sha1(_body_bytes(data)).hexdigest())
+        with self._lock:
+            records = self.records.get(key)
+            if not records:
+                raise requests.ConnectionError('No recorded response for {0} {1}'.format(method.upper(), url))
+            record = records.pop(0) if len(records) > 1 else records[0]
+        if self.latency:
+            time.sleep(record['elapsed'] * self.latency)
+        return MemoryResponse(record['status'], base64.b64decode(record['content']), record['headers'], url=url)
+
+
+class HTTP2Response(object):
+    ''' An httpx response, with the parts of the requests.Response interface used by the services '''
+
+    def __init__(self, response):
+        self._response = response
+        self.status_code = response.status_code
+        self.headers = response.headers
+        self.url = str(response.url)
+        self.reason = response.reason_phrase
+        self.http_version = response.http_version
+        self.raw = self
+
+    def __repr__(self):
+        return '<HTTP2Response [{0}]>'.format(self.status_code)
+
+    @property
+    def ok(self):
+        return self.status_code < 400
+
+    @property
+    def content(self):
+        return self._response.read()
+
+    @property
+    def text(self):
+        self._response.read()
+        return self._response.text
+
+    def json(self, **kwargs):
+        return json.loads(self.content.decode(), **kwargs)
+
+    def iter_content(self, chunk_size=1):
+        return self._response.iter_bytes(chunk_size)
+
+    def tell(self):
+        ''' Returns the number of bytes received on the wire so far '''
+        return self._response.num_bytes_downloaded
+
+    def raise_for_status(self):
+        if not self.ok:
+            raise requests.HTTPError('{0} Error: {1} for url: {2}'.format(self.status_code, self.reason, self.url),
+                                     response=self)
+
+    def close(self):
+        self._response.close()
+
+
+class HTTP2Session(Session):
+    ''' Sends requests over HTTP/2 with httpx, multiplexing concurrent requests to a host over one connection
+
+    A drop-in replacement for requests.Session in a Transport.  httpx errors are raised as the
+    matching requests exceptions, so retries work the same with both backends.  HTTP/2 is
+    negotiated over TLS, so plain http urls are still sent over HTTP/1.1.
+
+    Parameters:
+        kwargs:
+            Arguments passed to httpx.Client, e.g. verify or limits
+
+    '''
+
+    def __init__(self, **kwargs):
+        try:
+            import httpx
+        except ImportError:
+            raise SciServerError('The http2 backend needs httpx with HTTP/2 support. Install it with: '
+                                 'pip install "httpx[http2]"')
+        self._httpx = httpx
+        self.client = httpx.Client(http2=True, **kwargs)
+
+    def __repr__(self):
+        return '<HTTP2Session()>'
+
+    def request(self, method, url, headers=None, data=None, stream=None, timeout=None):
+        httpx = self._httpx
+        if isinstance(data, type(u'')):
+            data = data.encode('utf8')
+        elif hasattr(data, 'read'):
+            data = _iter_file(data)
+        timeout = httpx.Timeout(None, connect=timeout[0], read=timeout[1]) if timeout else httpx.Timeout(None)
+        try:
+            request = self.client.build_request(method.upper(), url, headers=headers, content=data, timeout=timeout)
+            response = self.client.send(request, stream=True)
+            if not stream:
+                response.read()
+        except httpx.ConnectTimeout as e:
+            raise requests.ConnectTimeout(e)
+        except httpx.TimeoutException as e:
+            raise requests.ReadTimeout(e)
+        except httpx.TransportError as e:
+            raise requests.ConnectionError(e)
+        return HTTP2Response(response)
+
+    def close(self):
+        self.client.close()
+
+
+def new_session(backend=None):
+    ''' Returns a new session of a backend
+
+    Parameters:
+        backend (str):
+            The backend, default is config.httpBackend:
+            'requests' for HTTP/1.1 with requests,
+            'http2' for HTTP/2 with httpx,
+            'memory' for an empty MemorySession,
+            'record' to send requests with requests and record them to config.transportRecording,
+            'replay' to answer requests from config.transportRecording.
+
+    '''
+    backend = backend or config.httpBackend
+    if backend == 'requests':
+        return requests.Session()
+    elif backend == 'http2':
+        return HTTP2Session()
+    elif backend == 'memory':
+        return MemorySession()
+    elif backend in ('record', 'replay'):
+        if not config.transportRecording:
+            raise SciServerError('Set config.transportRecording to the path of the recording')
+        if backend == 'record':
+            return RecordingSession(config.transportRecording)
+        return ReplaySession(config.transportRecording, latency=config.replayLatency)
+    raise SciServerError('Unknown http backend {0}. Choose requests, http2, memory, record or replay'.format(backend))
+
+
+class Transport(object):
+    ''' The HTTP transport used by send_request
+
+    Sends requests through a shared session of the backend chosen by
+    config.httpBackend: requests.Session, or HTTP2Session.  Coalesces concurrent
+    identical GET requests into one: while a GET is in flight, other threads
+    sending the same url with the same headers wait for it and share its
+    response.  Streamed GETs are never coalesced, since their body can only be
+    read once.
+
+    Failed requests are retried according to the RetryPolicy of the url (see
+    set_policy), and each host has a CircuitBreaker suspending requests to it
+    after too many consecutive connection errors, timeouts or responses with the
+    retryable statuses of its policy (e.g. 503).  Other errors, such as a 500 for
+    a bad query, show the host is up and do not count.  Requests to
+    the base urls in config.rateLimits go through a ServiceLimiter.
+
+    Responses are requested with the content codings from accept_encoding() and
+    decoded as they are read.  Upload bodies sent with compress=True to the base
+    urls in config.compressUploads are gzip-compressed; a service answering 415
+    (Unsupported Media Type) is sent the plain body instead, and no longer sent
+    compressed bodies.
+
+    Parameters:
+        session (requests.Session):
+            The session to send requests with.  Default is a new session of config.httpBackend.
+        coalesce (bool):
+            If True, coalesces concurrent identical GET requests.  Default is True.
+        retry (RetryPolicy):
+            The default retry policy.  Default is RetryPolicy().
+        breaker_threshold (int):
+            The number of consecutive failures suspending requests to a host.  Default is 5.
+        breaker_timeout (float):
+            The number of seconds requests to a failing host are suspended.  Default is 30.
+
+    Example:
+        >>> transport = get_transport()
+        >>> transport.stats()
+        {'requests': 12, 'sent': 10, 'coalesced': 3, 'retries': 1, 'retry_statuses': 1}
+
+    '''
+
+    coalesced_methods = ('get',)
+
+    def __init__(self, session=None, coalesce=True, retry=None, breaker_threshold=5, breaker_timeout=30.):
+        self.backend = None if session else config.httpBackend
+        self.session = session or new_session()
+        self.coalesce = coalesce
+        self.retry = retry or RetryPolicy()
+        self.policies = {}
+        self.breaker_threshold = breaker_threshold
+        self.breaker_timeout = breaker_timeout
+        self.breakers = {}
+        self.limiters = {}
+        self.uncompressed = set()
+        self.counters = Counter()
+        self._flight = SingleFlight()
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return '<Transport(coalesce={0}, inflight={1})>'.format(self.coalesce, len(self._flight))
+
+    def _count(self, name, value=1):
+        with self._lock:
+            self.counters[name] += value
+
+    def set_policy(self, prefix, policy):
+        ''' Sets the retry policy for all urls starting with prefix
+
+        Parameters:
+            prefix (str):
+                The url prefix, e.g. config.CasJobsRESTUri
+            policy (RetryPolicy):
+                The retry policy, or None to remove the policy for prefix
+
+        '''
+        if policy is None:
+            self.policies.pop(prefix, None)
+        else:
+            self.policies[prefix] = policy
+
+    def policy_for(self, url):
+        ''' Returns the retry policy of the longest matching prefix, or the default policy '''
+        matches = [prefix for prefix in self.policies if url.startswith(prefix)]
+        return self.policies[max(matches, key=len)] if matches else self.retry
+
+    def breaker(self, url):
+        ''' Returns the CircuitBreaker of the host of a url '''
+        host = urlparse(url).netloc
+        with self._lock:
+            if host not in self.breakers:
+                self.breakers[host] = CircuitBreaker(self.breaker_threshold, self.breaker_timeout)
+            return self.breakers[host]
+
+    def limiter(self, url):
+        ''' Returns the ServiceLimiter of the longest base url in config.rateLimits matching url, if any '''
+        matches = [prefix for prefix in config.rateLimits if url.startswith(prefix)]
+        if not matches:
+            return None
+        prefix = max(matches, key=len)
+        settings = dict(config.rateLimits[prefix])
+        if config.rateLimitLockDir:
+            digest = hashlib.sha1(prefix.encode('utf8')).hexdigest()[:16]
+            settings['lockfile'] = os.path.join(config.rateLimitLockDir, 'sciserver-{0}'.format(digest))
+        key = tuple(sorted(settings.items()))
+        with self._lock:
+            limiter = self.limiters.get(prefix)
+            if limiter is None or limiter[0] != key:
+                limiter = self.limiters[prefix] = (key, ServiceLimiter(**settings))
+        return limiter[1]
+
+    @staticmethod
+    def timeouts(timeout=None):
+        ''' Returns the (connect, read) timeouts of a request
+
+        Parameters:
+            timeout (float|tuple):
+                The timeout of the request in seconds, or a (connect, read) tuple.  Default
+                is (config.connectTimeout, config.readTimeout).  Either is cut to the time
+                left before the current deadline.
+
+        '''
+        if timeout is None:
+            timeout = (config.connectTimeout, config.readTimeout)
+        elif not isinstance(timeout, tuple):
+            timeout = (timeout, timeout)
+        timeout = tuple(effective_timeout(t) for t in timeout)
+        return None if timeout == (None, None) else timeout
+
+    def compresses(self, url):
+        ''' Returns the base url in config.compressUploads matching url, if uploads to it are compressed '''
+        matches = [prefix for prefix in config.compressUploads if url.startswith(prefix)]
+        prefix = max(matches, key=len) if matches else None
+        return prefix if prefix not in self.uncompressed else None
+
+    def _compress(self, data, headers):
+        ''' Returns the gzip-compressed body and headers, or None if the body is too small to compress '''
+        if isinstance(data, type(u'')):
+            data = data.encode('utf8')
+        if isinstance(data, bytes):
+            if len(data) < config.compressMinSize:
+                return None
+            body = b''.join(_gzip_chunks([data]))
+            self._count('upload_bytes', len(data))
+            self._count('upload_wire_bytes', len(body))
+        elif hasattr(data, 'read'):
+            body = _gzip_chunks(_iter_file(data), self._count)
+        elif hasattr(data, '__iter__') and not isinstance(data, dict):
+            body = _gzip_chunks(data, self._count)
+        else:
+            return None
+        headers = dict(headers or {}, **{'Content-Encoding': 'gzip'})
+        return body, headers
+
+    def count_download(self, response, nbytes):
+        ''' Counts the decoded and on-the-wire sizes of a response body read in full '''
+        raw = getattr(response, 'raw', None)
+        wire = raw.tell() if hasattr(raw, 'tell') else None
+        self._count('download_bytes', nbytes)
+        self._count('download_wire_bytes', nbytes if wire is None else wire)
+
+    def request(self, method, url, headers=None, data=None, stream=None, idempotent=None, timeout=None,
+                compress=False):
+        ''' Sends a request
+
+        Parameters:
+            method (str):
+                The request method, e.g. get, post, put, delete
+            url (str):
+                The url of the request
+            headers (dict):
+                The request headers
+            data:
+                Optional body of the request
+            stream (bool):
+                If True, does not download the response content immediately
+            idempotent (bool):
+                If True, the request may be retried even if its method is not idempotent
+            timeout (float|tuple):
+                The timeout in seconds, or a (connect, read) tuple.  See Transport.timeouts.
+            compress (bool):
+                If True, the body is an upload that may be gzip-compressed
+
+        Returns:
+            the requests.Response
+
+        Raises:
+            SciServerCircuitOpenError: when requests to the host are suspended
+            SciServerTimeoutError: when the current deadline has passed
+
+        '''
+        method = method.lower()
+        call = metrics.start_request(method, url, data)
+        try:
+            response = self._request(method, url, headers, data, stream, idempotent, timeout, compress)
+        except Exception as e:
+            metrics.end_request(call, error=e)
+            raise
+        metrics.end_request(call, response, stream=stream)
+        return response
+
+    def _request(self, method, url, headers, data, stream, idempotent, timeout, compress):
+        ''' Sends a request, compressing or coalescing it as needed '''
+        self._count('requests')
+        headers = dict(headers or {}, **{'Accept-Encoding': accept_encoding()})
+
+        prefix = self.compresses(url) if compress and data is not None else None
+        compressed = self._compress(data, headers) if prefix else None
+        if compressed:
+            response = self._send(method, url, compressed[1], compressed[0], stream, idempotent, timeout)
+            if response.status_code != 415 or not isinstance(compressed[0], bytes):
+                return response
+            response.close()
+            self.uncompressed.add(prefix)
+        if self.coalesce and method in self.coalesced_methods and not stream and data is None:
+            key = (method, url, tuple(sorted((headers or {}).items())))
+            return self._flight.do(key, lambda: self._send(method, url, headers, data, stream, idempotent, timeout))
+        return self._send(method, url, headers, data, stream, idempotent, timeout)
+
+    def _send(self, method, url, headers, data, stream, idempotent=None, timeout=None):
+        ''' Sends a request, retrying it according to the retry policy of the url '''
+        policy = self.policy_for(url)
+        breaker = self.breaker(url)
+        limiter = self.limiter(url)
+        replay = _replayer(data)
+        attempt = 0
+        while True:
+            wait = breaker.allow()
+            if wait:
+                self._count('circuit_rejected')
+                raise SciServerCircuitOpenError(urlparse(url).netloc, wait)
+
+            if attempt:
+                data = replay()
+            try:
+                response = self._limited(limiter, method, url, headers, data, stream, timeout)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                self._failure(breaker)
+                if isinstance(e, requests.Timeout) and remaining() is not None and remaining() <= 0:
+                    raise SciServerTimeoutError('Deadline exceeded while waiting for {0}'.format(url))
+                delay = policy.delay(attempt)
+                if not replay or not policy.can_retry(method, attempt, idempotent) or not self._in_budget(delay):
+                    raise
+                self._count('retry_errors')
+                reason = type(e).__name__
+            else:
+                # only overload and gateway errors mean the host is failing, not e.g. a 500 for a bad query
+                if response.status_code in policy.statuses:
+                    self._failure(breaker)
+                else:
+                    breaker.success()
+                if (response.status_code not in policy.statuses or not replay or
+                        not policy.can_retry(method, attempt, idempotent)):
+                    if not stream:
+                        self.count_download(response, len(response.content))
+                    return response
+                delay = policy.delay(attempt, response.headers.get('Retry-After'))
+                if not self._in_budget(delay):
+                    return response
+                response.close()
+                self._count('retry_statuses')
+                reason = response.status_code
+
+            self._count('retries')
+            metrics.retry(url, attempt + 1, reason, delay)
+            attempt += 1
+            time.sleep(delay)
+
+    @staticmethod
+    def _in_budget(delay):
+        ''' Checks whether a retry after delay seconds would start before the current deadline '''
+        left = remaining()
+        return left is None or delay < left
+
+    def _limited(self, limiter, method, url, headers, data, stream, timeout):
+        ''' Sends one HTTP request, within the limits of the service '''
+        if limiter is None:
+            self._count('sent')
+            return self.session.request(method, url, headers=headers, data=data, stream=stream,
+                                        timeout=self.timeouts(timeout))
+        with limiter.limit() as waited:
+            if waited > 0.001:
+                self._count('throttled')
+                self._count('throttle_seconds', waited)
+            self._count('sent')
+            return self.session.request(method, url, headers=headers, data=data, stream=stream,
+                                        timeout=self.timeouts(timeout))
+
+    def _failure(self, breaker):
+        if breaker.failure():
+            self._count('circuit_opened')
+
+    def stats(self):
+        ''' Returns the request counters
+
+        Counts the requests made, the HTTP requests sent, the requests coalesced, the retries
+        (after connection errors and after retryable statuses), the times a circuit
+        opened, the requests rejected by an open circuit, the requests delayed by a
+        service limit along with the total seconds they waited, and the decoded and
+        on-the-wire bytes of downloads and compressed uploads, with the bytes saved.
+
+        '''
+        with self._lock:
+            counters = dict(self.counters)
+        for name in ('requests', 'sent', 'retries', 'retry_errors', 'retry_statuses',
+                     'circuit_opened', 'circuit_rejected', 'throttled', 'throttle_seconds',
+                     'download_bytes', 'download_wire_bytes', 'upload_bytes', 'upload_wire_bytes'):
+            counters.setdefault(name, 0)
+        counters['download_saved'] = counters['download_bytes'] - counters['download_wire_bytes']
+        counters['upload_saved'] = counters['upload_bytes'] - counters['upload_wire_bytes']
+        counters['coalesced'] = self._flight.deduplicated
+        return counters
+
+    def reset_stats(self):
+        ''' Resets the request counters '''
+        with self._lock:
+            self.counters.clear()
+            self._flight.deduplicated = 0
+
+
+_transport = None
+_transport_lock = threading.Lock()
+
+
+def get_transport():
+    ''' Returns the transport used by send_request, creating it on first use or when config.httpBackend changes '''
+    global _transport
+    with _transport_lock:
+        if _transport is None or _transport.backend not in (None, config.httpBackend):
+            _transport = Transport()
+        return _transport
+
+
+def set_transport(transport):
+    ''' Sets the transport used by send_request
+
+    Parameters:
+        transport (Transport):
+            The new transport, or None to restore a default Transport on next use
+
+    Returns:
+        the previous transport
+
+    '''
+    global _transport
+    with _transport_lock:
+        previous, _transport = _transport, transport
+    return previous
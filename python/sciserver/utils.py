@@ -11,7 +11,10 @@
 from __future__ import print_function, division, absolute_import
 from functools import wraps
 from sciserver.exceptions import SciServerError, SciServerAPIError
-from sciserver import config
+from sciserver import config, metrics
+from sciserver.transport import check_deadline
+from sciserver.transport import (Transport, Session, MemorySession, MemoryResponse, RecordingSession,  # noqa: F401
+                                 ReplaySession, HTTP2Session, RateLimiter, get_transport, set_transport)
 import requests
 
 
@@ -107,9 +110,14 @@ def make_header(content_type='application/json', accept_header='text/plain'):
 
 
 def send_request(url, reqtype='get', data=None, content_type='application/json',
-                 acceptHeader='text/plain', errmsg='Error', stream=None):
+                 acceptHeader='text/plain', errmsg='Error', stream=None, idempotent=None, timeout=None,
+                 compress=False):
     ''' Sends a request to the server
 
+    The request is sent by the transport from sciserver.transport.get_transport(), which
+    coalesces concurrent identical non-streamed GET requests into a single HTTP request,
+    and retries GET and DELETE requests after connection errors and transient failures.
+
     Parameters:
         url (str):
             The url path for the request
@@ -125,6 +133,15 @@ def send_request(url, reqtype='get', data=None, content_type='application/json',
             custom error message in case of faults
         stream (bool):
             optional.  if False, the response content will be immediately downloaded
+        idempotent (bool):
+            optional.  if True, a post or put request is safe to send again and may be retried
+        timeout (float|tuple):
+            optional.  the timeout in seconds, or a (connect, read) tuple.  Default is
+            (config.connectTimeout, config.readTimeout), cut to the time left before the
+            current sciserver.deadline
+        compress (bool):
+            optional.  if True, data is an upload that is gzip-compressed when sent to a
+            service listed in config.compressUploads
 
     Returns:
         response:
@@ -145,16 +162,17 @@ def send_request(url, reqtype='get', data=None, content_type='application/json',
 
     headers = make_header(content_type=content_type, accept_header=acceptHeader)
 
+    if reqtype not in ('get', 'post', 'put', 'delete'):
+        raise SciServerError('Request type {0} not supported'.format(reqtype))
+    if reqtype in ('get', 'delete'):
+        data = None
+
     # send the request
     try:
-        if reqtype == 'get':
-            response = requests.get(url, headers=headers, stream=stream)
-        elif reqtype == 'post':
-            response = requests.post(url, data=data, headers=headers, stream=stream)
-        elif reqtype == 'put':
-            response = requests.put(url, data=data, headers=headers, stream=stream)
-        elif reqtype == 'delete':
-            response = requests.delete(url, headers=headers, stream=stream)
+        response = get_transport().request(reqtype, url, headers=headers, data=data, stream=stream,
+                                           idempotent=idempotent, timeout=timeout, compress=compress)
+    except SciServerError:
+        raise
     except Exception as e:
         raise SciServerError("A requests error occurred attempting to send: {0}".format(e))
     else:
@@ -187,3 +205,138 @@ class Task(object):
         else:
             self.name = self.base_name
 
+
+def should_stream(stream):
+    ''' Whether a response is larger than config.streamThreshold once decoded
+
+    The size is counted as the body is read, up to the threshold, since the Content-Length
+    of a compressed response is its compressed size and chunked responses have none.
+    The bytes read stay buffered in the stream.
+
+    Parameters:
+        stream (ResponseStream):
+            The response stream, not yet read from
+    '''
+    if config.streamThreshold is None:
+        return False
+    return len(stream.peek(config.streamThreshold + 1)) > config.streamThreshold
+
+
+class ResponseStream(object):
+    ''' A read-only file-like object over a streamed HTTP response
+
+    Reads the response body in chunks as it is consumed, so it can be passed directly
+    to readers such as pandas.read_csv without first loading the whole body into memory.
+    An optional transform is applied to each chunk of bytes as it is read.  Reading
+    raises SciServerTimeoutError once the current sciserver.deadline has passed.
+
+    Parameters:
+        response:
+            The HTTP response object, requested with stream=True
+        chunk_size (int):
+            The number of bytes to read from the response at a time.  Default is 1 MB.
+        transform (callable):
+            Optional function applied to each chunk of bytes.  It must not depend on
+            the chunk boundaries.
+
+    Attributes:
+        nbytes (int):
+            The number of response bytes consumed so far
+
+    Example:
+        >>> response = send_request(url, stream=True)
+        >>> df = pandas.read_csv(ResponseStream(response))
+
+    '''
+
+    def __init__(self, response, chunk_size=2**20, transform=None):
+        self.response = response
+        self.chunk_size = chunk_size
+        self.transform = transform
+        self.nbytes = 0
+        self._chunks = response.iter_content(chunk_size=chunk_size)
+        self._buffer = b''
+        self._pos = 0
+        self._eof = False
+        self.closed = False
+
+    def __iter__(self):
+        while True:
+            line = self.readline()
+            if not line:
+                return
+            yield line
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def readable(self):
+        return True
+
+    def _available(self):
+        return len(self._buffer) - self._pos
+
+    def _fill(self, size):
+        ''' Reads chunks into the buffer until it holds size bytes or the response ends '''
+        chunks = [self._buffer[self._pos:]]
+        available = len(chunks[0])
+        while not self._eof and (size < 0 or available < size):
+            check_deadline()
+            try:
+                chunk = next(self._chunks)
+            except StopIteration:
+                self._eof = True
+                get_transport().count_download(self.response, self.nbytes)
+                metrics.response_read(self.response, self.nbytes)
+                break
+            self.nbytes += len(chunk)
+            if self.transform:
+                chunk = self.transform(chunk)
+            chunks.append(chunk)
+            available += len(chunk)
+        if len(chunks) > 1:
+            self._buffer = b''.join(chunks)
+            self._pos = 0
+
+    def _take(self, size):
+        data = self._buffer[self._pos:self._pos + size]
+        self._pos += len(data)
+        return data
+
+    def read(self, size=-1):
+        ''' Reads up to size bytes, or to the end of the response if size is negative '''
+        if size is None or size < 0:
+            self._fill(-1)
+            return self._take(self._available())
+
+        # return whatever is already buffered before pulling in another chunk
+        if not self._available():
+            self._fill(size)
+        return self._take(size)
+
+    def peek(self, size=1):
+        ''' Returns the next size bytes without consuming them '''
+        if self._available() < size:
+            self._fill(size)
+        return self._buffer[self._pos:self._pos + size]
+
+    def readline(self, size=-1):
+        ''' Reads a single line '''
+        end = self._buffer.find(b'\n', self._pos)
+        while end < 0 and not self._eof:
+            searched = self._available()
+            self._fill(searched + 1)
+            end = self._buffer.find(b'\n', self._pos + searched)
+        length = end + 1 - self._pos if end >= 0 else self._available()
+        if size is not None and size >= 0:
+            length = min(length, size)
+        return self._take(length)
+
+    def close(self):
+        ''' Closes the underlying response '''
+        if not self.closed:
+            self.closed = True
+            self.response.close()
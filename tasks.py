@@ -9,7 +9,9 @@
 # @Last Modified time: 2017-08-10 06:53:57
 
 from __future__ import print_function, division, absolute_import
+import glob
 import os
+import socket
 from invoke import Collection, task
 
 
@@ -46,7 +48,25 @@ def deploy(ctx):
     ctx.run("twine upload dist/*")
 
 
-ns = Collection(clean, deploy)
+@task
+def benchmark(ctx, save=False, fail='mean:25%'):
+    ''' Runs the benchmarks against the mock server, comparing with the latest baseline of this host
+
+    Baselines hold absolute timings, so they are kept per host in benchmarks/baselines, untracked.
+    The first run on a host saves its baseline.
+
+    '''
+    print('Running the benchmarks')
+    storage = os.path.join('benchmarks', 'baselines', socket.gethostname())
+    cmd = 'pytest benchmarks --benchmark-storage=file://{0}'.format(storage)
+    if save or not glob.glob(os.path.join(storage, '*', '*.json')):
+        cmd += ' --benchmark-save=baseline'
+    else:
+        cmd += ' --benchmark-compare --benchmark-compare-fail={0}'.format(fail)
+    ctx.run(cmd)
+
+
+ns = Collection(clean, deploy, benchmark)
 docs = Collection('docs')
 docs.add_task(build_docs, 'build')
 docs.add_task(clean_docs, 'clean')